@@ -73,7 +73,7 @@ def dAdd(project, orgID, name='', descr='', color=None):
     
     return True
 
-def dGenomeAdd(project, orgID, filename):
+def dGenomeAdd(project, orgID, filename, compress=False):
     '''
     Add a single genome
     '''
@@ -88,7 +88,7 @@ def dGenomeAdd(project, orgID, filename):
         return False
     
     gen = Genome(project)
-    gen.addProteome(orgID, filename)
+    gen.addProteome(orgID, filename, compress=compress)
     logger.info('Added genome %s, having %d proteins'%
                 (orgID, gen.howMany(orgID)))
     return True
@@ -372,7 +372,7 @@ def dPhenomeClear(project):
     logger.info('Successfully removed all phenomic data')
     return True
 
-def dGenomeDirAdd(project, folder, extension):
+def dGenomeDirAdd(project, folder, extension, compress=False):
     '''
     Add a series of genomes contained in a directory
     '''
@@ -399,11 +399,11 @@ def dGenomeDirAdd(project, folder, extension):
             continue
         
         if not org.isMutant(orgID):
-            if not dGenomeAdd(project, orgID, filename):
+            if not dGenomeAdd(project, orgID, filename, compress):
                 logger.error('Could not add genome %s'%infile)
                 return False
         else:
-            if not dGenomeMutAdd(project, orgID, filename):
+            if not dGenomeMutAdd(project, orgID, filename, compress):
                 logger.error('Could not add genome %s'%infile)
                 return False
         added += 1
@@ -475,7 +475,7 @@ def dMutAdd(project, mutID, mutparent,kind, name='', descr='', color=None):
                 %(mutID, org.getOrg(mutID).mkind))
     return True
 
-def dGenomeMutAdd(project, mutID, mutfasta):
+def dGenomeMutAdd(project, mutID, mutfasta, compress=False):
     '''
     Check and add a mutant
     '''
@@ -489,7 +489,7 @@ def dGenomeMutAdd(project, mutID, mutfasta):
         return False
     
     gen = Genome(project)
-    gen.addProteome(mutID, mutfasta)
+    gen.addProteome(mutID, mutfasta, compress=compress)
     logger.info('Mutant %s (%s) added, having %d mutated genes'
                 %(mutID, org.getOrg(mutID).mkind,gen.howMany(mutID)))
     return True
@@ -646,13 +646,18 @@ def dPhenomeTrim(project, trimTime = None):
     
     logger.info('Trimmed %d plates at %f'%(len(plates), mtime))
     
-    logger.info('Updating the plates')
+    if len(exp.trimmed) == 0:
+        logger.info('No signal was affected by the trimming')
+        return True
+    
+    logger.info('Updating %d wells'%len(exp.trimmed))
     # Add to the project
+    # Only the trimmed wells are touched
     biolog = Biolog(project)
-    biolog.updateSignals(exp.getWells(False))
+    biolog.updateSignals(exp.trimmed)
     
     logger.warning('The parameters and the activity must be recalculated')
-    biolog.delWellsParams(exp.getWells(False))
+    biolog.delWellsParams(exp.trimmed)
         
     return True
 
@@ -766,7 +771,6 @@ def dGenomeStats(project, svg=False, doPrint=True):
     
     proj = Project(project)
     organism = Organism(project)
-    genome = Genome(project)
     kegg = Kegg(project)
     
     if kind == 'single' or kind == 'pangenome':
@@ -787,6 +791,7 @@ def dGenomeStats(project, svg=False, doPrint=True):
         f.write(header+'\n')
         
         eReacts = kegg.getExclusiveReactions()
+        oStats = kegg.getOrgsStats()
         
         lOrg = []
         for org in organism.getAll():
@@ -794,13 +799,14 @@ def dGenomeStats(project, svg=False, doPrint=True):
             name = org.name if org.name else 'NONE'
             description = org.description if org.description else 'NONE'
             
-            prots = genome.howMany(org_id)
+            oStat = oStats[org_id]
+            prots = oStat.prots
             
-            mapped, ko, react, path, unireact, ereact = (kegg.howManyMapped(org_id),
-                                        kegg.howManyKO(org_id),
-                                        kegg.howManyReactions(org_id),
-                                        kegg.howManyPathways(org_id),
-                                        kegg.howManyUniqueReactions(org_id),
+            mapped, ko, react, path, unireact, ereact = (oStat.mapped,
+                                        oStat.ko,
+                                        oStat.react,
+                                        oStat.path,
+                                        oStat.unireact,
                                         len(eReacts[org_id]))
             
             stats = '\t'.join( [str(x) for x in [org_id, name, description,
@@ -837,40 +843,19 @@ def dGenomeStats(project, svg=False, doPrint=True):
                 logger.info(header)
             f.write(header+'\n')
                 
-            core, disp, acc, uni = (genome.getLenCore(), genome.getLenDisp(),
-                              genome.getLenAcc(), genome.getLenUni())
-
-            ecore, edisp, eacc, euni = kegg.getExclusiveReactionsPanGenome()
-
+            pStats = kegg.getPanGenomeStats()
+            
             stats = []
-            stats.append('\t'.join( [str(x) for x in ['core', core,
-                                 kegg.howManyMapped(pangenome='core'),
-                                 kegg.howManyKO(pangenome='core'),
-                                 kegg.howManyPathways(pangenome='core'),
-                                 kegg.howManyReactions(pangenome='core'),
-                                 kegg.howManyUniqueReactions(pangenome='core'),
-                                 len(ecore)]]))
-            stats.append('\t'.join( [str(x) for x in ['dispensable', disp,
-                                 kegg.howManyMapped(pangenome='dispensable'),
-                                 kegg.howManyKO(pangenome='dispensable'),
-                                 kegg.howManyPathways(pangenome='dispensable'),
-                                 kegg.howManyReactions(pangenome='dispensable'),
-                                 kegg.howManyUniqueReactions(pangenome='dispensable'),
-                                 len(edisp)]]))
-            stats.append('\t'.join( [str(x) for x in ['accessory', acc,
-                                 kegg.howManyMapped(pangenome='accessory'),
-                                 kegg.howManyKO(pangenome='accessory'),
-                                 kegg.howManyPathways(pangenome='accessory'),
-                                 kegg.howManyReactions(pangenome='accessory'),
-                                 kegg.howManyUniqueReactions(pangenome='accessory'),
-                                 len(eacc)]]))
-            stats.append('\t'.join( [str(x) for x in ['unique', uni,
-                                 kegg.howManyMapped(pangenome='unique'),
-                                 kegg.howManyKO(pangenome='unique'),
-                                 kegg.howManyPathways(pangenome='unique'),
-                                 kegg.howManyReactions(pangenome='unique'),
-                                 kegg.howManyUniqueReactions(pangenome='unique'),
-                                 len(euni)]]))
+            lPanGenome = []
+            for category in ['core', 'dispensable', 'accessory', 'unique']:
+                pStat = pStats[category]
+                stats.append('\t'.join( [str(x) for x in [category,
+                                     pStat.size,
+                                     pStat.mapped, pStat.ko, pStat.path,
+                                     pStat.react, pStat.unireact,
+                                     pStat.ereact]]))
+                lPanGenome.append([category.capitalize(), pStat.size,
+                                   pStat.mapped, pStat.react, pStat.ereact])
             
             for stat in stats:
                 if doPrint:
@@ -882,26 +867,11 @@ def dGenomeStats(project, svg=False, doPrint=True):
             f.close()
             logger.info('Table also saved in file %s'%('pangenome_stats.tsv'))
             
-            lPanGenome = [['Core', core, kegg.howManyMapped(pangenome='core'),
-                           kegg.howManyReactions(pangenome='core'),
-                           len(ecore)],
-                          ['Dispensable', disp,
-                           kegg.howManyMapped(pangenome='dispensable'),
-                           kegg.howManyReactions(pangenome='dispensable'),
-                           len(edisp)],
-                          ['Accessory', acc,
-                           kegg.howManyMapped(pangenome='accessory'),
-                           kegg.howManyReactions(pangenome='accessory'),
-                           len(eacc)],
-                          ['Unique', uni,
-                           kegg.howManyMapped(pangenome='unique'),
-                           kegg.howManyReactions(pangenome='unique'),
-                           len(euni)]]
- 
             plotMapBars(lPanGenome, 'PanGenome statistics', 'pangenome_stats',
                         svg, labels=['Size', 'Mapped to Kegg',
                                 'Kegg reactions', 'Excusive Kegg reaction IDs'])
-            plotPanGenome(core, acc, uni, svg)
+            plotPanGenome(pStats['core'].size, pStats['accessory'].size,
+                          pStats['unique'].size, svg)
             
             logger.info('Pangenome stats (reactions)')
             logger.warning('Please note that here we consider the presence of '+
@@ -952,6 +922,9 @@ def dGenomeStats(project, svg=False, doPrint=True):
                        '"exclusive reaction IDs" column refers to the ones '+
                        'that are present in the wild-type and NOT '+
                        'in the mutant')
+        
+        oStats = kegg.getOrgsStats()
+        
         for ref_id in refs:
             logger.info('Mutants of %s stats'%ref_id)
             
@@ -976,30 +949,28 @@ def dGenomeStats(project, svg=False, doPrint=True):
                 
                 mkind = org.mkind if org.mkind in ['deletion', 'insertion'] else 'wild-type'
                 
-                if mkind not in ['deletion', 'insertion']:
-                    prots = genome.howMany(org_id)
-                elif mkind == 'deletion':
-                    prots = genome.howMany(ref_id) - genome.howMany(org_id)
-                elif mkind == 'insertion':
-                    prots = genome.howMany(ref_id) + genome.howMany(org_id)
+                oStat, rStat = oStats[org_id], oStats[ref_id]
                 
-                mapped, react, unireact, ereact = (kegg.howManyMapped(org_id),
-                                kegg.howManyReactions(org_id),
-                                kegg.howManyUniqueReactions(org_id),
+                prots, mapped, react, unireact, ereact = (oStat.prots,
+                                oStat.mapped,
+                                oStat.react,
+                                oStat.unireact,
                                 len(eReacts[org_id]))
-        
+                
                 if mkind == 'deletion':
-                    mapped = kegg.howManyMapped(ref_id) - mapped
-                    react = kegg.howManyReactions(ref_id) - react
+                    prots = rStat.prots - prots
+                    mapped = rStat.mapped - mapped
+                    react = rStat.react - react
                     # TODO: not sure this calculation is correct
-                    unireact = kegg.howManyUniqueReactions(ref_id) - unireact
+                    unireact = rStat.unireact - unireact
                     #
                     
                 elif mkind == 'insertion':
-                    mapped += kegg.howManyMapped(ref_id)
-                    react += kegg.howManyReactions(ref_id)
+                    prots += rStat.prots
+                    mapped += rStat.mapped
+                    react += rStat.react
                     # TODO: not sure this calculation is correct
-                    unireact += kegg.howManyUniqueReactions(ref_id)
+                    unireact += rStat.unireact
                     #
                 
                 stats = '\t'.join( [str(x) for x in [org_id, name, description,
@@ -1599,8 +1570,8 @@ def dPhenomeStats(project, activity=5, delta=3, svg=False, doPrint=True):
     for categ in categorder:
         line = [categ]
         for org_id in orgs:
-            wells = filter(lambda x:x.plate_id in category[categ],
-                                [w for w in exp.getAverageWells(org_id)])
+            wells = [w for w in exp.getAverageWells(org_id,
+                                                    plates=category[categ])]
             total = float(len(wells))
             active = float(len(filter(lambda x: x.activity >= activity,
                                       wells)))
@@ -2048,31 +2019,72 @@ def dPhenomeRings(project, delta=1, difforg=None, svg=False,
     return True
 
 def dKeggImport(project, infile):
+    import gzip
+    import io
+    import sqlite3
+    
     kegg = Kegg(project)
     
     logger.info('Importing KEGG metabolic network')
     
-    kegg.importKegg(open(infile))
+    # Compressed dump?
+    with open(infile, 'rb') as f:
+        magic = f.read(2)
+    if magic == '\x1f\x8b':
+        fin = io.BufferedReader(gzip.open(infile, 'rb'))
+    else:
+        fin = open(infile)
+    
+    try:
+        i = kegg.importKegg(fin)
+    except (ValueError, sqlite3.Error) as e:
+        logger.error('Could not import the KEGG data (%s)'%e)
+        return False
+    finally:
+        fin.close()
     
-    i = 0
-    for l in open(infile):
-        i += 1
     logger.info('Imported %d KEGG metabolic network entries'%i)
     
     return True
 
+def dKeggCopy(project, source):
+    import sqlite3
+    
+    kegg = Kegg(project)
+    
+    logger.info('Copying KEGG metabolic network from %s'%source)
+    
+    try:
+        i = kegg.copyKegg(source)
+    except sqlite3.Error as e:
+        logger.error('Could not copy the KEGG data (%s)'%e)
+        return False
+    
+    logger.info('Copied %d KEGG metabolic network entries'%i)
+    
+    return True
+
 def dKeggExport(project):
+    import gzip
+    
     kegg = Kegg(project)
     
     logger.info('Exporting KEGG metabolic network')
     
-    fname = 'kegg.tsv'
-    fout = open(fname,'w')
+    fname = 'kegg.tsv.gz'
+    fout = gzip.open(fname,'wb', 6)
     
     i = 0
+    rows = []
     for row in kegg.exportKegg():
-        fout.write(row + '\n')
+        rows.append(row)
         i += 1
+        # Compressed writes are faster in chunks
+        if len(rows) == 10000:
+            fout.write('\n'.join(rows) + '\n')
+            rows = []
+    if len(rows) > 0:
+        fout.write('\n'.join(rows) + '\n')
         
     fout.close()
     
@@ -2404,10 +2416,16 @@ def dBiologImport(project, infile):
     
     return True
 
-def dPhenomeExport(project, json=False):
-    from ductape.phenome.biolog import getSinglePlatesFromSignals
-    from ductape.phenome.biolog import toYAML, toJSON
+def dPhenomeExport(project, json=False, ncpus=1, npz=False):
+    '''
+    Export the phenomic data
+    Plates are written in parallel (ncpus), the other tables are streamed
+    from the storage; if npz is set, all the experiments are saved in
+    a single numpy file as well (phenome.npz)
+    '''
+    from ductape.phenome.biolog import ExportPlate, PhenomeArrays
     from ductape.common.utils import safeSubtraction
+    from itertools import groupby
     
     biolog = Biolog(project)    
     
@@ -2436,26 +2454,35 @@ def dPhenomeExport(project, json=False):
     
     logger.info('Exporting phenomic data for other programs')
     
-    sigs = [x for x in biolog.getAllSignals()]
-    for plate in getSinglePlatesFromSignals(sigs):
-        logger.info('Exporting plate %s, strain %s, replica %d'%(plate.plate_id,
-                                                                 plate.strain,
-                                                                plate.replica))
-        if not json:
-            fout = open('%s_%s_%s.yml'%(plate.plate_id, plate.strain,
-                                    plate.replica), 'w')
-            fout.write(toYAML(plate))
-            fout.close()
-        else:
-            fout = open('%s_%s_%s.json'%(plate.plate_id, plate.strain,
-                                    plate.replica), 'w')
-            fout.write(toJSON(plate))
-            fout.close()
+    if npz:
+        arrays = PhenomeArrays()
+    
+    # One plate at a time from a single cursor
+    # plates are written in small batches, to keep the memory usage low
+    batch = []
+    for key, signals in groupby(biolog.getAllSignals(ordered=True),
+                                lambda x: (x.plate_id, x.org_id, x.replica)):
+        signals = [x for x in signals]
+        if npz:
+            arrays.add(signals)
+        batch.append( ExportPlate(signals, json) )
+        if len(batch) >= ncpus * 10:
+            writePlates(batch, ncpus)
+            batch = []
+    writePlates(batch, ncpus)
+    
+    if npz:
+        arrays.save('phenome.npz')
+        logger.info('Saved %d phenomic experiments (%s)'%(len(arrays),
+                                                           'phenome.npz'))
     
     logger.info('Exporting single organism(s) phenomic data')
     
-    for org in organism.getAll():
-        fname = 'phenome_%s.tsv'%org.org_id
+    orgs = [org.org_id for org in organism.getAll()]
+    
+    for org_id, wells in groupby(biolog.getAllWellsDetails(byorg=True),
+                                 lambda x: x.org_id):
+        fname = 'phenome_%s.tsv'%org_id
         fout = open(fname,'w')
         fout.write('#' + '\t'.join(['plate_id', 'well_id', 'chemical',
                                 'category',
@@ -2463,10 +2490,12 @@ def dPhenomeExport(project, json=False):
                                 'min', 'max', 'height', 'plateau', 'slope',
                                 'lag', 'area', 'source']) + '\n')
         i = 0
-        for w in biolog.getOrgWells(org.org_id):
-            wdet = biolog.getWell(w.plate_id, w.well_id)
-            fout.write('\t'.join([xstr(x) for x in [w.plate_id, w.well_id, wdet.chemical,
-                                  wdet.category, wdet.moa, wdet.co_id]] +
+        replicas = set()
+        # [well, activities] for each plate/well
+        avgs = []
+        for w in wells:
+            fout.write('\t'.join([xstr(x) for x in [w.plate_id, w.well_id, w.chemical,
+                                  w.category, w.moa, w.co_id]] +
                                   [xstr(x) for x in [w.replica, w.activity,
                                                     w.min, w.max, w.height,
                                                     w.plateau, w.slope,
@@ -2474,194 +2503,198 @@ def dPhenomeExport(project, json=False):
                                                     w.source]])
                        + '\n')
             i += 1
+            
+            replicas.add(w.replica)
+            if len(avgs) == 0 or (avgs[-1][0].plate_id, avgs[-1][0].well_id) != (
+                                                        w.plate_id, w.well_id):
+                avgs.append( [w, []] )
+            if w.activity is not None:
+                avgs[-1][1].append(w.activity)
         fout.close()
         
-        if i == 0:
-            os.remove(fname)
-            logger.warning('No phenomic experiments available for %s'%org.org_id)
-        else:            
-            logger.info('Saved %d phenomic experiments from %s (%s)'%(i,
-                                                org.org_id,
-                                                'phenome_%s.tsv'%org.org_id))
+        logger.info('Saved %d phenomic experiments from %s (%s)'%(i,
+                                                org_id,
+                                                'phenome_%s.tsv'%org_id))
+        if org_id in orgs:
+            orgs.remove(org_id)
         
         # Export the average activity if we have replicas
-        if biolog.howManyReplicasByOrg(org.org_id) > 1:
-            fname = 'phenome_avg_%s.tsv'%org.org_id
+        if len(replicas) > 1:
+            fname = 'phenome_avg_%s.tsv'%org_id
             fout = open(fname,'w')
             fout.write('#' + '\t'.join(['plate_id', 'well_id', 'chemical',
                                     'category',
                                     'moa', 'co_id',
                                     'avg activity']) + '\n')
-            i = 0
-            for w in biolog.getOrgDistinctWells(org.org_id):
-                wdet = biolog.getWell(w.plate_id, w.well_id)
-                fout.write('\t'.join([xstr(x) for x in [w.plate_id, w.well_id, wdet.chemical,
-                                      wdet.category, wdet.moa, wdet.co_id,
-                                      xstr(biolog.getAvgActivity(w.plate_id,
-                                                            w.well_id,
-                                                            org.org_id))]])
+            for w, acts in avgs:
+                fout.write('\t'.join([xstr(x) for x in [w.plate_id, w.well_id, w.chemical,
+                                      w.category, w.moa, w.co_id,
+                                      xstr(getMean(acts))]])
                            + '\n')
-                i += 1
             fout.close()            
 
-            if i == 0:
-                os.remove(fname)
-                logger.warning('No average phenomic experiments available'%org.org_id)
-            else:            
-                logger.info('Saved %d average phenomic experiments from %s (%s)'%(i,
-                                                    org.org_id,
-                                                    'phenome_avg_%s.tsv'%org.org_id))
-    
-    if kind == 'pangenome':
-        logger.info('Exporting combined phenomes')
-        
-        fname = 'phenome_combined.tsv'
-        fout = open(fname,'w')
-        fout.write('#' + '\t'.join(['', '', '','','', '', '',
-                                            'activity']) + '\n')            
-        fout.write('#' + '\t'.join(['plate_id', 'well_id', 'chemical',
-                                'category',
-                                'moa', 'co_id', 'replica'] +
-                                [x.org_id for x in organism.getAll()])
-                   + '\n')        
-        
-        i = 0
-        for w in biolog.getDistinctWells(replica=True):
-            wdet = biolog.getWell(w.plate_id, w.well_id)
-            fout.write('\t'.join([xstr(x) for x in [w.plate_id, w.well_id, wdet.chemical,
-                                wdet.category, wdet.moa, wdet.co_id,
-                                w.replica]] +
-                                [xstr(biolog.getOneWell(w.plate_id, w.well_id,
-                                                   x.org_id, w.replica).activity)
-                                 for x in organism.getAll()]) + '\n')
-            i += 1
-        fout.close()            
-
-        if i == 0:
-            os.remove(fname)
-            logger.warning('No combined phenomic experiments available')
-        else:            
-            logger.info('Saved %d combined phenomic experiments (%s)'%(i,
-                        'phenome_combined.tsv'))
-            
-        # Export the average activity if we have replicas
-        if biolog.howManyReplicas() > 1:
-            i = 0
-            fname = 'phenome_avg_combined.tsv'
-            fout = open(fname,'w')
-            fout.write('#' + '\t'.join(['', '', '','','', '', '',
-                                                'avg activity']) + '\n')            
-            fout.write('#' + '\t'.join(['plate_id', 'well_id', 'chemical',
-                                    'category',
-                                    'moa', 'co_id'] +
-                                    [x.org_id for x in organism.getAll()])
-                       + '\n')        
-            
-            for w in biolog.getDistinctWells(replica=False):
-                wdet = biolog.getWell(w.plate_id, w.well_id)
-                fout.write('\t'.join([xstr(x) for x in [w.plate_id, w.well_id, wdet.chemical,
-                                    wdet.category, wdet.moa, wdet.co_id]] +
-                                    [xstr(biolog.getAvgActivity(w.plate_id,
-                                                                w.well_id,
-                                                                x.org_id))
-                                     for x in organism.getAll()]) + '\n')
-                i += 1
-            fout.close()            
+            logger.info('Saved %d average phenomic experiments from %s (%s)'%(len(avgs),
+                                                org_id,
+                                                'phenome_avg_%s.tsv'%org_id))
     
-            if i == 0:
-                os.remove(fname)
-                logger.warning('No combined average phenomic experiments available')
-            else:            
-                logger.info('Saved %d combined average phenomic experiments (%s)'%(i,
-                            'phenome_avg_combined.tsv'))
+    for org_id in orgs:
+        logger.warning('No phenomic experiments available for %s'%org_id)
     
+    if kind == 'pangenome':
+        orgs = [x.org_id for x in organism.getAll()]
+        columns = [[x] for x in orgs]
     elif kind == 'mutants':
-        logger.info('Exporting combined phenomes')
-        
         refs = [org.org_id
                 for org in organism.getAll()
                 if not organism.isMutant(org.org_id)]
-        
-        fname = 'phenome_combined.tsv'
-        fout = open(fname,'w')
-        fout.write('#' + '\t'.join(['', '', '','','', '', '',
-                                            'activity']) + '\n')            
-        fout.write('#' + '\t'.join(['plate_id', 'well_id', 'chemical',
+        columns = [[ref] + [x for x in organism.getOrgMutants(ref)]
+                   for ref in refs]
+    else:
+        return True
+    
+    logger.info('Exporting combined phenomes')
+    
+    fname = 'phenome_combined.tsv'
+    fout = open(fname,'w')
+    fout.write('#' + '\t'.join(['', '', '','','', '', '',
+                                        'activity']) + '\n')            
+    fout.write('#' + '\t'.join(['plate_id', 'well_id', 'chemical',
+                            'category',
+                            'moa', 'co_id', 'replica'] +
+                            [x for column in columns for x in column])
+               + '\n')
+    
+    # Export the average activity if we have replicas
+    if biolog.howManyReplicas() > 1:
+        afname = 'phenome_avg_combined.tsv'
+        afout = open(afname,'w')
+        if kind == 'pangenome':
+            afout.write('#' + '\t'.join(['', '', '','','', '', '',
+                                            'avg activity']) + '\n')
+        else:
+            afout.write('#' + '\t'.join(['', '', '','','', '', '',
+                                        'avg activity and deltas']) + '\n')
+        afout.write('#' + '\t'.join(['plate_id', 'well_id', 'chemical',
                                 'category',
-                                'moa', 'co_id', 'replica']))
-
-        for ref in refs:
-            fout.write('\t' + '\t'.join([ref] + [x for x in organism.getOrgMutants(ref)]))
-        fout.write('\n')
-        
-        i = 0
-        for w in biolog.getDistinctWells(replica=True):
-            wdet = biolog.getWell(w.plate_id, w.well_id)
-            fout.write('\t'.join([xstr(x) for x in [w.plate_id, w.well_id, wdet.chemical,
-                                wdet.category, wdet.moa, wdet.co_id,
-                                w.replica]]))
-            for ref in refs:
-                fout.write('\t' + '\t'.join([xstr(biolog.getOneWell(w.plate_id,
-                                                w.well_id,
-                                                ref,
-                                                w.replica).activity)] + 
-                                            [xstr(biolog.getOneWell(w.plate_id,
-                                                w.well_id,
-                                                x,
-                                                w.replica).activity)
-                                             for x in organism.getOrgMutants(ref)]))
-            fout.write('\n')
+                                'moa', 'co_id'] +
+                                [x for column in columns for x in column])
+                   + '\n')
+    else:
+        afout = None
+    
+    i = 0
+    j = 0
+    for (plate_id, well_id), wells in groupby(
+                                biolog.getAllWellsDetails(byorg=False),
+                                lambda x: (x.plate_id, x.well_id)):
+        # org_id --> activities
+        avgacts = {}
+        for replica, rwells in groupby(wells, lambda x: x.replica):
+            acts = {}
+            for w in rwells:
+                acts[w.org_id] = w.activity
+                if w.activity is not None:
+                    avgacts[w.org_id] = avgacts.get(w.org_id, []) + [w.activity]
+            
+            fout.write('\t'.join([xstr(x) for x in [w.plate_id, w.well_id, w.chemical,
+                                w.category, w.moa, w.co_id,
+                                w.replica]] +
+                                [xstr(acts.get(x))
+                                 for column in columns for x in column]) + '\n')
             i += 1
-        fout.close()            
-
-        if i == 0:
-            os.remove(fname)
-            logger.warning('No combined phenomic experiments available')
-        else:            
-            logger.info('Saved %d combined phenomic experiments (%s)'%(i,
-                        'phenome_combined.tsv'))
         
-        # Export the average activity if we have replicas
-        if biolog.howManyReplicas() > 1:
-            i = 0
-            fname = 'phenome_avg_combined.tsv'
-            fout = open(fname,'w')
-            fout.write('#' + '\t'.join(['', '', '','','', '', '',
-                                                'avg activity and deltas']) + '\n')            
-            fout.write('#' + '\t'.join(['plate_id', 'well_id', 'chemical',
-                                    'category',
-                                    'moa', 'co_id']))
+        if afout is None:
+            continue
+        
+        afout.write('\t'.join([xstr(x) for x in [w.plate_id, w.well_id, w.chemical,
+                              w.category, w.moa, w.co_id]]))
+        for column in columns:
+            ref_act = getMean(avgacts.get(column[0], []))
+            afout.write('\t' + '\t'.join([xstr(ref_act)] +
+                                [xstr(safeSubtraction(ref_act,
+                                            getMean(avgacts.get(x, []))))
+                                 for x in column[1:]]))
+        afout.write('\n')
+        j += 1
+    fout.close()
     
-            for ref in refs:
-                fout.write('\t' + '\t'.join([ref] + [x for x in organism.getOrgMutants(ref)]))
-            fout.write('\n')
-            
-            for w in biolog.getDistinctWells(replica=False):
-                wdet = biolog.getWell(w.plate_id, w.well_id)
-                fout.write('\t'.join([xstr(x) for x in [w.plate_id, w.well_id, wdet.chemical,
-                                    wdet.category, wdet.moa, wdet.co_id]]))
-                for ref in refs:
-                    ref_act = biolog.getAvgActivity(w.plate_id, w.well_id, ref)
-                    fout.write('\t' + '\t'.join([xstr(ref_act)] + 
-                                                [xstr(safeSubtraction(ref_act, 
-                                                      biolog.getAvgActivity(
-                                                                    w.plate_id,
-                                                                    w.well_id,
-                                                                    x)))
-                                                 for x in organism.getOrgMutants(ref)]))
-                fout.write('\n')
-                i += 1
-            fout.close()            
+    logger.info('Saved %d combined phenomic experiments (%s)'%(i,
+                    'phenome_combined.tsv'))
     
-            if i == 0:
-                os.remove(fname)
-                logger.warning('No combined average phenomic experiments available')
-            else:            
-                logger.info('Saved %d combined average phenomic experiments (%s)'%(i,
-                            'phenome_avg_combined.tsv'))        
+    if afout is not None:
+        afout.close()
+        logger.info('Saved %d combined average phenomic experiments (%s)'%(j,
+                    'phenome_avg_combined.tsv'))
                        
     return True
 
+def getMean(values):
+    '''
+    Mean of a list of values (None if the list is empty)
+    '''
+    if len(values) == 0:
+        return None
+    return sum(values) / float(len(values))
+
+def writePlates(tasks, ncpus=1):
+    '''
+    Write a batch of plates (ExportPlate tasks) using ncpus processes
+    '''
+    from ductape.common.commonmultiprocess import runParallel
+    
+    for plate_id, strain, replica, fname in runParallel(tasks, ncpus):
+        if fname is None:
+            logger.warning('Could not export plate %s, strain %s, replica %d'%
+                           (plate_id, strain, replica))
+        else:
+            logger.info('Exported plate %s, strain %s, replica %d'%(plate_id,
+                                                                    strain,
+                                                                    replica))
+
+def getCompoundsMean(wells, values):
+    '''
+    Mean value for each compound (some compounds are present in more
+    than one well); wells and values are rows and a column of a
+    Biolog activity matrix (NaN values are skipped)
+    Returns a dictionary co_id --> value
+    '''
+    corg = {}
+    for well, value in zip(wells, values):
+        if well.co_id is None or math.isnan(value):
+            continue
+        corg[well.co_id] = corg.get(well.co_id, []) + [value]
+    
+    return dict([(k, np.array(v).mean()) for k, v in corg.iteritems()])
+
+def getPairwiseDiffs(matrix):
+    '''
+    Mean absolute difference between each pair of organisms (columns)
+    for each well (rows) of a Biolog activity matrix
+    Wells with less than two organisms get a NaN value
+    '''
+    i, j = np.triu_indices(matrix.shape[1], 1)
+    diffs = np.abs(matrix[:, i] - matrix[:, j])
+    counts = (~np.isnan(diffs)).sum(axis=1)
+    
+    means = np.empty(matrix.shape[0])
+    means.fill(np.nan)
+    means[counts > 0] = np.nansum(diffs[counts > 0], axis=1) / counts[counts > 0]
+    
+    return means
+
+def getOrgActivity(project, org_id, category, path_id=None):
+    '''
+    Mean activity of each compound of a category for an organism
+    (only the compounds of path_id, if provided)
+    Returns a dictionary co_id --> activity
+    '''
+    wells, orgs, matrix = Biolog(project).getActivityMatrix(category=category,
+                                                             path_id=path_id)
+    if org_id not in orgs:
+        return {}
+    
+    return getCompoundsMean(wells, matrix[:, orgs.index(org_id)])
+
 def getTotalNet(project, path_id=None):
     '''
     Get the overall Kegg metabolic net
@@ -2701,33 +2734,7 @@ def getOrgNet(project, org_id, path_id=None, category=None):
         biolog = Biolog(project)
         vmax = biolog.getMaxActivity()
 
-        corg = {}
-        
-        # Filter by path?
-        path_co = []
-        if path_id:
-            path_co = [x.co_id for x in kegg.getPathComps(path_id)]
-            wells = [w for w in biolog.getAllCoByCateg(category)
-                        if 'cpd:'+w.co_id in path_co]
-        else:
-            wells = [w for w in biolog.getAllCoByCateg(category)]
-        for well in wells:
-            act = biolog.getAvgActivity(well.plate_id, well.well_id, org_id)
-            if act is not None:
-                # Some co_ids are present more than once
-                if well.co_id not in corg:
-                    corg[well.co_id] = []
-                corg[well.co_id].append(act)
-    
-        toremove = set()
-        for k, v in corg.iteritems():
-            mean = np.array(v).mean()
-            if not math.isnan(float(mean)):
-                corg[k] = mean
-            else:
-                toremove.add(k)
-        for k in toremove:
-            del corg[k]
+        corg = getOrgActivity(project, org_id, category, path_id)
         
         compounds = [Compound('cpd:'+k,kegg.getCompound('cpd:'+k).name,v,vmax) for k,v in corg.iteritems()]
         net.addNodes(compounds)
@@ -2758,33 +2765,7 @@ def getMutNet(project, mut_id, mut_rpairs, path_id=None, category=None):
         biolog = Biolog(project)
         vmax = biolog.getMaxActivity()
 
-        corg = {}
-        
-        # Filter by path?
-        path_co = []
-        if path_id:
-            path_co = [x.co_id for x in kegg.getPathComps(path_id)]
-            wells = [w for w in biolog.getAllCoByCateg(category)
-                        if 'cpd:'+w.co_id in path_co]
-        else:
-            wells = [w for w in biolog.getAllCoByCateg(category)]
-        for well in wells:
-            act = biolog.getAvgActivity(well.plate_id, well.well_id, mut_id)
-            if act is not None:
-                # Some co_ids are present more than once
-                if well.co_id not in corg:
-                    corg[well.co_id] = []
-                corg[well.co_id].append(act)
-    
-        toremove = set()
-        for k, v in corg.iteritems():
-            mean = np.array(v).mean()
-            if not math.isnan(float(mean)):
-                corg[k] = mean
-            else:
-                toremove.add(k)
-        for k in toremove:
-            del corg[k]
+        corg = getOrgActivity(project, mut_id, category, path_id)
         
         compounds = [Compound('cpd:'+k,kegg.getCompound('cpd:'+k).name,v,vmax) for k,v in corg.iteritems()]
         net.addNodes(compounds)
@@ -2812,7 +2793,6 @@ def getPanGenomeNet(project, dpangenome, pangenome='all', path_id=None, category
         logger.debug('Building total metabolic network for %s'%pangenome)
         
     from ductape.kegg.net import MetabolicNet, Compound
-    from itertools import combinations
     
     kegg = Kegg(project)
     
@@ -2825,45 +2805,10 @@ def getPanGenomeNet(project, dpangenome, pangenome='all', path_id=None, category
         biolog = Biolog(project)
         vmax = biolog.getMaxActivity()
         
-        corg = {}
-        
-        # Filter by path?
-        path_co = []
-        if path_id:
-            path_co = [x.co_id for x in kegg.getPathComps(path_id)]
-            wells = [w for w in biolog.getAllCoByCateg(category)
-                        if 'cpd:'+w.co_id in path_co]
-        else:
-            wells = [w for w in biolog.getAllCoByCateg(category)]
-        
-        for well in wells:
-            acts = [x.avgact 
-                    for x in
-                    biolog.getAvgActivityEachOrg(well.plate_id,
-                                                 well.well_id)]
-            if len(acts) <= 1:
-                continue
-            
-            diffs = []
-            for a, a1 in combinations(acts, 2):
-                diffs.append( abs(a - a1) )
-                
-            avgdiff = np.array(diffs).mean()
-            
-            # Some co_ids are present more than once
-            if well.co_id not in corg:
-                corg[well.co_id] = []
-            corg[well.co_id].append(avgdiff)
-        
-        toremove = set()
-        for k, v in corg.iteritems():
-            mean = np.array(v).mean()
-            if not math.isnan(float(mean)):
-                corg[k] = mean
-            else:
-                toremove.add(k)
-        for k in toremove:
-            del corg[k]
+        # Mean activity difference between the organisms
+        wells, orgs, matrix = biolog.getActivityMatrix(category=category,
+                                                       path_id=path_id)
+        corg = getCompoundsMean(wells, getPairwiseDiffs(matrix))
         
         compounds = [Compound('cpd:'+k,kegg.getCompound('cpd:'+k).name,v,vmax) for k,v in corg.iteritems()]
         net.addNodes(compounds)
@@ -2871,9 +2816,11 @@ def getPanGenomeNet(project, dpangenome, pangenome='all', path_id=None, category
         
     return net
 
-def writeNet(net, path, name):
+def writeNet(net, path, name, binary=False):
     '''
     Save a network as a gml file in the desired location
+    If binary is set, the compact binary format is saved as well
+    (same name, .dnet extension)
     '''
     import networkx as nx
     try:
@@ -2882,6 +2829,8 @@ def writeNet(net, path, name):
     except AttributeError:
         # old version of networkx
         nx.write_gml(net.net, os.path.join(path,name))
+    if binary:
+        net.writeBinary(os.path.join(path, os.path.splitext(name)[0]+'.dnet'))
     logger.debug('Saved network %s to %s'%(name, path))
 
 def writeCombinedPanGenome(dvalues):
@@ -2958,9 +2907,10 @@ def writeCombined(dvalues, orgs):
     fout.close()
     logger.info('Saved combined informations (%s)'%fname)
 
-def dNet(project, allorgs=False, allpaths=False):
+def dNet(project, allorgs=False, allpaths=False, binary=False):
     '''
     Metabolic network reconstruction and analysis
+    If binary is set, the networks are saved in binary format as well
     '''
     from ductape.common.utils import makeRoom
     from ductape.kegg.kegg import avoidedPaths
@@ -2996,12 +2946,12 @@ def dNet(project, allorgs=False, allpaths=False):
         
     # Write
     npath = makeRoom('', 'metNet', 'KEGG')
-    writeNet(aNet, npath, 'ALL.gml')
+    writeNet(aNet, npath, 'ALL.gml', binary)
     for k,v in dapNet.iteritems():
         if ':' in k:
             k = k.split(':')[1]
         if allpaths:
-            writeNet(v, npath, '%s.gml'%k)
+            writeNet(v, npath, '%s.gml'%k, binary)
         
     if proj.isPanGenome() and kind == 'pangenome' and not allorgs:
         orgs = ['conserved', 'variable']
@@ -3044,7 +2994,7 @@ def dNet(project, allorgs=False, allpaths=False):
         for org in orgs:
             oNet[org] = getPanGenomeNet(project, dpangenome, org)
             npath = makeRoom('', 'metNet', org)
-            writeNet(oNet[org], npath, '%s.gml'%org)
+            writeNet(oNet[org], npath, '%s.gml'%org, binary)
         
             
         flen.write('\t'.join( ['All', ''] +
@@ -3068,7 +3018,7 @@ def dNet(project, allorgs=False, allpaths=False):
                                        'all',
                                        category=categ.category)
                 npath = makeRoom('', 'metNet', 'all', scateg)
-                writeNet(oNet, npath, '%s_%s.gml'%('all', scateg))
+                writeNet(oNet, npath, '%s_%s.gml'%('all', scateg), binary)
                 
                 fact.write('\t'.join( ['All', '', scateg] +
                               [str(oNet.mean())] + [str(oNet.std())]) + '\n')
@@ -3104,7 +3054,7 @@ def dNet(project, allorgs=False, allpaths=False):
                                                org_id, path.path_id)
                 if allpaths and not skip:
                     npath = makeRoom('', 'metNet', org_id)
-                    writeNet(oNet[org_id], npath, '%s_%s.gml'%(org_id, spath))
+                    writeNet(oNet[org_id], npath, '%s_%s.gml'%(org_id, spath), binary)
             
             iAll = len(dapNet[path.path_id])
             iDisp = len(oNet['variable'].getDistinctReactions())
@@ -3158,7 +3108,7 @@ def dNet(project, allorgs=False, allpaths=False):
                     if allpaths:
                         npath = makeRoom('', 'metNet', 'all', scateg)
                         writeNet(oNet, npath,
-                                 '%s_%s_%s.gml'%('all', scateg, spath))
+                                 '%s_%s_%s.gml'%('all', scateg, spath), binary)
                     
                     fact.write('\t'.join( [path.path_id, path.name, scateg] +
                                   [str(oNet.mean())] + [str(oNet.std())]) + '\n')
@@ -3228,7 +3178,7 @@ def dNet(project, allorgs=False, allpaths=False):
         for org_id in orgs:
             oNet[org_id] = getOrgNet(project, org_id)
             npath = makeRoom('', 'metNet', org_id)
-            writeNet(oNet[org_id], npath, '%s.gml'%org_id)
+            writeNet(oNet[org_id], npath, '%s.gml'%org_id, binary)
             
         flen.write('\t'.join( ['All', ''] +
                               [str(len(aNet.getDistinctReactions()))] +
@@ -3259,7 +3209,7 @@ def dNet(project, allorgs=False, allpaths=False):
                                              org_id,
                                              category=categ.category)
                     npath = makeRoom('', 'metNet', org_id, scateg)
-                    writeNet(oNet[org_id], npath, '%s_%s.gml'%(org_id, scateg))
+                    writeNet(oNet[org_id], npath, '%s_%s.gml'%(org_id, scateg), binary)
                 
                 fact.write('\t'.join( ['All', '', scateg] +
                               [str(oNet[x].mean()) for x in orgs] +
@@ -3296,7 +3246,7 @@ def dNet(project, allorgs=False, allpaths=False):
                 
                 if allpaths:
                     npath = makeRoom('', 'metNet', org_id)
-                    writeNet(oNet[org_id], npath, '%s_%s.gml'%(org_id, spath))
+                    writeNet(oNet[org_id], npath, '%s_%s.gml'%(org_id, spath), binary)
             
             skip = False
             if sum( [len(oNet[x]) for x in oNet] ) == 0:
@@ -3356,7 +3306,7 @@ def dNet(project, allorgs=False, allpaths=False):
                                 continue
                             npath = makeRoom('', 'metNet', org_id, scateg)
                             writeNet(oNet[org_id], npath,
-                                     '%s_%s_%s.gml'%(org_id, scateg, spath))
+                                     '%s_%s_%s.gml'%(org_id, scateg, spath), binary)
                     
                     check = set([oNet[x].hasNodesWeight() for x in oNet])
                     if len(check) == 1 and check.pop() == False:
@@ -3434,13 +3384,13 @@ def dNet(project, allorgs=False, allpaths=False):
             
             oNet[ref_id] = getOrgNet(project, ref_id)
             npath = makeRoom('', 'metNet', ref_id)
-            writeNet(oNet[ref_id], npath, '%s.gml'%ref_id)
+            writeNet(oNet[ref_id], npath, '%s.gml'%ref_id, binary)
             
             for mut_id in muts:
                 oNet[mut_id] = getMutNet(project, mut_id,
                                          ref_rpairs[ref_id][mut_id].values())
                 npath = makeRoom('', 'metNet', mut_id)
-                writeNet(oNet[mut_id], npath, '%s.gml'%mut_id)
+                writeNet(oNet[mut_id], npath, '%s.gml'%mut_id, binary)
             
         flen.write('\t'.join( ['All', ''] +
                               [str(len(aNet.getDistinctReactions()))] +
@@ -3472,7 +3422,7 @@ def dNet(project, allorgs=False, allpaths=False):
                     oNet[ref_id] = getOrgNet(project, ref_id,
                                              category=categ.category)
                     npath = makeRoom('', 'metNet', ref_id, scateg)
-                    writeNet(oNet[ref_id], npath, '%s_%s.gml'%(ref_id, scateg))
+                    writeNet(oNet[ref_id], npath, '%s_%s.gml'%(ref_id, scateg), binary)
                     
                     for mut_id in muts:
                         oNet[mut_id] = getMutNet(project,
@@ -3480,7 +3430,7 @@ def dNet(project, allorgs=False, allpaths=False):
                                                  ref_rpairs[ref_id][mut_id].values(),
                                                  category=categ.category)
                         npath = makeRoom('', 'metNet', mut_id, scateg)
-                        writeNet(oNet[mut_id], npath, '%s_%s.gml'%(mut_id, scateg))
+                        writeNet(oNet[mut_id], npath, '%s_%s.gml'%(mut_id, scateg), binary)
                 
                 fact.write('\t'.join( ['All', '', scateg] +
                               [str(oNet[x].mean()) for x in orgs] +
@@ -3523,7 +3473,7 @@ def dNet(project, allorgs=False, allpaths=False):
                 
                 if allpaths and not skip:
                     npath = makeRoom('', 'metNet', ref_id)
-                    writeNet(oNet[ref_id], npath, '%s_%s.gml'%(ref_id, spath))
+                    writeNet(oNet[ref_id], npath, '%s_%s.gml'%(ref_id, spath), binary)
             
                 for mut_id in muts:
                     oNet[mut_id] = getMutNet(project,
@@ -3543,7 +3493,7 @@ def dNet(project, allorgs=False, allpaths=False):
                     
                     if allpaths and not skip:
                         npath = makeRoom('', 'metNet', mut_id)
-                        writeNet(oNet[mut_id], npath, '%s_%s.gml'%(mut_id, spath))
+                        writeNet(oNet[mut_id], npath, '%s_%s.gml'%(mut_id, spath), binary)
             
             skip = False
             if sum( [len(oNet[x]) for x in oNet] ) == 0:
@@ -3612,7 +3562,7 @@ def dNet(project, allorgs=False, allpaths=False):
                             if not skip:
                                 npath = makeRoom('', 'metNet', ref_id, scateg)
                                 writeNet(oNet[ref_id], npath,
-                                         '%s_%s_%s.gml'%(ref_id, scateg, spath))
+                                         '%s_%s_%s.gml'%(ref_id, scateg, spath), binary)
                         
                         for mut_id in muts:
                             oNet[mut_id] = getMutNet(project,
@@ -3634,7 +3584,7 @@ def dNet(project, allorgs=False, allpaths=False):
                                     continue
                                 npath = makeRoom('', 'metNet', mut_id, scateg)
                                 writeNet(oNet[mut_id], npath,
-                                         '%s_%s_%s.gml'%(mut_id, scateg, spath))
+                                         '%s_%s_%s.gml'%(mut_id, scateg, spath), binary)
                     
                     check = set([oNet[x].hasNodesWeight() for x in oNet])
                     if len(check) == 1 and check.pop() == False:
@@ -3846,7 +3796,6 @@ def dCombine(project, allorgs=False, pthresh=5, doPrint=True):
     Prepare a table/heatmap focused on compound activity/genetic content
     '''
     from ductape.kegg.kegg import avoidedPaths
-    from itertools import combinations
     
     kind = dSetKind(project)
     
@@ -3888,40 +3837,10 @@ def dCombine(project, allorgs=False, pthresh=5, doPrint=True):
             category = categ.category
             scateg = categ.category.replace(' ','_').replace('&','and')
 
-            corg = {}
-            
-            wells = [w for w in biolog.getAllCoByCateg(category)]
-            
-            for well in wells:
-                co_id = 'cpd:' + well.co_id
-                
-                acts = [x.avgact 
-                        for x in
-                        biolog.getAvgActivityEachOrg(well.plate_id,
-                                                     well.well_id)]
-                if len(acts) <= 1:
-                    continue
-                
-                diffs = []
-                for a, a1 in combinations(acts, 2):
-                    diffs.append( abs(a - a1) )
-                    
-                avgdiff = np.array(diffs).mean()
-                
-                # Some co_ids are present more than once
-                if co_id not in corg:
-                    corg[co_id] = []
-                corg[co_id].append(avgdiff)
-            
-            toremove = set()
-            for k, v in corg.iteritems():
-                mean = np.array(v).mean()
-                if not math.isnan(float(mean)):
-                    corg[k] = mean
-                else:
-                    toremove.add(k)
-            for k in toremove:
-                del corg[k]
+            # Mean activity difference between the organisms
+            wells, orgs, matrix = biolog.getActivityMatrix(category=category)
+            corg = dict([('cpd:' + k, v) for k, v in
+                    getCompoundsMean(wells, getPairwiseDiffs(matrix)).iteritems()])
                 
             # Insert the compounds inside the matrix
             for co_id in corg:
@@ -4053,30 +3972,8 @@ def dCombine(project, allorgs=False, pthresh=5, doPrint=True):
                 category = categ.category
                 scateg = categ.category.replace(' ','_').replace('&','and')
     
-                corg = {}
-        
-                # Filter by path?
-                wells = [w for w in biolog.getAllCoByCateg(category)]
-                for well in wells:
-                    co_id = 'cpd:' + well.co_id
-                    
-                    act = biolog.getAvgActivity(well.plate_id, well.well_id,
-                                                org_id)
-                    if act is not None:
-                        # Some co_ids are present more than once
-                        if co_id not in corg:
-                            corg[co_id] = []
-                        corg[co_id].append(act)
-            
-                toremove = set()
-                for k, v in corg.iteritems():
-                    mean = np.array(v).mean()
-                    if not math.isnan(float(mean)):
-                        corg[k] = mean
-                    else:
-                        toremove.add(k)
-                for k in toremove:
-                    del corg[k]
+                corg = dict([('cpd:' + k, v) for k, v in
+                    getOrgActivity(project, org_id, category).iteritems()])
                 
                 # Insert the compounds inside the matrix
                 for co_id in corg:
@@ -4152,31 +4049,16 @@ def dCombine(project, allorgs=False, pthresh=5, doPrint=True):
                     category = categ.category
                     scateg = categ.category.replace(' ','_').replace('&','and')
 
-                    corg = {}
-        
-                    # Filter by path?
-                    wells = [w for w in biolog.getAllCoByCateg(category)]
-                    for well in wells:
-                        co_id = 'cpd:' + well.co_id
-                        refact = biolog.getAvgActivity(well.plate_id, well.well_id,
-                                                       ref_id)
-                        act = biolog.getAvgActivity(well.plate_id, well.well_id,
-                                                    mut_id)
-                        if act is not None and refact is not None:
-                            # Some co_ids are present more than once
-                            if co_id not in corg:
-                                corg[co_id] = []
-                            corg[co_id].append(refact-act)
-                
-                    toremove = set()
-                    for k, v in corg.iteritems():
-                        mean = np.array(v).mean()
-                        if not math.isnan(float(mean)):
-                            corg[k] = mean
-                        else:
-                            toremove.add(k)
-                    for k in toremove:
-                        del corg[k]
+                    # Activity difference with the parent strain
+                    wells, orgs, matrix = biolog.getActivityMatrix(
+                                                        category=category)
+                    if ref_id in orgs and mut_id in orgs:
+                        corg = dict([('cpd:' + k, v) for k, v in
+                            getCompoundsMean(wells,
+                                    matrix[:, orgs.index(ref_id)] -
+                                    matrix[:, orgs.index(mut_id)]).iteritems()])
+                    else:
+                        corg = {}
                     
                     # Insert the compounds inside the matrix
                     for co_id in corg:
@@ -4466,14 +4348,10 @@ def getExclusiveReactions(project, orgs=set()):
     # Get the exclusive reactions
     ereacts = kegg.getExclusiveReactions(orgs)
     # Get the reactions of each organisms
-    mreacts = {}
-    for org_id in orgs:
-        mreacts[org_id] = set()
-        for oR in kegg.getOrgReact(org_id):
-            mreacts[org_id].add(oR.re_id)
+    mreacts = kegg.getOrgsReactions(orgs)
     
     # Remove the exclusives
-    for org_id in orgs:
+    for org_id in mreacts:
         mreacts[org_id].difference_update(ereacts[org_id])
         
     return mreacts, ereacts
@@ -4555,13 +4433,12 @@ def prepareColors(maximum, colorrange):
     
     return hexs
 
-def createLegend(kind, project):
+def createLegend(kind, project, fname='legend.png'):
     '''
     Create a color scheme legend
     '''
     # TODO: a more centralized color scheme
     fig = plt.figure()
-    fname = 'legend.png'
     
     # Get the maximum activity now present
     maxAct = Biolog(project).getMaxActivity()
@@ -4832,6 +4709,7 @@ def touchProject(project):
         return False
     else:
         proj = Project(project)
+        proj.upgrade()
         proj.updateLast()
         logger.debug('%s'%str(proj))
         return True
@@ -80,7 +80,7 @@ class PathPanGenomer(CommonMultiProcess):
                     logger.debug('Exiting for a kill signal')
                     return
                 
-                path_id, dpangenome = self._parallelresults.get()
+                path_id, dpangenome = self.getParallelResult()
                 self.result[path_id] = dpangenome
                 
                 self._substatus += 1
@@ -96,7 +96,7 @@ class PathPanGenomer(CommonMultiProcess):
                 logger.debug('Exiting for a kill signal')
                 return
             
-            path_id, dpangenome = self._parallelresults.get()
+            path_id, dpangenome = self.getParallelResult()
             self.result[path_id] = dpangenome
             
             self._substatus += 1
@@ -108,7 +108,12 @@ class PathPanGenomer(CommonMultiProcess):
     
     def run(self):
         self.updateStatus()
-        if not self.analyzePaths():
+        try:
+            res = self.analyzePaths()
+        except RuntimeError:
+            self.killParallel()
+            res = False
+        if not res:
             self.sendFailure('Could not analyze pathways!')
             return
         self.resetSubStatus()
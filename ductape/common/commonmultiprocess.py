@@ -11,6 +11,7 @@ from multiprocessing.queues import Queue
 import logging
 import multiprocessing
 import time
+import traceback
 
 # Consumer borrowed from http://broadcast.oreilly.com/
 # EINTR fix borrowed from Boyd Waters
@@ -110,6 +111,14 @@ class SafeQueue(Queue):
         e = IOError('Unrecoverable error')
         raise e
 
+class TaskFailure(object):
+    '''
+    Put in the results queue when a task raises an exception
+    '''
+    def __init__(self, task, detail):
+        self.task = task
+        self.detail = detail
+
 class Consumer(multiprocessing.Process):
     
     def __init__(self, 
@@ -127,7 +136,13 @@ class Consumer(multiprocessing.Process):
             if next_task is None:
                 # Poison pill means we should exit
                 break
-            answer = next_task()
+            try:
+                answer = next_task()
+            except Exception:
+                # Otherwise the parent would wait forever for this result
+                logger.error('Task %s failed'%next_task.__class__.__name__)
+                answer = TaskFailure(next_task.__class__.__name__,
+                                     traceback.format_exc())
             self.result_queue.put(answer)
         return
     
@@ -145,6 +160,8 @@ class CommonMultiProcess(CommonThread):
         self._paralleltasks = SafeQueue()
         self._parallelresults = SafeQueue()
         self.sleeper = SafeSleep()
+        # Pluggable executor (see ductape.common.executors)
+        self.executor = None
         
         # ID
         self._unique = 0
@@ -153,6 +170,23 @@ class CommonMultiProcess(CommonThread):
         self._unique += 1
         return self._unique
     
+    def runTasks(self, tasks):
+        '''
+        Run a list of callable objects with the executor, if set,
+        otherwise using ncpus local processes
+        Generator to the results (in no particular order)
+        '''
+        if self.executor is None:
+            return runParallel(tasks, self.ncpus)
+        return self.executor.run(tasks)
+    
+    def getParallelResult(self):
+        '''
+        Get a result of the parallel tasks
+        Raises RuntimeError if the task failed
+        '''
+        return checkResult(self._parallelresults.get())
+    
     def initiateParallel(self):
         self._parallel = [Consumer(self._paralleltasks,self._parallelresults)
                           for x in range(self.ncpus)]
@@ -170,5 +204,61 @@ class CommonMultiProcess(CommonThread):
         return True
 
     def killParallel(self):
+        if self._parallel is None:
+            return
         for consumer in self._parallel:
             consumer.terminate()
+
+def checkResult(result):
+    '''
+    Raises RuntimeError if the result comes from a failed task
+    '''
+    if isinstance(result, TaskFailure):
+        logger.error('Task %s failed: %s'%(result.task, result.detail))
+        raise RuntimeError('Task %s failed'%result.task)
+    return result
+
+def runParallel(tasks, ncpus=1):
+    '''
+    Run a list of callable objects using ncpus processes
+    Generator to the results (in no particular order)
+    If ncpus is 1 the tasks are run in the current process
+    
+    The tasks should return a failure flag instead of raising exceptions;
+    if a task raises anyway RuntimeError is raised here
+    '''
+    ncpus = min(int(ncpus), len(tasks))
+    
+    if ncpus <= 1:
+        for task in tasks:
+            try:
+                result = task()
+            except Exception:
+                result = TaskFailure(task.__class__.__name__,
+                                     traceback.format_exc())
+            yield checkResult(result)
+        return
+    
+    paralleltasks = SafeQueue()
+    parallelresults = SafeQueue()
+    
+    consumers = [Consumer(paralleltasks, parallelresults)
+                 for x in range(ncpus)]
+    for task in tasks:
+        paralleltasks.put(task)
+    # Poison pill to stop the workers
+    for consumer in consumers:
+        paralleltasks.put(None)
+    
+    for consumer in consumers:
+        consumer.start()
+    
+    try:
+        for i in range(len(tasks)):
+            yield checkResult(parallelresults.get())
+        for consumer in consumers:
+            consumer.join()
+    finally:
+        for consumer in consumers:
+            if consumer.is_alive():
+                consumer.terminate()
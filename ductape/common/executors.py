@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+"""
+Executors
+
+Common library
+
+Pluggable executors for the callable tasks: local processes, a spool
+directory on a shared filesystem served by workers on other hosts, or a
+batch scheduler submission command
+"""
+from ductape.common.commonmultiprocess import runParallel
+import cPickle
+import logging
+import multiprocessing
+import os
+import socket
+import subprocess
+import threading
+import time
+import traceback
+import uuid
+
+__author__ = "Marco Galardini"
+
+################################################################################
+# Log setup
+
+logger = logging.getLogger('ductape.executors')
+
+################################################################################
+# Constants
+
+# Spool subdirectories
+queueDir = 'queue'
+runningDir = 'running'
+doneDir = 'done'
+
+# Worker command, used by the submission command
+workerCommand = 'dgenome worker %s -j %s'
+
+# The workers touch their claimed jobs every heartbeat seconds; claims
+# older than staleTimeout seconds are considered dead and requeued
+heartbeat = 30
+staleTimeout = 300
+# Maximum number of requeues of a single job
+maxRetries = 3
+
+################################################################################
+# Classes
+
+class LocalExecutor(object):
+    '''
+    Class LocalExecutor
+    Runs the tasks using ncpus processes on this host
+    '''
+    def __init__(self, ncpus=1):
+        self.ncpus = int(ncpus)
+
+    def run(self, tasks):
+        '''
+        Generator to the results (in no particular order)
+        '''
+        return runParallel(tasks, self.ncpus)
+
+class SpoolExecutor(object):
+    '''
+    Class SpoolExecutor
+    The tasks are pickled as jobs in a spool directory on a shared
+    filesystem; the workers (see runWorker) claim them with an atomic
+    rename and write back the pickled results
+
+    The tasks should only use paths reachable by the workers
+    If workers is > 0 that many local workers are started (i.e. for tests
+    or to use this host too)
+    The claims of dead workers (no heartbeat for stale seconds) are put
+    back in the queue, up to maxRetries times; if timeout is set
+    RuntimeError is raised when the jobs are not done in time
+    '''
+    def __init__(self, spool, workers=0, poll=1.0, stale=staleTimeout,
+                 timeout=None):
+        self.spool = os.path.abspath(spool)
+        self.workers = int(workers)
+        self.poll = float(poll)
+        self.stale = float(stale)
+        self.timeout = timeout
+
+        for d in (queueDir, runningDir, doneDir):
+            path = os.path.join(self.spool, d)
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+    def submit(self, task):
+        '''
+        Put a task in the queue, returns the job ID
+        '''
+        job = uuid.uuid4().hex
+
+        tmp = os.path.join(self.spool, queueDir, '.%s.tmp'%job)
+        f = open(tmp, 'wb')
+        cPickle.dump(task, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmp, getJobFile(self.spool, job))
+
+        self.launch(job)
+
+        return job
+
+    def launch(self, job):
+        '''
+        Called when a job is put in the queue (nothing to do here: the
+        workers poll the queue)
+        '''
+        pass
+
+    def requeueStale(self, jobs, retries):
+        '''
+        Put back in the queue the stale claims of the desired jobs
+        Raises RuntimeError if a job has been requeued too many times
+        '''
+        running = os.path.join(self.spool, runningDir)
+        for claim in os.listdir(running):
+            job = claim.split('.')[0]
+            if job not in jobs:
+                continue
+
+            claimed = os.path.join(running, claim)
+            try:
+                age = time.time() - os.path.getmtime(claimed)
+            except OSError:
+                continue
+            if age < self.stale:
+                continue
+
+            retries[job] = retries.get(job, 0) + 1
+            if retries[job] > maxRetries:
+                logger.error('Job %s failed %d times (%s)'%(job,
+                             retries[job], claim))
+                raise RuntimeError('Job %s has no live worker'%job)
+
+            logger.warning('Job %s has a stale claim (%s), requeuing'%(job,
+                           claim))
+            try:
+                os.rename(claimed, getJobFile(self.spool, job))
+            except OSError:
+                continue
+            self.launch(job)
+
+    def run(self, tasks):
+        '''
+        Generator to the results (in no particular order)
+        Raises RuntimeError if a job failed inside a worker
+        '''
+        jobs = set([self.submit(task) for task in tasks])
+        logger.debug('%d jobs submitted to %s'%(len(jobs), self.spool))
+
+        workers = [multiprocessing.Process(target=runWorker,
+                                           args=(self.spool, None, True,
+                                                 self.poll))
+                   for x in range(self.workers)]
+        for worker in workers:
+            worker.start()
+
+        start = time.time()
+        retries = {}
+        try:
+            while len(jobs) > 0:
+                done = [job for job in jobs
+                        if os.path.exists(getResultFile(self.spool, job))]
+                if len(done) == 0:
+                    if (self.timeout is not None and
+                        time.time() - start > self.timeout):
+                        logger.error('%d jobs not done after %ds'%(len(jobs),
+                                     self.timeout))
+                        raise RuntimeError('Spool jobs timeout')
+                    self.requeueStale(jobs, retries)
+                    time.sleep(self.poll)
+                    continue
+
+                for job in done:
+                    jobs.remove(job)
+
+                    resfile = getResultFile(self.spool, job)
+                    f = open(resfile, 'rb')
+                    success, result = cPickle.load(f)
+                    f.close()
+                    os.remove(resfile)
+
+                    if not success:
+                        logger.error('Job %s failed: %s'%(job, result))
+                        raise RuntimeError('Job %s failed'%job)
+
+                    yield result
+        finally:
+            for worker in workers:
+                worker.terminate()
+
+class CommandExecutor(SpoolExecutor):
+    '''
+    Class CommandExecutor
+    A SpoolExecutor that launches a command for each job, i.e. to submit
+    it to a batch scheduler; {command} in the template is replaced by the
+    worker command for that job
+    (e.g. 'sbatch --wrap "{command}"' or 'qsub -b y {command}')
+    '''
+    def __init__(self, spool, template, poll=5.0, stale=staleTimeout,
+                 timeout=None):
+        SpoolExecutor.__init__(self, spool, workers=0, poll=poll,
+                               stale=stale, timeout=timeout)
+        self.template = template
+
+    def launch(self, job):
+        '''
+        Submit the worker command of a queued job (also when requeued)
+        '''
+        cmd = self.template.replace('{command}',
+                                    workerCommand%(self.spool, job))
+        logger.debug('Submitting job %s (%s)'%(job, cmd))
+        if subprocess.call(cmd, shell=True) != 0:
+            logger.error('Submission failed for job %s (%s)'%(job, cmd))
+            raise RuntimeError('Submission failed for job %s'%job)
+
+################################################################################
+# Methods
+
+def getJobFile(spool, job):
+    return os.path.join(spool, queueDir, '%s.job'%job)
+
+def getResultFile(spool, job):
+    return os.path.join(spool, doneDir, '%s.res'%job)
+
+def claimJob(spool, job):
+    '''
+    Move the job in the running directory
+    Returns the claimed job file or None if another worker got it
+    '''
+    claimed = os.path.join(spool, runningDir, '%s.%s-%d'%(job,
+                           socket.gethostname(), os.getpid()))
+    try:
+        os.rename(getJobFile(spool, job), claimed)
+    except OSError:
+        return None
+    return claimed
+
+def _heartbeat(claimed, stop):
+    '''
+    Touch the claimed job until stop is set, to show that it is alive
+    '''
+    while not stop.wait(heartbeat):
+        try:
+            os.utime(claimed, None)
+        except OSError:
+            return
+
+def runJob(spool, job, claimed):
+    '''
+    Run a claimed job and write its pickled result
+    A failure is returned to the executor together with the traceback
+    '''
+    stop = threading.Event()
+    beat = threading.Thread(target=_heartbeat, args=(claimed, stop))
+    beat.daemon = True
+    beat.start()
+
+    try:
+        f = open(claimed, 'rb')
+        task = cPickle.load(f)
+        f.close()
+        result = (True, task())
+    except Exception:
+        logger.error('Job %s failed'%job)
+        result = (False, traceback.format_exc())
+    finally:
+        stop.set()
+
+    tmp = os.path.join(spool, doneDir, '.%s.tmp'%job)
+    f = open(tmp, 'wb')
+    cPickle.dump(result, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.rename(tmp, getResultFile(spool, job))
+
+    # The claim may have been requeued meanwhile
+    try:
+        os.remove(claimed)
+    except OSError:
+        pass
+
+    return result[0]
+
+def runWorker(spool, job=None, exitWhenEmpty=False, poll=1.0):
+    '''
+    Serve the jobs of a spool directory
+    If job is given only that job is run
+    Returns the number of jobs run
+    '''
+    spool = os.path.abspath(spool)
+
+    if job is not None:
+        claimed = claimJob(spool, job)
+        if claimed is None:
+            logger.warning('Job %s is not in the queue'%job)
+            return 0
+        runJob(spool, job, claimed)
+        return 1
+
+    count = 0
+    while True:
+        jobs = sorted([x[:-4] for x in os.listdir(os.path.join(spool, queueDir))
+                       if x.endswith('.job')])
+        for job in jobs:
+            claimed = claimJob(spool, job)
+            if claimed is None:
+                continue
+            runJob(spool, job, claimed)
+            count += 1
+
+        if len(jobs) == 0:
+            if exitWhenEmpty:
+                return count
+            time.sleep(poll)
+
+def getExecutor(ncpus=1, spool=None, submit=None):
+    '''
+    Returns the executor for the desired setup
+    (local processes if no spool directory is given)
+    '''
+    if spool is None:
+        if submit is not None:
+            raise ValueError('A spool directory is needed to submit jobs')
+        return LocalExecutor(ncpus)
+    if submit is not None:
+        return CommandExecutor(spool, submit)
+    return SpoolExecutor(spool)
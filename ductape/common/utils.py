@@ -25,6 +25,23 @@ def slice_it(li, cols=10):
         yield li[start:stop]
         start = stop
         
+def slice_residues(li, size):
+    '''
+    Slices a list of sequences in chunks of at least size residues
+    (the last one may be smaller)
+    '''
+    chunk = []
+    residues = 0
+    for seq in li:
+        chunk.append(seq)
+        residues += len(seq)
+        if residues >= size:
+            yield chunk
+            chunk = []
+            residues = 0
+    if len(chunk) > 0:
+        yield chunk
+        
 def get_span(li, span=4):
     i = 0
     while i < len(li):
@@ -7,9 +7,12 @@ Genome library
 Classes to handle Blast analysis against a local database
 """
 import logging
+import hashlib
 import os
+import shutil
 import subprocess
 import sys
+import time
 try:
     from StringIO import StringIO # Python 2
 except ImportError:
@@ -85,6 +88,15 @@ class BlastHit:
             return None
         
 class Blaster(object):
+    '''
+    Class Blaster
+    NCBI BLAST+ search backend, also the interface of the other backends:
+    createDB, retrieveFromDB, runBlast (BLAST XML output), parseBlast
+    and getHits (generator of BlastHit lists, one for each query)
+    '''
+    name = 'blast'
+    executables = ['makeblastdb', 'blastp', 'blastdbcmd']
+    
     def __init__(self, useDisk=False):
         self._hits = None
         self._out = ''
@@ -95,6 +107,17 @@ class Blaster(object):
         self.query = ''
         self.out = ''
         
+    @classmethod
+    def isAvailable(cls):
+        '''Are the backend executables installed?'''
+        from distutils.spawn import find_executable
+        
+        return all([find_executable(x) is not None for x in cls.executables])
+    
+    def getVersion(self):
+        '''Backend version (used to tag the cached DBs)'''
+        return _getVersion('blastp -version')
+    
     def createDB(self,seqFile,dbType,outFile='BlastDB',parseIDs=True,
                         title='Generic Blast DB'):
         '''Generation of a Blast DB'''
@@ -211,11 +234,158 @@ class Blaster(object):
                     hits.append(h)
             yield hits
             
+class Diamond(Blaster):
+    '''
+    Class Diamond
+    DIAMOND search backend (protein DBs only)
+    The BLAST XML output is used, so that the hits are parsed as usual;
+    the sequences are retrieved from the fasta file used for the DB
+    The BLAST specific options are translated when possible
+    '''
+    name = 'diamond'
+    executables = ['diamond']
+    
+    # BLAST option --> DIAMOND option (None: no equivalent)
+    _options = {'-max_target_seqs':'--max-target-seqs',
+                '-matrix':'--matrix',
+                '-soft_masking':None,
+                '-dbsize':None,
+                '-use_sw_tback':None}
+    
+    # DB source file --> sequences index
+    _indexes = {}
+    
+    def getVersion(self):
+        '''Backend version (used to tag the cached DBs)'''
+        return _getVersion('diamond version')
+    
+    def _run(self, cmd, stdin=None):
+        logger.debug('DIAMOND cmd: %s'%cmd)
+        proc = subprocess.Popen(cmd,shell=(sys.platform!="win32"),
+                    stdin=subprocess.PIPE,stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
+        out = proc.communicate(stdin)
+        return_code = proc.returncode
+        if return_code != 0:
+            logger.warning('DIAMOND failed with error %d'%return_code)
+            logger.warning('%s'%str(out[1]))
+        
+        return out[0], bool(not return_code)
+    
+    def _translate(self, additional):
+        '''Translates the BLAST command line options'''
+        options = []
+        args = additional.split()
+        i = 0
+        while i < len(args):
+            option = args[i]
+            value = None
+            if i + 1 < len(args) and not args[i+1].startswith('-'):
+                value = args[i+1]
+                i += 1
+            i += 1
+            
+            if option not in self._options:
+                logger.debug('Unknown BLAST option for DIAMOND (%s)'%option)
+                continue
+            if self._options[option] is None:
+                continue
+            options.append(self._options[option])
+            if value is not None:
+                options.append(value)
+        
+        return ' '.join(options)
+    
+    def createDB(self,seqFile,dbType,outFile='BlastDB',parseIDs=True,
+                        title='Generic Blast DB'):
+        '''Generation of a DIAMOND DB'''
+        if dbType != 'prot':
+            logger.warning('DIAMOND only supports protein DBs')
+            return False
+        
+        cmd = 'diamond makedb --in %s -d %s'%(seqFile, outFile)
+        res = self._run(cmd)[1]
+        
+        # The sequences are retrieved from a copy of the original file
+        if res:
+            shutil.copyfile(seqFile, outFile + '.faa')
+        
+        return res
+    
+    def retrieveFromDB(self, db, accession, out='out.fsa', isFile=False):
+        '''Retrieve the desired sequence(s) from a DIAMOND DB'''
+        from Bio import SeqIO
+        
+        try:
+            source = os.path.abspath(db + '.faa')
+            if source not in self._indexes:
+                self._indexes[source] = SeqIO.index(source, 'fasta')
+            index = self._indexes[source]
+        except (IOError, ValueError) as e:
+            logger.warning('Could not open the DIAMOND DB source (%s)'%e)
+            return False
+        
+        if not isFile:
+            accessions = [accession]
+        else:
+            accessions = [l.strip() for l in open(accession) if l.strip()]
+        
+        missing = [x for x in accessions if x not in index]
+        if len(missing) > 0:
+            logger.warning('Entry %s not found in %s'%(missing[0], db))
+            return False
+        
+        data = StringIO()
+        SeqIO.write([index[x] for x in accessions], data, 'fasta')
+        
+        if self._useDisk:
+            fout = open(out, 'w')
+            fout.write(data.getvalue())
+            fout.close()
+        else:
+            self.retrieved = data.getvalue()
+        
+        return True
+    
+    def runBlast(self, queryFile, db, outFile='', evalue = 10,
+                    task = '', ncpus = 1, additional = '', outfmt='5'):
+        '''Run DIAMOND blastp with the desired parameters'''
+        import tempfile
+        
+        self._out = outFile
+        
+        # DIAMOND needs a query file
+        tmp = None
+        if not self._useDisk:
+            tmp = tempfile.NamedTemporaryFile(suffix='.faa', delete=False)
+            tmp.write(self.query)
+            tmp.close()
+            queryFile = tmp.name
+        
+        cmd = ('diamond blastp -d %s -q %s -e %s --outfmt %s -p %d --quiet'%
+               (db, queryFile, float(evalue), outfmt, int(ncpus)))
+        # No short queries mode
+        if task == 'blastp-short':
+            cmd += ' --more-sensitive'
+        if additional != '':
+            cmd += ' ' + self._translate(additional)
+        if self._useDisk and outFile != '':
+            cmd += ' -o %s'%outFile
+        
+        out, res = self._run(cmd)
+        
+        if tmp is not None:
+            os.remove(tmp.name)
+            self.out = out
+        
+        return res
+
 class RunBBH(object):
     def __init__(self, query, queryid,
                  source, target, targetorg,
                  evalue, matrix, short = False, uniqueid = 1,
-                 kegg = False, ko_entry = None, ko_id = None, useDisk=True):
+                 kegg = False, ko_entry = None, ko_id = None, useDisk=True,
+                 backend='blast'):
         self.query = query
         self.queryid = queryid
         self.source = source
@@ -231,7 +401,7 @@ class RunBBH(object):
         self.useDisk = bool(useDisk)
         
         self.out = self.query + '_' + str(self.uniqueid) +'.xml'
-        self.blaster = Blaster(useDisk=self.useDisk)
+        self.blaster = getBackend(backend, useDisk=self.useDisk)
         self.additional = (' -soft_masking true -dbsize 500000000 '+
                     '-use_sw_tback -max_target_seqs 1 -matrix %s'%self.matrix)
         
@@ -352,3 +522,113 @@ class RunBBH(object):
         if self.useDisk:
             os.remove(self.out)
         return [None, self.targetorg, True]
+
+class RunBlast(object):
+    '''
+    Blast run of a query file against a DB, to be used with runParallel
+    Returns (output file, success, elapsed seconds)
+    '''
+    def __init__(self, query, db, out, evalue, short=False, ncpus=1,
+                 additional='', backend='blast'):
+        self.query = query
+        self.db = db
+        self.out = out
+        self.evalue = evalue
+        self.short = short
+        self.ncpus = ncpus
+        self.additional = additional
+        self.backend = backend
+        
+    def __call__(self):
+        start = time.time()
+        
+        blaster = getBackend(self.backend, useDisk=True)
+        if self.short:
+            res = blaster.runBlast(self.query, self.db, self.out,
+                                   evalue = self.evalue,
+                                   ncpus = self.ncpus, task='blastp-short',
+                                   additional = self.additional)
+        else:
+            res = blaster.runBlast(self.query, self.db, self.out,
+                                   evalue = self.evalue,
+                                   ncpus = self.ncpus,
+                                   additional = self.additional)
+        
+        return (self.out, res, time.time() - start)
+
+################################################################################
+# Methods
+
+# Search backends name --> class
+searchBackends = {Blaster.name:Blaster,
+                  Diamond.name:Diamond}
+
+# Backend version command --> version
+_versions = {}
+
+# (sequences file, size, modification time) --> content digest
+_digests = {}
+
+def _getVersion(cmd):
+    '''
+    Returns the first line of the output of the version command
+    '''
+    if cmd not in _versions:
+        proc = subprocess.Popen(cmd,shell=(sys.platform!="win32"),
+                    stdin=subprocess.PIPE,stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
+        out = proc.communicate()
+        _versions[cmd] = out[0].strip().split('\n')[0]
+    
+    return _versions[cmd]
+
+def _getDigest(seqFile):
+    '''
+    Content digest of a file, computed once for each file version
+    '''
+    st = os.stat(seqFile)
+    key = (os.path.abspath(seqFile), st.st_size, st.st_mtime)
+    if key not in _digests:
+        h = hashlib.sha1()
+        f = open(seqFile, 'rb')
+        for chunk in iter(lambda: f.read(1048576), ''):
+            h.update(chunk)
+        f.close()
+        _digests[key] = h.hexdigest()
+    
+    return _digests[key]
+
+def getCachedDB(blaster, seqFile, dbType, cache, parseIDs=True):
+    '''
+    Returns the path of the DB built from seqFile by the blaster backend
+    The DBs are kept in the cache directory, keyed by the sequences
+    content and the backend version, and reused when possible
+    The cache is never pruned (see dgenome clear --cache)
+    Returns None if the DB could not be created
+    '''
+    h = hashlib.sha1()
+    h.update('\t'.join([blaster.name, blaster.getVersion(), dbType,
+                        str(bool(parseIDs)), _getDigest(seqFile)]))
+    
+    if not os.path.exists(cache):
+        os.makedirs(cache)
+    db = os.path.join(cache, h.hexdigest())
+    
+    if os.path.exists(db + '.done'):
+        logger.debug('Using cached DB %s for %s'%(db, seqFile))
+        return db
+    
+    if not blaster.createDB(seqFile, dbType, db, parseIDs):
+        return None
+    open(db + '.done', 'w').close()
+    
+    return db
+
+def getBackend(name='blast', useDisk=False):
+    '''
+    Returns a search backend instance
+    An exception is raised if the backend is unknown
+    '''
+    if name not in searchBackends:
+        raise ValueError('Unknown search backend %s'%name)
+    return searchBackends[name](useDisk=useDisk)
@@ -8,9 +8,11 @@ Handle a KO search on a local machine (Blast-BBH) or online (KAAS)
 """
 from Bio import SeqIO
 from ductape.common.commonmultiprocess import CommonMultiProcess
-from ductape.common.utils import slice_it
-from ductape.genome.blast import Blaster, RunBBH
+from ductape.common.utils import slice_residues
+from ductape.genome.blast import RunBlast, getBackend, getCachedDB
+from StringIO import StringIO
 import Queue
+import hashlib
 import logging
 import os
 import webbrowser
@@ -22,6 +24,14 @@ __author__ = "Marco Galardini"
 
 logger = logging.getLogger('ductape.map2KO')
 
+################################################################################
+# Constants
+
+# Local search: on average each CPU gets this many query chunks
+chunksPerCPU = 4
+# Minimum number of residues in each query chunk
+minChunkResidues = 20000
+
 ################################################################################
 # Classes
 
@@ -45,8 +55,10 @@ class LocalSearch(CommonMultiProcess):
     
     def __init__(self,query,target,
                  ncpus=1,evalue=1e-50,
-                 buildDB=True,bbh=True,recover=False,queue=Queue.Queue()):
+                 buildDB=True,bbh=True,recover=False,backend='blast',
+                 dbcache=None,dedup=True,executor=None,queue=Queue.Queue()):
         CommonMultiProcess.__init__(self,ncpus,queue)
+        self.executor = executor
         # Blast
         self.query = query
         if buildDB:
@@ -63,7 +75,16 @@ class LocalSearch(CommonMultiProcess):
         self._kohits = []
         self.results = {}
         self._keggroom = None
-        self._blast = Blaster()
+        # Persistent Blast DBs directory
+        self.dbcache = dbcache
+        self.backend = backend
+        self._blast = getBackend(backend, useDisk=True)
+        self.timings = []
+        # Identical proteins: representative --> other copies
+        # (if dedup is set they are searched only once)
+        self.dedup = bool(dedup)
+        self._copies = {}
+        self._representatives = None
         
     def makeRoom(self,location=''):
         '''
@@ -95,64 +116,171 @@ class LocalSearch(CommonMultiProcess):
                           %path)
         
     def createDB(self):
+        if self.dbcache:
+            self.db = getCachedDB(self._blast, self.target, 'prot',
+                                  self.dbcache)
+            return self.db is not None
+        
         self.db = os.path.join(self._keggroom,'KEGGdb') 
         return self._blast.createDB(self.target, 'prot', self.db)
     
-    def runBlast(self,short=False):
-        lS = []
-        for s in SeqIO.parse(open(self.query),'fasta'):
-            if short and len(s) <= 30:
-                lS.append(s)
-            elif not short:lS.append(s)
-        self._maxsubstatus = len(lS)
-        for seqs in slice_it(lS,10):
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
+    def _getChunks(self, seqs, prefix, short=False):
+        '''
+        Splits the query sequences in chunks of similar residues count
+        Returns a list of (query file, output file, sequences, short)
+        '''
+        residues = sum([len(s) for s in seqs])
+        size = max(minChunkResidues,
+                   residues / (self.ncpus * chunksPerCPU) + 1)
+        
+        chunks = []
+        for i, chunk in enumerate(slice_residues(seqs, size)):
+            query = os.path.join(self._room, '%s_%d.faa'%(prefix, i))
+            out = os.path.join(self._room, '%s_%d.xml'%(prefix, i))
+            chunks.append( (query, out, chunk, short) )
+        
+        return chunks
+    
+    def _isDone(self, query, out, data):
+        '''
+        Recovery: has this chunk already been searched?
+        '''
+        if not os.path.exists(query) or not os.path.exists(out):
+            return False
+        with open(query) as f:
+            if f.read() != data:
                 return False
+        
+        # Last test: can it be parsed?
+        try:
+            self._blast.parseBlast(out)
+            for hits in self._blast.getHits(self.evalue):
+                pass
+            return True
+        except:
+            return False
+    
+    def _runChunks(self, chunks, db, additional=''):
+        '''
+        Runs the Blast chunks (see _getChunks) concurrently against db
+        The substatus is updated with the number of searched sequences
+        Returns True/False
+        '''
+        # Bigger chunks first, for a better load balance
+        chunks = sorted(chunks, key=lambda x: sum([len(s) for s in x[2]]),
+                        reverse=True)
+        
+        # Few chunks: use the spare CPUs inside Blast
+        threads = max(1, self.ncpus / max(1, len(chunks)))
+        
+        tasks = []
+        nseqs = {}
+        for query, out, seqs, short in chunks:
+            data = StringIO()
+            oseqs = SeqIO.write(seqs, data, 'fasta')
+            if oseqs != len(seqs):
+                logger.warning('Query splitting error! Expected %d, '%len(seqs)+
+                                'Printed %d'%oseqs)
+            data = data.getvalue()
             
-            if len(seqs) == 0:
-                continue
-            self._substatus += len(seqs)
-            self.updateStatus(sub=True)
-            if short:
-                query = os.path.join(self._room,
-                         'KEGGshort_%d.faa'%self._substatus)
-                out = os.path.join(self._room,
-                           'KEGGshort_%d.xml'%self._substatus)
-            else:
-                query = os.path.join(self._room,
-                         'KEGG_%d.faa'%self._substatus)
-                out = os.path.join(self._room,'KEGG_%d.xml'%self._substatus)
-            self.out.append(out)
             # If recovery, skip the unnecessary scans
-            if ( self.recover and os.path.exists(query) and
-                 os.path.exists(out)):
-                # Last test: can it be parsed?
-                try:
-                    self._blast.parseBlast(out)
-                    for hits in self._blast.getHits(self.evalue):
-                        pass
-                    logger.debug('Skipping slice %s because has already been done'
-                                %query)
-                    continue
-                except:
-                    pass
-            oseqs = SeqIO.write(seqs,open(query,'w'),'fasta')
-            if oseqs != len(seqs):
-                logger.warning('Query splitting error! Expected %d, '+
-                                'Printed %d'%(len(seqs),oseqs))
-            if short:
-                res = self._blast.runBlast(query, self.db, out,
-                                 evalue = self.evalue,
-                                 ncpus = self.ncpus, task='blastp-short')
-            else:
-                res = self._blast.runBlast(query, self.db, out,
-                                 evalue = self.evalue,
-                                 ncpus = self.ncpus)
-            if not res:
-                return False
+            if self.recover and self._isDone(query, out, data):
+                logger.debug('Skipping slice %s because has already been done'
+                             %query)
+                self._substatus += len(seqs)
+                continue
+            
+            fout = open(query, 'w')
+            fout.write(data)
+            fout.close()
+            
+            tasks.append( RunBlast(query, db, out, self.evalue, short,
+                                   threads, additional, self.backend) )
+            nseqs[out] = (len(seqs), sum([len(s) for s in seqs]))
+        
+        self.updateStatus(sub=True)
+        
+        try:
+            for out, res, elapsed in self.runTasks(tasks):
+                if self.killed:
+                    logger.debug('Exiting for a kill signal')
+                    return False
+                
+                if not res:
+                    return False
+                
+                logger.debug('Blast chunk %s: %d proteins, %d residues, %.1fs'%
+                             (out, nseqs[out][0], nseqs[out][1], elapsed))
+                self.timings.append( (out, nseqs[out][0], nseqs[out][1], elapsed) )
+                
+                self._substatus += nseqs[out][0]
+                self.updateStatus(sub=True)
+        except RuntimeError:
+            logger.error('Blast job failure')
+            return False
+        
         return True
     
+    def _dedup(self, seqs):
+        '''
+        Collapses the identical proteins of the query proteome
+        Only the first copy is searched, the results are then expanded
+        to the other ones; returns the representative sequences
+        '''
+        reps = []
+        seen = {}
+        for s in seqs:
+            digest = hashlib.sha1(str(s.seq).upper()).digest()
+            if digest in seen:
+                self._copies[seen[digest]].append(s.id)
+                continue
+            seen[digest] = s.id
+            self._copies[s.id] = []
+            reps.append(s)
+        
+        logger.info('%s: %d unique proteins out of %d (%.1f%%)'%(
+                    os.path.basename(self.query), len(reps), len(seqs),
+                    len(reps) * 100.0 / max(1, len(seqs))))
+        
+        if len(reps) < len(seqs):
+            self._representatives = os.path.join(self._room,
+                                                 'REPRESENTATIVES.faa')
+            SeqIO.write(reps, open(self._representatives, 'w'), 'fasta')
+        
+        return reps
+    
+    def expandResults(self):
+        '''
+        Transfer the results of each representative to its identical copies
+        '''
+        for rep, copies in self._copies.iteritems():
+            if rep not in self.results:
+                continue
+            for copy in copies:
+                self.results[copy] = self.results[rep]
+    
+    def runBlast(self):
+        '''
+        Blast search of the query proteome against the KEGG DB
+        The proteome is split in chunks of similar residues count, which
+        are searched concurrently; the short proteins (<= 30 residues)
+        are searched again with blastp-short in the same run
+        Identical proteins are searched only once (if dedup is set)
+        '''
+        lS = [s for s in SeqIO.parse(open(self.query),'fasta')]
+        if self.dedup:
+            lS = self._dedup(lS)
+        
+        chunks = self._getChunks(lS, 'KEGG')
+        chunks += self._getChunks([s for s in lS if len(s) <= 30],
+                                  'KEGGshort', True)
+        
+        self._maxsubstatus = sum([len(x[2]) for x in chunks])
+        # The results are parsed in the query order
+        self.out += [x[1] for x in chunks]
+        
+        return self._runChunks(chunks, self.db)
+    
     def parseBlast(self):
         for out in self.out:
             if self.killed:
@@ -172,82 +300,110 @@ class LocalSearch(CommonMultiProcess):
         return True
     
     def runBBH(self):
+        '''
+        Reverse search of the KO hits against the query proteome
+        All the distinct KO entries are retrieved at once and searched
+        in chunks; the best bidirectional hits are resolved in memory
+        '''
         # Create a DB of the source genome
-        sourceDB = os.path.join(self._room,'SOURCEdb') 
-        if not self._blast.createDB(self.query, 'prot', sourceDB):
-            logger.error('Could not create source DB %s'%sourceDB)
+        # (only the representatives of the identical proteins)
+        source = self._representatives or self.query
+        if self.dbcache:
+            sourceDB = getCachedDB(self._blast, source, 'prot',
+                                   self.dbcache)
+            if not sourceDB:
+                logger.error('Could not create source DB for %s'%self.query)
+                return False
+        else:
+            sourceDB = os.path.join(self._room,'SOURCEdb') 
+            if not self._blast.createDB(source, 'prot', sourceDB):
+                logger.error('Could not create source DB %s'%sourceDB)
+                return False
+        
+        # Distinct KO entries, by search kind
+        # (short query proteins are searched back with blastp-short)
+        entries = sorted(set([(hit.hit, hit.query_len <= 30)
+                              for hit in self._kohits]))
+        
+        ids = sorted(set([x[0] for x in entries]))
+        
+        batch = os.path.join(self._room, 'REVERSE.txt')
+        fout = open(batch, 'w')
+        for entry in ids:
+            fout.write('%s\n'%entry)
+        fout.close()
+        
+        retrieved = os.path.join(self._room, 'REVERSE.faa')
+        if not self._blast.retrieveFromDB(self.db, batch, out=retrieved,
+                                          isFile=True):
+            logger.error('Could not retrieve the KO entries')
             return False
-        self._maxsubstatus = len(self._kohits)
         
-        self.initiateParallel()
+        # Retrieved entries, by ID (local IDs may get the lcl| prefix)
+        seqs = {}
+        lids = set(ids)
+        for s in SeqIO.parse(open(retrieved), 'fasta'):
+            if s.id.startswith('lcl|') and s.id not in lids:
+                seqs[s.id[4:]] = s
+            else:
+                seqs[s.id] = s
+        missing = [x for x in ids if x not in seqs]
+        if len(missing) > 0:
+            logger.error('Could not retrieve %d KO entries (%s...)'%(
+                         len(missing), missing[0]))
+            return False
         
-        for hit in self._kohits:
-            uniqueid = self.getUniqueID()
-            
-            if hit.query_len > 30:
-                short = False
+        # The reverse queries are renamed, to be safely tracked back
+        queries = {}
+        lS, lShort = [], []
+        for i, (entry, short) in enumerate(entries):
+            seq = seqs[entry][:]
+            seq.id = 'q%d'%i
+            # Without a description Blast reports "No definition line"
+            seq.description = entry
+            queries[seq.id] = (entry, short)
+            if short:
+                lShort.append(seq)
             else:
-                short = True
-            
-            # Multi process
-            obj = RunBBH('Map2KO',hit.query_id,sourceDB,
-                    self.db,None,
-                    self.evalue,'BLOSUM62',short,uniqueid,
-                    kegg = True, ko_entry = hit.hit, ko_id = hit.getKO())
-            self._paralleltasks.put(obj)
-            
-        # Poison pill to stop the workers
-        self.addPoison()
+                lS.append(seq)
         
-        while True:
-            while not self._parallelresults.empty():
-                if self.killed:
-                    logger.debug('Exiting for a kill signal')
-                    return False
-                
-                self._substatus += 1
-                self.updateStatus(sub=True)
-                
-                result = self._parallelresults.get()
-                
-                if not result[2]:
-                    logger.error('An error occurred for BBH!')
-                    return False
-                if result[1] not in self.results and result[0]:
-                    self.results[result[1]] = []
-                if result[0] and result[0] not in self.results[result[1]]:
-                    self.results[result[1]].append(result[0])
-                    
-            if self.isTerminated():
-                break
-            
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
-                return False
-            
-            self.sleeper.sleep(0.1)
-            
-        # Get the last messages
-        while not self._parallelresults.empty():
+        chunks = self._getChunks(lS, 'REVERSE')
+        chunks += self._getChunks(lShort, 'REVERSEshort', True)
+        
+        self._maxsubstatus = len(entries)
+        
+        additional = (' -soft_masking true -dbsize 500000000 '+
+                    '-use_sw_tback -max_target_seqs 1 -matrix BLOSUM62')
+        if not self._runChunks(chunks, sourceDB, additional):
+            return False
+        
+        # (KO entry, short) --> best source protein
+        best = {}
+        for out in [x[1] for x in chunks]:
             if self.killed:
                 logger.debug('Exiting for a kill signal')
                 return False
             
-            self._substatus += 1
-            self.updateStatus(sub=True)
-            
-            result = self._parallelresults.get()
-            
-            if not result[2]:
-                logger.error('An error occurred for BBH!')
+            self._blast.parseBlast(out)
+            try:
+                for hits in self._blast.getHits(self.evalue):
+                    if len(hits) == 0:
+                        continue
+                    best[queries[hits[0].query_id]] = hits[0].hit
+            except:
+                logger.error('Blast results corrupted for file %s'%out)
                 return False
-            if result[1] not in self.results and result[0]:
-                self.results[result[1]] = []
-            if result[0] and result[0] not in self.results[result[1]]:
-                self.results[result[1]].append(result[0])
+        
+        for hit in self._kohits:
+            if best.get((hit.hit, hit.query_len <= 30)) != hit.query_id:
+                continue
             
-        self.killParallel()            
-
+            ko_id = hit.getKO()
+            if hit.query_id not in self.results:
+                self.results[hit.query_id] = []
+            if ko_id not in self.results[hit.query_id]:
+                self.results[hit.query_id].append(ko_id)
+        
         return True
             
     def run(self):
@@ -274,14 +430,8 @@ class LocalSearch(CommonMultiProcess):
             return
         self.resetSubStatus()
         
-        if self.killed:
-            return
-        
-        self.updateStatus()
-        if not self.runBlast(True):
-            self.sendFailure('RunBlast (short) failure')
-            return
-        self.resetSubStatus()
+        # The short proteins have been searched together with the others
+        self.updateStatus(send=False)
         
         if self.killed:
             return
@@ -320,6 +470,8 @@ class LocalSearch(CommonMultiProcess):
             del self.results[None]
         except:pass
         
+        self.expandResults()
+        
         # Only ONE KO for each protein
         for k in self.results:
             self.results[k] = self.results[k][0]
@@ -8,8 +8,10 @@ Uses a serial-BBH approach to compute a pangenome of the desired organisms list
 """
 from Bio import SeqIO
 from ductape.common.commonmultiprocess import CommonMultiProcess
-from ductape.genome.blast import Blaster, RunBBH
+from ductape.genome.blast import RunBBH, RunBlast, getBackend, getCachedDB
+from ductape.genome.prefilter import KmerIndex, defaultSeed, defaultMinSeeds
 import Queue
+import hashlib
 import logging
 import os
 import shutil
@@ -40,20 +42,42 @@ class PanGenomer(CommonMultiProcess):
     def __init__(self,organisms,
                  ncpus=1,evalue=1e-10,
                  recover=False,prefix='',
-                 matrix='BLOSUM80',queue=Queue.Queue()):
+                 matrix='BLOSUM80',backend='blast',dbcache=None,
+                 prefilter=False,seed=defaultSeed,minseeds=defaultMinSeeds,
+                 rbh=False,dedup=True,executor=None,queue=Queue.Queue()):
         CommonMultiProcess.__init__(self,ncpus,queue)
+        self.executor = executor
         # Blast
         self.organisms = list(organisms)
         self.dbs = {}
         self._prot2orgs = {}
+        self._proteins = []
+        # Sequence digest --> identical proteins
+        # (if dedup is set they are assigned without any search)
+        self.dedup = bool(dedup)
+        self._identical = {}
+        self._prot2hash = {}
+        self._deduped = 0
+        # K-mer prefilter: the organisms without seed hits are not searched
+        if prefilter:
+            self._index = KmerIndex(seed, minseeds)
+        else:
+            self._index = None
+        self._searches = 0
+        self._skipped = 0
+        # Groups from the reciprocal best hits of all the organisms pairs
+        self.rbh = bool(rbh)
         self.out = []
         self.evalue = float(evalue)
         # TODO: implement recovery
         self.recover = recover
         #
         self.results = {}
-        self._blast = Blaster()
+        self.backend = backend
+        self._blast = getBackend(backend)
         self._pangenomeroom = None
+        # Persistent Blast DBs directory
+        self.dbcache = dbcache
         self.prefix = prefix.rstrip('_')
         self.matrix = matrix
         self._already = set()
@@ -107,20 +131,61 @@ class PanGenomer(CommonMultiProcess):
             self._substatus += 1
             self.updateStatus(sub=True)
             
-            seqs = [seq.id for seq in SeqIO.parse(open(org),'fasta')]
-            for seqid in seqs:
+            seqs = [seq for seq in SeqIO.parse(open(org),'fasta')]
+            for seq in seqs:
+                seqid = seq.id
                 if seqid in self._prot2orgs:
                     logger.warning('Protein %s present as duplicate!'%seqid)
                     return False
-                self._prot2orgs[seqid] = org            
-            self.dbs[org] = os.path.join(self._room,str(dbindex)) 
-            res = self._blast.createDB(org, 'prot', self.dbs[org])
+                self._prot2orgs[seqid] = org
+                self._proteins.append(seqid)
+                digest = hashlib.sha1(str(seq.seq).upper()).digest()
+                self._prot2hash[seqid] = digest
+                self._identical.setdefault(digest, []).append(seqid)
+            if self._index is not None:
+                self._index.addOrganism(org, seqs)
+            if self.dbcache:
+                self.dbs[org] = getCachedDB(self._blast, org, 'prot',
+                                            self.dbcache)
+                res = self.dbs[org] is not None
+            else:
+                self.dbs[org] = os.path.join(self._room,str(dbindex)) 
+                res = self._blast.createDB(org, 'prot', self.dbs[org])
             if not res:
                 logger.error('Could not create DB for %s'%org)
                 return False
             dbindex += 1
         return True
     
+    def getIdenticals(self, seqid):
+        '''
+        Returns the identical copies of a protein in the other organisms
+        Only the copies that are unique inside their proteome are returned,
+        so that the orthology is not ambiguous
+        '''
+        if not self.dedup:
+            return []
+        
+        byorg = {}
+        for prot in self._identical[self._prot2hash[seqid]]:
+            byorg.setdefault(self._prot2orgs[prot], []).append(prot)
+        
+        if len(byorg[self._prot2orgs[seqid]]) > 1:
+            return []
+        
+        return [prots[0] for org, prots in byorg.iteritems()
+                if org != self._prot2orgs[seqid] and len(prots) == 1]
+    
+    def isCandidate(self, seq, org):
+        '''
+        Returns False if the prefilter excludes any homolog of seq in org
+        '''
+        self._searches += 1
+        if self._index is None or self._index.hasCandidates(seq, org):
+            return True
+        self._skipped += 1
+        return False
+    
     def serialBBH(self):
         orthindex = 1
         
@@ -148,11 +213,22 @@ class PanGenomer(CommonMultiProcess):
                 self.orthologs[orthname] = [seq.id]
                 query = '>%s\n%s\n'%(seq.id, str(seq.seq))
                 
+                # Identical copies are orthologs without any search
+                for prot in self.getIdenticals(seq.id):
+                    if prot in self._already:
+                        continue
+                    self.orthologs[orthname].append(prot)
+                    orgsincluded.append(self._prot2orgs[prot])
+                    self._already.add(prot)
+                    self._deduped += 1
+                
                 self.initiateParallel()
                 
                 # Iterate over each other organism
                 for otherorg in self.organisms:
-                    if org == otherorg:
+                    if otherorg in orgsincluded:
+                        continue
+                    if not self.isCandidate(str(seq.seq), otherorg):
                         continue
                     # Go fot it!
                     if len(seq) < 30:
@@ -166,7 +242,8 @@ class PanGenomer(CommonMultiProcess):
                     obj = RunBBH(query,seq.id,self.dbs[org],
                             self.dbs[otherorg],otherorg,
                             self.evalue,self.matrix,short=short,
-                            uniqueid=uniqueid,useDisk=False)
+                            uniqueid=uniqueid,useDisk=False,
+                            backend=self.backend)
                     self._paralleltasks.put(obj)
                     
                 # Poison pill to stop the workers
@@ -182,7 +259,7 @@ class PanGenomer(CommonMultiProcess):
                             logger.debug('Exiting for a kill signal')
                             return
                         
-                        result = self._parallelresults.get()
+                        result = self.getParallelResult()
                         
                         if not result[2]:
                             logger.error('An error occurred for BBH on query %s'%seq.id+
@@ -203,7 +280,7 @@ class PanGenomer(CommonMultiProcess):
                         logger.debug('Exiting for a kill signal')
                         return
                     
-                    result = self._parallelresults.get()
+                    result = self.getParallelResult()
                     
                     if not result[2]:
                         logger.error('An error occurred for BBH on query %s'%seq.id+
@@ -222,20 +299,25 @@ class PanGenomer(CommonMultiProcess):
                     for otherprotein in self.orthologs[orthname]:
                         if otherprotein == seq.id:
                             continue
+                        # Identical copies are searched too: the reverse
+                        # search runs against their own organism
                         neworg = self._prot2orgs[otherprotein]
                         if neworg == org:
                             continue
                             
-                        searcher = Blaster(useDisk=False)
+                        searcher = getBackend(self.backend, useDisk=False)
                         searcher.retrieveFromDB(self.dbs[neworg],
                                                 otherprotein)
                         query = searcher.retrieved
+                        otherseq = ''.join(query.split('\n')[1:])
                         
                         self.initiateParallel()
                         
                         for evenneworg in self.organisms:
                             if evenneworg in orgsincluded:
                                 continue
+                            if not self.isCandidate(otherseq, evenneworg):
+                                continue
                             # Go fot it!
                             if len(seq) < 30:
                                 short = True
@@ -248,7 +330,8 @@ class PanGenomer(CommonMultiProcess):
                             obj = RunBBH(query,otherprotein,self.dbs[neworg],
                                     self.dbs[evenneworg],evenneworg,
                                     self.evalue,self.matrix,short=short,
-                                    uniqueid=uniqueid,useDisk=False)
+                                    uniqueid=uniqueid,useDisk=False,
+                                    backend=self.backend)
                             self._paralleltasks.put(obj)
                             
                         # Poison pill to stop the workers
@@ -264,7 +347,7 @@ class PanGenomer(CommonMultiProcess):
                                     logger.debug('Exiting for a kill signal')
                                     return
                                 
-                                result = self._parallelresults.get()
+                                result = self.getParallelResult()
                                 
                                 if not result[2]:
                                     logger.error('An error occurred for BBH on query %s'%seq.id+
@@ -285,7 +368,7 @@ class PanGenomer(CommonMultiProcess):
                                 logger.debug('Exiting for a kill signal')
                                 return
                             
-                            result = self._parallelresults.get()
+                            result = self.getParallelResult()
                             
                             if not result[2]:
                                 logger.error('An error occurred for BBH on query %s'%seq.id+
@@ -299,11 +382,96 @@ class PanGenomer(CommonMultiProcess):
                         self.killParallel()
                 
                 orthindex += 1
+        
+        if self.dedup and len(self._prot2orgs) > 0:
+            logger.info('%d/%d proteins (%.1f%%) assigned by sequence identity'%(
+                        self._deduped, len(self._prot2orgs),
+                        self._deduped * 100.0 / len(self._prot2orgs)))
+        if self._index is not None and self._searches > 0:
+            logger.info('%d/%d BBH searches (%.1f%%) skipped by the prefilter'%(
+                        self._skipped, self._searches,
+                        self._skipped * 100.0 / self._searches))
+        return True
+    
+    def pairwiseBBH(self):
+        '''
+        Each proteome is searched against all the other organisms at once,
+        all the pairs concurrently; the orthologous groups are the connected
+        components of the reciprocal best hits graph, thus not depending
+        on the organisms order
+        '''
+        additional = (' -soft_masking true -dbsize 500000000 '+
+                      '-use_sw_tback -max_target_seqs 1 -matrix %s'%self.matrix)
+        
+        queries = {}
+        for org in self.organisms:
+            seqs = [seq for seq in SeqIO.parse(open(org),'fasta')]
+            queries[org] = []
+            for short in (False, True):
+                lseqs = [seq for seq in seqs if (len(seq) < 30) == short]
+                if len(lseqs) == 0:
+                    continue
+                query = os.path.join(self._pangenomeroom, '%d%s.faa'%(
+                                     self.organisms.index(org),
+                                     {True:'short', False:''}[short]))
+                SeqIO.write(lseqs, open(query, 'w'), 'fasta')
+                queries[org].append((query, short))
+        
+        tasks = []
+        pairs = {}
+        for org in self.organisms:
+            for otherorg in self.organisms:
+                if org == otherorg:
+                    continue
+                for query, short in queries[org]:
+                    out = '%s_%d.xml'%(os.path.splitext(query)[0],
+                                       self.organisms.index(otherorg))
+                    pairs[out] = otherorg
+                    tasks.append( RunBlast(query, self.dbs[otherorg], out,
+                                           self.evalue, short, 1,
+                                           additional, self.backend) )
+        
+        self._maxsubstatus = len(tasks)
+        
+        # Protein, target organism --> best hit
+        besthits = {}
+        try:
+            for out, res, elapsed in self.runTasks(tasks):
+                if self.killed:
+                    logger.debug('Exiting for a kill signal')
+                    return
+                
+                if not res:
+                    logger.error('Blast error on %s'%out)
+                    return False
+                
+                self._substatus += 1
+                self.updateStatus(sub=True)
+                
+                self._blast.parseBlast(out)
+                try:
+                    for hits in self._blast.getHits(self.evalue):
+                        if len(hits) == 0:
+                            continue
+                        besthits[(hits[0].query_id, pairs[out])] = hits[0].hit
+                except:
+                    logger.error('Blast results corrupted for file %s'%out)
+                    return False
+        except RuntimeError:
+            logger.error('Blast job failure')
+            return False
+        
+        orthindex = 1
+        for group in getRBHGroups(self._proteins, self._prot2orgs, besthits):
+            self.orthologs[self.prefix + str(orthindex)] = group
+            orthindex += 1
+        
         return True
     
     def packPanGenome(self):
         for g in self.orthologs:
-            if len(self.orthologs[g]) == len(self.organisms):
+            orgs = set([self._prot2orgs[x] for x in self.orthologs[g]])
+            if len(orgs) == len(self.organisms):
                 self.core.append(g)
             elif len(self.orthologs[g]) == 1:
                 self.unique.append(g)
@@ -328,8 +496,15 @@ class PanGenomer(CommonMultiProcess):
             return
             
         self.updateStatus()
-        if not self.serialBBH():
-            self.sendFailure('Serial BBH failure!')
+        if self.rbh:
+            res = self.pairwiseBBH()
+        else:
+            try:
+                res = self.serialBBH()
+            except RuntimeError:
+                res = False
+        if not res:
+            self.sendFailure('BBH failure!')
             self.killParallel()
             self.cleanUp()
             return
@@ -346,3 +521,44 @@ class PanGenomer(CommonMultiProcess):
         
         self.updateStatus()
         self.cleanUp()
+
+################################################################################
+# Methods
+
+def getRBHGroups(proteins, prot2orgs, besthits):
+    '''
+    Groups the proteins using their reciprocal best hits
+    proteins: all the proteins (their order defines the groups order)
+    prot2orgs: protein --> organism
+    besthits: (protein, target organism) --> best hit in that organism
+    Returns a list of groups (list of proteins), one for each connected
+    component of the reciprocal best hits graph
+    '''
+    parent = {}
+    
+    def find(prot):
+        root = prot
+        while parent.get(root, root) != root:
+            root = parent[root]
+        # Path compression
+        while prot != root:
+            parent[prot], prot = root, parent[prot]
+        return root
+    
+    for (prot, org), hit in besthits.iteritems():
+        if besthits.get((hit, prot2orgs[prot])) != prot:
+            continue
+        a, b = find(prot), find(hit)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+    
+    groups = {}
+    order = []
+    for prot in proteins:
+        root = find(prot)
+        if root not in groups:
+            groups[root] = []
+            order.append(root)
+        groups[root].append(prot)
+    
+    return [groups[root] for root in order]
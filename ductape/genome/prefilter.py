@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Prefilter
+
+Genome library
+
+K-mer index of a set of proteomes, used to skip the homology searches
+that cannot find any hit
+"""
+from Bio import SeqIO
+import logging
+import numpy as np
+
+__author__ = "Marco Galardini"
+
+################################################################################
+# Log setup
+
+logger = logging.getLogger('ductape.prefilter')
+
+################################################################################
+# Constants
+
+# Reduced amino acid alphabet (Murphy et al. 2000, 10 letters)
+reducedAlphabet = ['LVIM', 'C', 'A', 'G', 'ST', 'P', 'FYW', 'EDNQB', 'KRZ',
+                   'H']
+# Spaced seed (1: considered position, 0: ignored position)
+defaultSeed = '111011011'
+# Minimum number of seeds shared with a target protein on the same diagonal
+defaultMinSeeds = 3
+# Width of the diagonals bands (to tolerate small gaps)
+diagonalBand = 16
+# Shorter queries are never filtered out
+minLength = 30
+
+################################################################################
+# Classes
+
+class KmerIndex(object):
+    '''
+    Class KmerIndex
+    For each organism the seeds are kept as three arrays sorted by seed
+    code (seed code, protein index, position); an organism is a candidate
+    target if at least one protein shares minseeds seeds with the query
+    on the same diagonal band (two grids of bands are used, shifted by
+    half a band)
+
+    The sensitivity can be raised using a lighter seed (less '1') or
+    lowering minseeds, at the cost of less skipped searches
+    '''
+    def __init__(self, seed=defaultSeed, minseeds=defaultMinSeeds):
+        self.seed = seed
+        self.minseeds = int(minseeds)
+        self._offsets = np.array([i for i, x in enumerate(seed) if x == '1'])
+        if len(self._offsets) == 0 or len(self._offsets) > 9:
+            raise ValueError('The seed weight must be between 1 and 9')
+        self._span = len(seed)
+        self._weights = 10 ** np.arange(len(self._offsets) - 1, -1, -1,
+                                        dtype=np.uint32)
+
+        self._table = np.zeros(256, dtype=np.int8) - 1
+        for code, letters in enumerate(reducedAlphabet):
+            for letter in letters:
+                self._table[ord(letter)] = code
+                self._table[ord(letter.lower())] = code
+
+        self._codes = {}
+        self._prots = {}
+        self._pos = {}
+
+    def getSeeds(self, seq):
+        '''
+        Returns the seed codes of a sequence and the start of each seed
+        Windows with unknown residues are discarded
+        '''
+        res = self._table[np.frombuffer(seq, dtype=np.uint8)]
+        nwin = len(res) - self._span + 1
+        if nwin <= 0:
+            return (np.zeros(0, dtype=np.uint32),
+                    np.zeros(0, dtype=np.int64))
+
+        codes = np.zeros(nwin, dtype=np.uint32)
+        valid = np.ones(nwin, dtype=bool)
+        for offset, weight in zip(self._offsets, self._weights):
+            window = res[offset:offset + nwin]
+            valid &= window >= 0
+            codes += window.astype(np.uint32) * weight
+
+        starts = np.nonzero(valid)[0]
+        return codes[starts], starts
+
+    def addOrganism(self, org, seqs):
+        '''
+        Index a proteome (iterable of Bio.SeqRecord)
+        '''
+        # One concatenated sequence, '*' separates the proteins
+        lseqs = [str(s.seq) for s in seqs]
+        if len(lseqs) == 0:
+            lseqs = ['']
+
+        codes, starts = self.getSeeds('*'.join(lseqs))
+
+        bounds = np.cumsum([len(s) + 1 for s in lseqs])
+        prots = np.searchsorted(bounds, starts, side='right')
+        pos = starts - np.concatenate(([0], bounds))[prots]
+
+        order = np.argsort(codes, kind='mergesort')
+        self._codes[org] = codes[order]
+        self._prots[org] = prots[order].astype(np.uint32)
+        self._pos[org] = pos[order].astype(np.uint32)
+
+    def addFile(self, org, infile):
+        '''
+        Index a proteome fasta file
+        '''
+        self.addOrganism(org, SeqIO.parse(open(infile), 'fasta'))
+
+    def hasCandidates(self, seq, org):
+        '''
+        Returns True if a protein of the organism may be an homolog of seq
+        '''
+        if len(seq) < minLength:
+            return True
+
+        query, qpos = self.getSeeds(seq)
+        codes = self._codes[org]
+
+        lo = np.searchsorted(codes, query, side='left')
+        hi = np.searchsorted(codes, query, side='right')
+        nhits = hi - lo
+        total = nhits.sum()
+        if total < self.minseeds:
+            return False
+
+        # Positions of all the matching seeds in the index
+        first = np.repeat(lo - np.cumsum(nhits) + nhits, nhits)
+        matches = first + np.arange(total)
+
+        diagonals = (self._pos[org][matches].astype(np.int64) -
+                     np.repeat(qpos, nhits) + 2**31)
+        prots = self._prots[org][matches].astype(np.int64) << 33
+        # Each seed is counted in two bands grids, shifted by half a band,
+        # so that the seeds close to a band border are not split
+        keys = np.concatenate((prots + diagonals // diagonalBand,
+                               prots + 2**32 + (diagonals + diagonalBand // 2)
+                                               // diagonalBand))
+
+        return np.unique(keys, return_counts=True)[1].max() >= self.minseeds
+
+    def getCandidates(self, seq, orgs):
+        '''
+        Returns the organisms that may contain an homolog of seq
+        '''
+        return [org for org in orgs if self.hasCandidates(seq, org)]
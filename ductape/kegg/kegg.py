@@ -660,6 +660,33 @@ class KeggAPI(object):
                     logger.warning('show_pathway failed!')
                     return
 
+    def getPathwayPicture(self, path_id, retries=8):
+        '''
+        Get the base (uncolored) picture of a pathway (png data)
+        '''
+        attempts = 0
+        while True:
+            try:
+                self.input = path_id
+                logger.debug('Looking for KEGG map picture of %s'%path_id)
+                url = self._apiurl + 'get/%s/image'%path_id.split(':')[-1]
+                
+                sock=urllib.urlopen(url, timeout=60)
+                self.result = sock.read()
+                sock.close()
+                return
+            except Exception as e:
+                attempts += 1
+                logger.debug('get image failed! Attempt %d'
+                              %attempts)
+                logger.debug('%s'%str(e))
+                time.sleep((2 + random.random())*attempts)
+                if self.keeptrying:continue
+                if attempts >= retries:
+                    self.failed = True
+                    logger.warning('get image failed!')
+                    return
+
 class KeggColor(object):
     '''
     Class KeggColor
@@ -2028,35 +2055,110 @@ class CompMapper(BaseMapper):
                              rpairreact=self.rpairreact)
         self.result.setMaps(self.pathmap)
 
+class MapJob(object):
+    '''
+    Class MapJob
+    A set of maps (KeggColor list) sharing the output directory and legend
+    '''
+    def __init__(self, color_objs, prefix='', legend=None):
+        self.colors = color_objs
+        self.prefix = prefix
+        self.legend = legend
+        
+        # Output directory
+        self.room = None
+
+class RunPaint(object):
+    '''
+    Paint all the requested colorings of a single Kegg map
+    (the base picture is decoded only once)
+    Input: base picture, html map, list of (colors, borders, filename)
+    Returns the list of (filename, success)
+    '''
+    def __init__(self, path, png, htmlmap, paints):
+        self.path = path
+        self.png = png
+        self.htmlmap = htmlmap
+        self.paints = paints
+    
+    def __call__(self):
+        from ductape.kegg.painter import MapPainter
+        
+        try:
+            painter = MapPainter(self.png, self.htmlmap)
+        except Exception as e:
+            logger.debug('Could not read the base map of %s (%s)'%(self.path,
+                                                                   e))
+            return [(fname, False) for colors, borders, fname in self.paints]
+        
+        res = []
+        for colors, borders, fname in self.paints:
+            try:
+                pic = painter.paint(colors, borders)
+                
+                fOut = open(fname,'wb')
+                fOut.write(pic)
+                fOut.close()
+                
+                res.append((fname, True))
+            except Exception as e:
+                logger.debug('Could not paint %s (%s)'%(fname, e))
+                res.append((fname, False))
+        
+        return res
+
 class MapsFetcher(BaseKegg):
     '''
     Class MapsFetcher
-    Download colored Kegg maps (png or URLs)
-    Input: color_objs (KeggColor list), picture, htmls, urls, prefix, legend (file)
+    Color Kegg maps (png) and generate the interactive web pages
+    The base maps pictures are only downloaded if not provided; the colors
+    are then painted locally using the html map coordinates
+    
+    More than one set of maps (jobs) can be added: all the maps are then
+    painted together, grouped by pathway, using ncpus processes
+    
+    Input: color_objs (KeggColor list), picture, htmls, prefix, legend (file),
+           basemaps (path_id --> png data), htmlmaps (path_id --> html map,
+           used when the KeggColor has no html map)
     Output: tuple(list of png filenames, list of HTML files, list of URLs)
+            newbasemaps (path_id --> png data) for the downloaded base maps
     '''
     
     _statusDesc = {0:'Not started',
                1:'Checking connectivity',
                2:'Making room',
-               3:'Fetching maps (pictures)',
-               4:'Generating interactive web pages'}
+               3:'Fetching base maps',
+               4:'Coloring maps (pictures)',
+               5:'Generating interactive web pages'}
     
-    _substatuses = [3]
+    _substatuses = [3,4]
     
-    def __init__(self, color_objs, pictures=True, html=True, prefix='', 
-                 legend=None, threads=40, keeptrying=False,
+    def __init__(self, color_objs=[], pictures=True, html=True, prefix='', 
+                 legend=None, basemaps={}, htmlmaps={}, ncpus=1,
+                 threads=40, keeptrying=False,
                  queue=Queue.Queue()):
         BaseKegg.__init__(self, threads=threads, keeptrying=keeptrying,
                           queue=queue)
         
-        self.colors = color_objs
+        self.jobs = []
+        if len(color_objs) > 0:
+            self.addJob(color_objs, prefix, legend)
+        
         self.pictures = bool(pictures)
         self.web = bool(html)
-        self.legend = legend 
+        
+        self.ncpus = int(ncpus)
         
         self._keggroom = None
-        self._prefix = prefix 
+        
+        # Base maps
+        self.basemaps = basemaps
+        self.newbasemaps = {}
+        self.htmlmaps = htmlmaps
+        # KeggColor --> base map
+        self._base = {}
+        # path_id --> web page html map
+        self._webmaps = {}
         
         # Outputs
         self.pics = []
@@ -2064,6 +2166,20 @@ class MapsFetcher(BaseKegg):
         self.pages = []
         self.result = (self.pics, self.webpages, self.pages)
     
+    def addJob(self, color_objs, prefix='', legend=None):
+        '''
+        Add a set of maps to be colored
+        '''
+        self.jobs.append( MapJob(color_objs, prefix, legend) )
+    
+    def getColors(self):
+        '''
+        Generator to all the KeggColor objects
+        '''
+        for job in self.jobs:
+            for kmap in job.colors:
+                yield kmap
+    
     def makeRoom(self,location=''):
         '''
         Creates a tmp directory in the desired location
@@ -2078,26 +2194,43 @@ class MapsFetcher(BaseKegg):
             path = os.path.join(path, 'keggmaps')
             try:os.mkdir(path)
             except:pass
-            path = os.path.join(path, self._prefix)
             self._keggroom = path
-            os.mkdir(path)
         except:
             logger.debug('Temporary directory creation failed! %s'
                           %path)
+        
+        for job in self.jobs:
+            try:
+                path = os.path.join(self._keggroom, job.prefix)
+                job.room = path
+                os.mkdir(path)
+            except:
+                logger.debug('Temporary directory creation failed! %s'
+                              %path)
     
-    def copyLegend(self):
+    def copyLegend(self, job):
         '''Copy the legend in the target directory'''
-        if self.legend and os.path.exists(self.legend):
-            legend = os.path.join(self._keggroom, 'legend.png')
-            shutil.copyfile(self.legend, legend)
+        if job.legend and os.path.exists(job.legend):
+            legend = os.path.join(job.room, 'legend.png')
+            shutil.copyfile(job.legend, legend)
             
             return legend
         return None
     
-    def getMaps(self):
-        legend = self.copyLegend()
+    def getMissingMaps(self):
+        '''
+        Pathways whose base map picture is not available
+        '''
+        return sorted(set([kmap.path for kmap in self.getColors()
+                           if kmap.path not in self.basemaps
+                           and kmap.path not in avoidedPaths]))
+    
+    def getBaseMaps(self):
+        missing = self.getMissingMaps()
+        
+        self._maxsubstatus = len(missing)
         
-        for piece in get_span(self.colors, self.numThreads):
+        for piece in get_span(missing, self.numThreads):
             if self.killed:
                 logger.debug('Exiting for a kill signal')
                 return
@@ -2109,28 +2242,14 @@ class MapsFetcher(BaseKegg):
             self.updateStatus(sub=True)
             
             threads = []
-            for kmap in piece:
-                path = kmap.path
-                
-                # Skip the general maps
-                if path in avoidedPaths:
-                    logger.debug('Skipping general pathway %s'%path)
-                    continue
-                #
-                
-                objs,colors = kmap.getAll()
-                dummy,borders = kmap.getBorders()
-                
+            for path in piece:
                 obj = threading.Thread(
-                        target = self.handlers[piece.index(kmap)].getHTMLColoredPathway,
-                        args = (path,objs,colors,borders,))
+                        target = self.handlers[piece.index(path)].getPathwayPicture,
+                        args = (path,))
                 obj.start()
                 threads.append(obj)
             time.sleep(0.01)
             
-            if len(threads) == 0:
-                continue
-            
             while len(threads) > 0:
                 for thread in threads:
                     if not thread.isAlive():
@@ -2144,34 +2263,77 @@ class MapsFetcher(BaseKegg):
                     logger.debug('Found an empty handler')
                     continue
                 
-                fname = os.path.join(self._keggroom,handler.input)
-                fname = fname+'.png'
+                self.newbasemaps[handler.input] = handler.result
+        
+        for kmap in self.getColors():
+            if kmap.path in self.basemaps:
+                self._base[kmap] = self.basemaps[kmap.path]
+            elif kmap.path in self.newbasemaps:
+                self._base[kmap] = self.newbasemaps[kmap.path]
+    
+    def getMaps(self):
+        from ductape.common.commonmultiprocess import runParallel
+        
+        # Group the maps by pathway
+        paths = {}
+        for job in self.jobs:
+            self.copyLegend(job)
+            
+            for kmap in job.colors:
+                path = kmap.path
                 
-                # Fetch the map picture
-                # Hoping it won't change much in the future
-                for line in handler.result.split('\n'):
-                    if ('<img' in line
-                        and 'pathwayimage' in line
-                        and 'usemap="#mapdata"' in line):
-                        urlimage = 'http://www.kegg.jp/' + line.split('src="')[1].split('"')[0]
-
-                        sock=urllib.urlopen(urlimage, timeout=30)
-                        pic = sock.read()
-                        sock.close()
-                        
-                        fOut = open(fname,'w')
-                        fOut.write(pic)
-                        fOut.close()
-                        self.pics.append(fname)
+                # Skip the general maps
+                if path in avoidedPaths:
+                    logger.debug('Skipping general pathway %s'%path)
+                    continue
                 #
+                
+                if kmap not in self._base:
+                    logger.debug('Base map picture missing for %s'%path)
+                    continue
+                
+                objs,colors = kmap.getAll()
+                dummy,borders = kmap.getBorders()
+                
+                fname = os.path.join(job.room,path)
+                fname = fname+'.png'
+                
+                if path not in paths:
+                    paths[path] = RunPaint(path, self._base[kmap],
+                                           kmap.htmlmap, [])
+                paths[path].paints.append( (dict(zip(objs, colors)),
+                                            dict(zip(objs, borders)),
+                                            fname) )
+        
+        self._maxsubstatus = sum([len(task.paints)
+                                  for task in paths.itervalues()])
+        
+        for res in runParallel(paths.values(), self.ncpus):
+            if self.killed:
+                logger.debug('Exiting for a kill signal')
+                return
+            
+            for fname, success in res:
+                if success:
+                    self.pics.append(fname)
+                else:
+                    logger.warning('Could not color map %s'%fname)
+            
+            self._substatus += len(res)
+            self.updateStatus(sub=True)
     
     def getWebPages(self):
+        for job in self.jobs:
+            self.writeWebPages(job)
+    
+    def writeWebPages(self, job):
         # TODO: nicer web pages
-        legend = self.copyLegend()
-        legend = os.path.split(legend)[-1]
+        legend = self.copyLegend(job)
         
         if legend:
-            fname = os.path.join(self._keggroom,'legend.html')
+            legend = os.path.split(legend)[-1]
+            
+            fname = os.path.join(job.room,'legend.html')
             
             fOut = open(fname,'w')
             fOut.write('<html>\n<head></head>\n<body>\n')
@@ -2182,12 +2344,10 @@ class MapsFetcher(BaseKegg):
             fOut.write('</body>\n</html>')
             fOut.close()
         
-        for path in self.colors:
-            myindex = self.colors.index(path)
-            
+        for myindex, path in enumerate(job.colors):
             logger.debug('Writing interactive web page for %s'%path.path)
             
-            fname = os.path.join(self._keggroom,path.path)
+            fname = os.path.join(job.room,path.path)
             fname = fname+'.html'
             
             fOut = open(fname,'w')
@@ -2196,11 +2356,11 @@ class MapsFetcher(BaseKegg):
             # Navigation
             fOut.write('''<h2 align="center">\n''')
             fOut.write('''<a href="./%s.html">&laquo;</a>%s'''%(
-                       self.colors[myindex-1].path, path.path))
+                       job.colors[myindex-1].path, path.path))
             try:
-                next = self.colors[myindex+1]
+                next = job.colors[myindex+1]
             except:
-                next = self.colors[0]
+                next = job.colors[0]
             fOut.write('''<a href="./%s.html">&raquo;</a>\n</h2>\n'''%
                        (next.path))
             
@@ -2214,34 +2374,41 @@ class MapsFetcher(BaseKegg):
                         </div>\n'''%
                        (path.path+'.png'))
             
-            html = path.htmlmap.split('\n')
-            newhtml = []
-            for line in html:
-                line = line.replace('href="/dbget-bin/www_bget?',
-               'target="_blank" href="http://www.genome.jp/dbget-bin/www_bget?')
-                
-                if '/kegg-bin/show_pathway?' in line:
-                    s = line.split('/kegg-bin/show_pathway?')
-                    s1 = s[1].split('"')
-                    s1[0] += '.html'
-                    line1 = '"'.join(s1)
-                    line = './'.join([s[0]] + [line1])
-                
-                newhtml.append(line)
+            # The same map is shared by all the jobs
+            if path.path not in self._webmaps:
+                html = path.htmlmap.split('\n')
+                newhtml = []
+                for line in html:
+                    line = line.replace('href="/dbget-bin/www_bget?',
+                   'target="_blank" href="http://www.genome.jp/dbget-bin/www_bget?')
+                    
+                    if '/kegg-bin/show_pathway?' in line:
+                        s = line.split('/kegg-bin/show_pathway?')
+                        s1 = s[1].split('"')
+                        s1[0] += '.html'
+                        line1 = '"'.join(s1)
+                        line = './'.join([s[0]] + [line1])
+                    
+                    newhtml.append(line)
+                self._webmaps[path.path] = '\n'.join(newhtml)
                 
-            fOut.write('%s\n'%'\n'.join(newhtml))
+            fOut.write('%s\n'%self._webmaps[path.path])
             fOut.write('<div id="poplay" class="poplay" />\n</body>\n</html>')
             fOut.close()
             
             self.webpages.append(fname)
     
     def run(self):
-        self.updateStatus()
-        try:
-            self.checkConnection()
-        except Exception as e:
-            self.sendFailure(str(e))
-            return
+        # Only go online if some base map is missing
+        if self.pictures and len(self.getMissingMaps()) > 0:
+            self.updateStatus()
+            try:
+                self.checkConnection()
+            except Exception as e:
+                self.sendFailure(str(e))
+                return
+        else:
+            self.updateStatus(send=False)
     
         self.updateStatus()
         self.makeRoom()
@@ -2249,21 +2416,38 @@ class MapsFetcher(BaseKegg):
         if self.killed:
             return
         
+        if self.pictures:
+            self.updateStatus()
+            try:
+                self.getBaseMaps()
+            except Exception as e:
+                self.sendFailure(e)
+                return
+            self.cleanHandlers()
+            self.resetSubStatus()
+        else:
+            self.updateStatus(send=False)
+        
+        if self.killed:
+            return
+        
+        for kmap in self.getColors():
+            if not kmap.htmlmap:
+                kmap.htmlmap = self.htmlmaps.get(kmap.path, '')
+        
         # ':' bugfix
         # the ':' char causes various problems in windows folders
-        for path in self.colors:
+        for path in self.getColors():
             if ':' in path.path:
                 path.path = path.path.split(':')[1]
         
         if self.pictures:
-            self._maxsubstatus = len(self.colors)
             self.updateStatus()
             try:
                 self.getMaps()
             except Exception as e:
                 self.sendFailure(e)
                 return
-            self.cleanHandlers()
             self.resetSubStatus()
         else:
             self.updateStatus(send=False)
@@ -6,9 +6,13 @@ Kegg Library
 
 Networks made using Kegg data
 """
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+import json
 import logging
 import networkx as nx
 import numpy as np
+import struct
 # Nodes color handling
 import matplotlib.colors as pltcls
 import matplotlib.pyplot as plt
@@ -20,6 +24,14 @@ __author__ = "Marco Galardini"
 
 logger = logging.getLogger('ductape.net')
 
+################################################################################
+# Constants
+
+# Binary network format
+# magic, version, header length (little endian), JSON header, CSR arrays
+binaryMagic = 'DNET'
+binaryVersion = 1
+
 ################################################################################
 # Classes
 
@@ -76,28 +88,36 @@ class MetabolicNet(object):
         
         self.net = nx.Graph()
         
+        # Graph statistics, computed once until the graph changes
+        self._stats = {}
+        
         if nodes:
-            for n in nodes:
-                self.net.add_node(n.co_id, name=n.name)
-                if hasattr(n, 'weight'):
-                    self.net.node[n.co_id]['weight'] = n.weight
-                    self.net.node[n.co_id]['graphics'] = {'fill': n.getColor()}
+            self.addNodes(nodes)
         
         if edges:
-            for e in edges:
-                self.net.add_edge(e.co1, e.co2, reid=e.re_id, name=e.name)
-                if hasattr(e, 'weight'):
-                    self.net.adj[e.co1][e.co2]['weight'] = e.weight
+            self.addEdges(edges)
+    
+    def _changed(self):
+        '''
+        The graph has been modified: forget the statistics
+        '''
+        self._stats = {}
+    
+    def _getStat(self, key, func):
+        '''
+        Returns a memoized graph statistic
+        '''
+        if key not in self._stats:
+            self._stats[key] = func()
+        return self._stats[key]
                     
     def hasNodesWeight(self):
         '''
         At least one node has weight?
         '''
-        for co in self.net.nodes():
-            try:
-                self.net.node[co]['weight']
+        for co, data in self.net.nodes(data=True):
+            if 'weight' in data:
                 return True
-            except:pass
             
         return False
     
@@ -105,25 +125,34 @@ class MetabolicNet(object):
         '''
         At least one edge has weight?
         '''
-        for e in self.net.edges():
-            if 'weight' in self.net.adj[e[0]][e[1]]:
+        for co1, co2, data in self.net.edges(data=True):
+            if 'weight' in data:
                 return True
 
         return False
     
+    def getDegree(self):
+        '''
+        Returns a dictionary node --> degree
+        '''
+        return self._getStat('degree', lambda: dict(self.net.degree()))
+    
     def removeSingletons(self):
         '''
         Remove nodes with degree 0
         '''
-        to_remove = filter(lambda x: self.net.degree()[x] == 0,
-                           self.net.nodes())
-        self.net.remove_nodes_from(to_remove)
+        to_remove = [co for co, degree in self.getDegree().iteritems()
+                     if degree == 0]
+        if len(to_remove) > 0:
+            self.net.remove_nodes_from(to_remove)
+            self._changed()
             
     def setNet(self, net):
         '''
         Use an external networkx graph
         '''
         self.net = net
+        self._changed()
                     
     def addNodes(self, nodes):
         '''
@@ -131,77 +160,221 @@ class MetabolicNet(object):
         w co_id, name; w or w/o weight attributes
         nodes weight indicate the activity index
         '''
+        bulk = []
         for n in nodes:
-            self.net.add_node(n.co_id, name=n.name)
+            attrs = {'name':n.name}
             if hasattr(n, 'weight'):
-                self.net.node[n.co_id]['weight'] = n.weight
-                self.net.node[n.co_id]['graphics'] = {'fill': n.getColor()}
+                attrs['weight'] = n.weight
+                attrs['graphics'] = {'fill': n.getColor()}
+            bulk.append( (n.co_id, attrs) )
+        
+        self.net.add_nodes_from(bulk)
+        self._changed()
+    
+    def addEdges(self, edges):
+        '''
+        Takes a reactions iterable and adds (or updates) the edges
+        w co1, co2, re_id, name; w or w/o weight attributes
+        edges weight indicate the copy number
+        '''
+        bulk = []
+        for e in edges:
+            attrs = {'reid':e.re_id, 'name':e.name}
+            if hasattr(e, 'weight'):
+                attrs['weight'] = e.weight
+            bulk.append( (e.co1, e.co2, attrs) )
+        
+        self.net.add_edges_from(bulk)
+        self._changed()
                 
     def __len__(self):
         '''
         Returns the number of reactions
         '''
-        i = 0
-        for e in self.net.edges():
-            if 'weight' in self.net.adj[e[0]][e[1]]:
-                i += self.net.adj[e[0]][e[1]]['weight']
-            else:
-                i += 1
-                
-        return i
+        return sum([data.get('weight', 1)
+                    for co1, co2, data in self.net.edges(data=True)])
     
     def getDistinctReactions(self):
         '''
         Returns the distinct reaction IDs of this network
         '''
-        re_id = set()
-        for e in self.net.edges():
-            re_id.add(self.net.adj[e[0]][e[1]]['reid'])
-        
-        return re_id
+        return set([data['reid']
+                    for co1, co2, data in self.net.edges(data=True)])
+    
+    def _getWeights(self):
+        '''
+        Returns the nodes weights (compounds activity)
+        '''
+        return np.array([data['weight']
+                         for co, data in self.net.nodes(data=True)
+                         if 'weight' in data])
     
     def mean(self):
         '''
         Get the mean compounds activity (nodes weight)  
         '''
-        weights = []
-        
-        for co in self.net.nodes():
-            try:
-                weights.append(self.net.node[co]['weight'])
-            except:pass
+        weights = self._getWeights()
             
         if len(weights) == 0:
             return np.nan
         
-        return np.array(weights).mean()
+        return weights.mean()
     
     def std(self):
         '''
         Get the stddev compounds activity (nodes weight)  
         '''
-        weights = []
-        
-        for co in self.net.nodes():
-            try:
-                weights.append(self.net.node[co]['weight'])
-            except:pass
+        weights = self._getWeights()
             
         if len(weights) == 0:
             return np.nan
         
-        return np.array(weights).std()
+        return weights.std()
+
+    def _getComponentsSizes(self):
+        '''
+        Connected components sizes, using the sparse adjacency matrix
+        '''
+        index = dict([(co, i) for i, co in enumerate(self.net.nodes())])
+        if len(index) == 0:
+            return []
+        
+        edges = np.array([(index[co1], index[co2])
+                          for co1, co2 in self.net.edges()],
+                          dtype=int).reshape(-1, 2)
+        adjacency = coo_matrix((np.ones(edges.shape[0]),
+                                (edges[:,0], edges[:,1])),
+                               shape=(len(index), len(index)))
+        
+        ncomp, labels = connected_components(adjacency, directed=False)
+        
+        return [int(x) for x in np.bincount(labels)]
 
-    def getComponents(self):
-        return len(list(nx.connected_components(self.net)))
-    
     def getComponentsSizes(self):
-        return [len(x) for x in nx.connected_components(self.net)]
+        return list(self._getStat('components', self._getComponentsSizes))
+
+    def getComponents(self):
+        return len(self.getComponentsSizes())
     
     def getComponentsMean(self):
-        return np.array([len(x)
-                         for x in nx.connected_components(self.net)]).mean()
+        return np.array(self.getComponentsSizes()).mean()
                          
     def getComponentsStd(self):
-        return np.array([len(x)
-                         for x in nx.connected_components(self.net)]).std()
+        return np.array(self.getComponentsSizes()).std()
+
+    def _iterRows(self, nodes, index):
+        '''
+        Generator to the edges of each node, in the nodes order
+        Each edge is given once, on the node with the lower index:
+        [(neighbour index, edge data), ...]
+        '''
+        for i, co in enumerate(nodes):
+            yield [(index[nbr], data) for nbr, data in self.net.adj[co].items()
+                   if index[nbr] >= i]
+
+    def writeBinary(self, fname):
+        '''
+        Save the network in the compact binary format
+        
+        JSON header: network name, nodes (ID and attributes), reactions
+        (ID and name), arrays lengths
+        Arrays (CSR, each edge stored once): indptr (int32, nodes + 1),
+        indices (int32, edges), reaction index (int32, edges),
+        weight (float64, edges; NaN if missing)
+        
+        The arrays are written one row at a time, walking the graph once
+        for each array, so that the edges are never copied in memory
+        '''
+        nodes = self.net.nodes()
+        index = dict([(co, i) for i, co in enumerate(nodes)])
+        
+        reactions = []
+        dreact = {}
+        nedges = 0
+        for co1, co2, data in self.net.edges(data=True):
+            r = (data.get('reid'), data.get('name'))
+            if r not in dreact:
+                dreact[r] = len(reactions)
+                reactions.append(r)
+            nedges += 1
+        
+        header = {'name':self.name,
+                  'nodes':[(co, self.net.node[co]) for co in nodes],
+                  'reactions':reactions,
+                  'nnodes':len(nodes),
+                  'nedges':nedges}
+        
+        f = open(fname, 'wb')
+        f.write(binaryMagic)
+        f.write(struct.pack('<II', binaryVersion, 0))
+        start = f.tell()
+        json.dump(header, f)
+        length = f.tell() - start
+        f.seek(start - 4)
+        f.write(struct.pack('<I', length))
+        f.seek(0, 2)
+        
+        # indptr
+        total = 0
+        np.array([0], dtype='<i4').tofile(f)
+        for row in self._iterRows(nodes, index):
+            total += len(row)
+            np.array([total], dtype='<i4').tofile(f)
+        
+        getters = ((lambda j, data: j, '<i4'),
+                   (lambda j, data: dreact[(data.get('reid'),
+                                            data.get('name'))], '<i4'),
+                   (lambda j, data: data.get('weight', np.nan), '<f8'))
+        for getter, dtype in getters:
+            for row in self._iterRows(nodes, index):
+                np.array([getter(j, data) for j, data in row],
+                         dtype=dtype).tofile(f)
+        f.close()
+        
+        logger.debug('Saved binary network %s (%d nodes, %d edges)'%(fname,
+                                                        len(nodes), nedges))
+
+################################################################################
+# Methods
+
+def loadBinary(fname):
+    '''
+    Load a network saved in the compact binary format
+    Returns a MetabolicNet object
+    '''
+    f = open(fname, 'rb')
+    if f.read(len(binaryMagic)) != binaryMagic:
+        f.close()
+        raise IOError('Not a binary network file (%s)'%fname)
+    version, length = struct.unpack('<II', f.read(8))
+    if version > binaryVersion:
+        f.close()
+        raise IOError('Unsupported binary network version %d (%s)'%(version,
+                                                                    fname))
+    header = json.loads(f.read(length))
+    
+    indptr = np.fromfile(f, dtype='<i4', count=header['nnodes'] + 1)
+    indices = np.fromfile(f, dtype='<i4', count=header['nedges'])
+    reacts = np.fromfile(f, dtype='<i4', count=header['nedges'])
+    weights = np.fromfile(f, dtype='<f8', count=header['nedges'])
+    f.close()
+    
+    nodes = [co for co, data in header['nodes']]
+    reactions = header['reactions']
+    sources = np.repeat(np.arange(header['nnodes']), np.diff(indptr))
+    
+    edges = []
+    for i, j, r, w in zip(sources, indices, reacts, weights):
+        data = {'reid':reactions[r][0], 'name':reactions[r][1]}
+        if not np.isnan(w):
+            data['weight'] = w
+        edges.append( (nodes[i], nodes[j], data) )
+    
+    g = nx.Graph()
+    g.add_nodes_from([(co, data) for co, data in header['nodes']])
+    g.add_edges_from(edges)
+    
+    net = MetabolicNet(name=header['name'])
+    net.setNet(g)
+    
+    return net
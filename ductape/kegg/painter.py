@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""
+Painter
+
+Kegg Library
+
+Local colorization of Kegg maps, using the base map picture and the
+coordinates of the objects (html image map)
+"""
+import logging
+import numpy as np
+import re
+from StringIO import StringIO
+
+__author__ = "Marco Galardini"
+
+################################################################################
+# Log setup
+
+logger = logging.getLogger('ductape.painter')
+
+################################################################################
+# Constants
+
+# Pixels lighter than this are considered background
+lightness = 0.5
+# Border width (pixels)
+borderWidth = 2
+
+################################################################################
+# Classes
+
+class MapArea(object):
+    '''
+    Class MapArea
+    A single object in the html image map (shape, coordinates, IDs)
+    '''
+    def __init__(self, shape, coords, ids):
+        self.shape = shape
+        self.coords = coords
+        self.ids = ids
+
+class MapPainter(object):
+    '''
+    Class MapPainter
+    Colors a Kegg map picture; the picture is decoded and the html map
+    is parsed only once, so that many colorings can be painted quickly
+    
+    Rectangles (reactions, orthologs) get their background colored,
+    circles (compounds) are filled; the IDs prefixes are not considered
+    '''
+    def __init__(self, png, htmlmap):
+        import matplotlib.image as mpimg
+        
+        img = mpimg.imread(StringIO(png), format='png')
+        if img.dtype != np.float32 and img.dtype != np.float64:
+            img = img / 255.0
+        if img.ndim == 2:
+            img = np.dstack([img] * 3)
+        self.img = np.array(img[:, :, :3], dtype=float)
+        
+        self.light = self.img.mean(axis=2) > lightness
+        
+        self.areas = parseMap(htmlmap)
+    
+    def paint(self, colors, borders={}):
+        '''
+        colors: object ID --> html color (the background of the object)
+        borders: object ID --> html color (the border of the object)
+        Returns the colored picture (png data)
+        '''
+        import matplotlib.image as mpimg
+        
+        img = self.img.copy()
+        
+        lcolors = dict([(getBareID(k), v) for k, v in colors.iteritems()])
+        lborders = dict([(getBareID(k), v) for k, v in borders.iteritems()
+                         if v is not None])
+        
+        for area in self.areas:
+            fill = None
+            edge = None
+            for obj_id in area.ids:
+                if fill is None and obj_id in lcolors:
+                    fill = lcolors[obj_id]
+                if edge is None and obj_id in lborders:
+                    edge = lborders[obj_id]
+            if fill is None and edge is None:
+                continue
+            
+            if area.shape == 'rect' and len(area.coords) == 4:
+                window, inner, border = _rectMasks(img, area.coords)
+                # Keep the text and the frame of the box
+                inner &= self.light[window]
+            elif area.shape == 'circle' and len(area.coords) >= 3:
+                window, inner, border = _circleMasks(img, area.coords)
+            else:
+                continue
+            
+            if fill is not None:
+                img[window][inner] = hexToRGB(fill)
+            if edge is not None:
+                img[window][border] = hexToRGB(edge)
+        
+        out = StringIO()
+        mpimg.imsave(out, img, format='png')
+        
+        return out.getvalue()
+
+################################################################################
+# Methods
+
+_attribute = re.compile(r'''(\w+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''')
+
+def getBareID(obj_id):
+    '''
+    Removes the database prefix from a Kegg ID (i.e. cpd:C00001 --> C00001)
+    '''
+    return obj_id.split(':')[-1]
+
+def parseMap(htmlmap):
+    '''
+    Takes the html image map of a pathway and returns a list of MapArea
+    '''
+    areas = []
+    if not htmlmap:
+        return areas
+
+    for line in htmlmap.split('\n'):
+        line = line.strip()
+        if not line.startswith('<area'):
+            continue
+
+        attrs = {}
+        for m in _attribute.finditer(line):
+            value = [v for v in m.groups()[1:] if v is not None][0]
+            attrs[m.group(1).lower()] = value
+
+        if 'www_bget?' not in attrs.get('href', ''):
+            continue
+
+        try:
+            coords = [int(float(x)) for x in attrs['coords'].split(',')]
+        except (KeyError, ValueError):
+            logger.debug('Could not parse the area coordinates (%s)'%line)
+            continue
+
+        ids = attrs['href'].split('www_bget?')[1]
+        ids = [getBareID(x) for x in ids.replace(' ', '+').split('+') if x]
+
+        areas.append( MapArea(attrs.get('shape', 'rect').lower(), coords,
+                              ids) )
+
+    return areas
+
+def hexToRGB(color):
+    '''
+    Converts an html color (#RRGGBB) to a RGB tuple (0-1 floats)
+    '''
+    color = color.replace('%23', '').lstrip('#')
+    return tuple([int(color[i:i+2], 16)/255.0 for i in range(0, 6, 2)])
+
+def _rectMasks(img, coords):
+    '''
+    Returns the window of the rectangle and its inner and border masks
+    '''
+    x1, y1, x2, y2 = coords
+    h, w = img.shape[:2]
+    x1, x2 = max(0, min(x1, x2)), min(w, max(x1, x2) + 1)
+    y1, y2 = max(0, min(y1, y2)), min(h, max(y1, y2) + 1)
+
+    inner = np.ones((max(0, y2 - y1), max(0, x2 - x1)), dtype=bool)
+
+    border = inner.copy()
+    border[borderWidth:-borderWidth, borderWidth:-borderWidth] = False
+
+    return (slice(y1, y2), slice(x1, x2)), inner, border
+
+def _circleMasks(img, coords):
+    '''
+    Returns the window of the circle and its inner and border masks
+    '''
+    x, y, r = coords[:3]
+    h, w = img.shape[:2]
+    x1, x2 = max(0, x - r), min(w, x + r + 1)
+    y1, y2 = max(0, y - r), min(h, y + r + 1)
+
+    yy, xx = np.ogrid[y1:y2, x1:x2]
+    dist = np.sqrt((xx - x) ** 2 + (yy - y) ** 2)
+
+    inner = dist <= r
+    border = inner & (dist > r - borderWidth)
+
+    return (slice(y1, y2), slice(x1, x2)), inner, border
+
+def paintMap(png, htmlmap, colors, borders={}):
+    '''
+    Color a Kegg map picture
+    png: base map picture (png data)
+    htmlmap: html image map of the pathway (object coordinates)
+    colors: object ID --> html color (the background of the object)
+    borders: object ID --> html color (the border of the object)
+    Returns the colored picture (png data)
+    '''
+    return MapPainter(png, htmlmap).paint(colors, borders)
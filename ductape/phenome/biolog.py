@@ -8,7 +8,7 @@ Classes to handle Biolog data
 """
 from ductape import __email__
 from ductape.common.commonthread import CommonThread
-from ductape.common.utils import smooth, compress
+from ductape.common.utils import smooth, compress, xstr
 from matplotlib import cm
 from matplotlib import colors
 import Queue
@@ -74,6 +74,9 @@ class Well(object):
         self.replica = None
         self.strain = None
         self.zero = False
+        
+        # Fingerprint of the stored signals (and fitting settings)
+        self.fingerprint = None
 
     def getHeader(self):
         '''
@@ -206,11 +209,13 @@ class Well(object):
         '''
         from scipy.integrate import trapz
         from ductape.phenome.fitting import fitData, getFlex, getPlateau
+        from ductape.phenome.fitting import fitSettings
        
         if not self.compressed:
-            self.compress()
+            self.compress(span=fitSettings['compress'])
         if not self.smoothed:
-            self.smooth(window_len=11, window_type='blackman')
+            self.smooth(window_len=fitSettings['window_len'],
+                        window_type=fitSettings['window'])
             
         # Let's start with the easy ones!
         self.max = self.getMax()
@@ -812,6 +817,12 @@ class Experiment(object):
         self.purged = False
         
         self.discarded = set()
+        
+        # Clusters centroids (zero/nonzero), sorted by activity
+        self.centroids = {}
+        
+        # Wells whose signals have been trimmed
+        self.trimmed = []
     
     def _addPlate(self, plate):
         if plate.plate_id not in self.plates:
@@ -825,41 +836,171 @@ class Experiment(object):
     def _organize(self):
         '''
         Organize the whole experiment in a dictionary-based structure
+        
+        A columnar view is kept as well: each well is a row, with the
+        (plate, well, strain) group it belongs to and its parent SinglePlate
+        Replica means and purging are computed as group operations
         '''
-        for w in self.getWells(params=False):
-            if w.plate_id not in self.experiment:
-                self.experiment[w.plate_id] = {}
-                self.sumexp[w.plate_id] = {}
-            if w.well_id not in self.experiment[w.plate_id]:
-                self.experiment[w.plate_id][w.well_id] = {}
-                self.sumexp[w.plate_id][w.well_id] = {}
-            if w.strain not in self.experiment[w.plate_id][w.well_id]:
-                self.experiment[w.plate_id][w.well_id][w.strain] = {}
-                
-                fakeWell = Well(w.plate_id, w.well_id)
-                fakeWell.strain = w.strain 
-                self.sumexp[w.plate_id][w.well_id][w.strain] = fakeWell
-            
-            self.experiment[w.plate_id][w.well_id][w.strain][w.replica] = w
+        # Row --> Well, SinglePlate and group index
+        self._rows = []
+        self._rowplates = []
+        group = []
+        # Group index --> (plate_id, well_id, strain)
+        self._groups = []
+        dGroups = {}
+        
+        for plate_id in self.plates:
+            for strain, plates in self.plates[plate_id].strains.iteritems():
+                for splate in plates:
+                    for w in splate.getWells():
+                        self._rows.append(w)
+                        self._rowplates.append(splate)
+                        
+                        key = (w.plate_id, w.well_id, w.strain)
+                        if key not in dGroups:
+                            dGroups[key] = len(self._groups)
+                            self._groups.append(key)
+                        group.append(dGroups[key])
+                        
+                        self._addToExperiment(w)
+        
+        self._group = np.array(group, dtype=int)
+        self._alive = np.ones(len(self._rows), dtype=bool)
+        
+        self._buildIndex()
             
-        # For each well, if each replica has an activity, add its value
+        # For each well, if each replica has a parameter, add its mean value
         # to the averaged dictionary
-        for pid in self.sumexp:
-            for wid in self.sumexp[pid]:
-                for org in self.sumexp[pid][wid]:
-                    reps = self.experiment[pid][wid][org].keys()
-                    
-                    # Keep track of all mean parameters
-                    for param in Well('phony', 'phony').params + ['activity']:
-                        act = []
-                        for r in reps:
-                            if getattr(self.experiment[pid][wid][org][r], param) is None:
-                                break
-                            act.append(getattr(self.experiment[pid][wid][org][r], param))
-                        
-                        if len(act) > 0:
-                            mean = np.array(act).mean()
-                            setattr(self.sumexp[pid][wid][org], param, mean)
+        for param in Well('phony', 'phony').params + ['activity']:
+            means, valid = self._groupMean(param)
+            for gidx in np.nonzero(valid)[0]:
+                pid, wid, org = self._groups[gidx]
+                setattr(self.sumexp[pid][wid][org], param, means[gidx])
+    
+    def _buildIndex(self):
+        '''
+        Index the rows by plate, strain, category and zero-subtraction
+        '''
+        dPlate = {}
+        dStrain = {}
+        for i, w in enumerate(self._rows):
+            dPlate.setdefault(w.plate_id, []).append(i)
+            dStrain.setdefault(w.strain, []).append(i)
+        
+        self._index = {'plate':{}, 'strain':{}, 'category':{}}
+        for plate_id, rows in dPlate.iteritems():
+            self._index['plate'][plate_id] = np.array(rows, dtype=int)
+        for strain, rows in dStrain.iteritems():
+            self._index['strain'][strain] = np.array(rows, dtype=int)
+        
+        for categ, plates in self.category.iteritems():
+            self._index['category'][categ] = self._plateRows(plates)
+        
+        self._index['zero'] = self._plateRows(self.zeroPlates)
+        self._index['nonzero'] = self._plateRows(
+                                    set(self.plates).difference(self.zeroPlates))
+    
+    def _plateRows(self, plates):
+        '''
+        Sorted rows belonging to the provided plates
+        '''
+        rows = [self._index['plate'][plate_id] for plate_id in plates
+                if plate_id in self._index['plate']]
+        if len(rows) == 0:
+            return np.array([], dtype=int)
+        return np.sort(np.concatenate(rows))
+    
+    def _iterRows(self, rows, params=True):
+        '''
+        Generator to the wells of the selected rows (purged wells excluded)
+        if params is set to False, it just gives you the wells,
+        otherwise it calculates them
+        '''
+        for i in rows[self._alive[rows]]:
+            well = self._rows[i]
+            if not well.isParams() and params:
+                well.calculateParams()
+            
+            yield well
+    
+    def _addToExperiment(self, w):
+        if w.plate_id not in self.experiment:
+            self.experiment[w.plate_id] = {}
+            self.sumexp[w.plate_id] = {}
+        if w.well_id not in self.experiment[w.plate_id]:
+            self.experiment[w.plate_id][w.well_id] = {}
+            self.sumexp[w.plate_id][w.well_id] = {}
+        if w.strain not in self.experiment[w.plate_id][w.well_id]:
+            self.experiment[w.plate_id][w.well_id][w.strain] = {}
+            
+            fakeWell = Well(w.plate_id, w.well_id)
+            fakeWell.strain = w.strain 
+            self.sumexp[w.plate_id][w.well_id][w.strain] = fakeWell
+        
+        self.experiment[w.plate_id][w.well_id][w.strain][w.replica] = w
+    
+    def _column(self, param):
+        '''
+        Returns an array with the parameter value for each row
+        and a mask of the rows where the parameter is missing
+        '''
+        values = [getattr(w, param) for w in self._rows]
+        missing = np.array([x is None for x in values], dtype=bool)
+        values = np.array([x if x is not None else np.nan for x in values],
+                          dtype=float)
+        return values, missing
+    
+    def _groupMean(self, param, rows=None):
+        '''
+        Returns the mean of a parameter for each group (considering only the
+        selected rows) and a mask of the groups where the mean is valid
+        (i.e. all the replicas have the parameter)
+        '''
+        if rows is None:
+            rows = self._alive
+        values, missing = self._column(param)
+        ngroups = len(self._groups)
+        
+        counts = np.bincount(self._group[rows], minlength=ngroups)
+        nmissing = np.bincount(self._group[rows],
+                               weights=missing[rows].astype(float),
+                               minlength=ngroups)
+        sums = np.bincount(self._group[rows],
+                           weights=np.where(missing, 0, values)[rows],
+                           minlength=ngroups)
+        
+        valid = (counts > 0) & (nmissing == 0)
+        means = np.zeros(ngroups)
+        means[valid] = sums[valid] / counts[valid]
+        
+        return means, valid
+    
+    def _groupReduce(self, values, ufunc, fill):
+        '''
+        Apply an ufunc (i.e. np.minimum) to the alive rows of each group
+        '''
+        res = np.empty(len(self._groups))
+        res.fill(fill)
+        ufunc.at(res, self._group[self._alive], values[self._alive])
+        return res
+    
+    def _discardRows(self, rows):
+        '''
+        Remove the selected rows from the experiment
+        '''
+        for i in np.nonzero(rows)[0]:
+            w = self._rows[i]
+            plate, well, strain = self._groups[self._group[i]]
+            
+            self.discarded.add((plate, well, strain, w.replica))
+            
+            del self.experiment[plate][well][strain][w.replica]
+            del self._rowplates[i].data[well]
+            
+            logger.debug('Purged %s %s %s %d'%(plate, well,
+                                               strain, w.replica))
+        
+        self._alive &= ~rows
     
     def getMax(self):
         '''
@@ -961,9 +1102,7 @@ class Experiment(object):
         if params is set to False, it just gives you the wells,
         otherwise it calculates them
         '''
-        for well in self.getWells(params):
-            if well.plate_id in self.zeroPlates:
-                yield well
+        return self._iterRows(self._index['zero'], params)
                 
     def getNoZeroWells(self, params=True):
         '''
@@ -971,9 +1110,7 @@ class Experiment(object):
         if params is set to False, it just gives you the wells,
         otherwise it calculates them
         '''
-        for well in self.getWells(params):
-            if well.plate_id not in self.zeroPlates:
-                yield well
+        return self._iterRows(self._index['nonzero'], params)
                 
     def getCategoryWells(self, params=True):
         '''
@@ -982,12 +1119,26 @@ class Experiment(object):
         otherwise it calculates them
         '''
         for categ in self.categorder:
-            plates = self.category[categ]
-            wells = []
-            for well in self.getWells(params):
-                if well.plate_id in plates:
-                    wells.append(well)
-            yield (categ, wells)
+            rows = self._index['category'].get(categ, np.array([], dtype=int))
+            yield (categ, [well for well in self._iterRows(rows, params)])
+    
+    def getPlateWells(self, plate_id, params=True):
+        '''
+        Generator to get the single wells of a plate
+        if params is set to False, it just gives you the wells,
+        otherwise it calculates them
+        '''
+        rows = self._index['plate'].get(plate_id, np.array([], dtype=int))
+        return self._iterRows(rows, params)
+    
+    def getStrainWells(self, strain, params=True):
+        '''
+        Generator to get the single wells of a strain
+        if params is set to False, it just gives you the wells,
+        otherwise it calculates them
+        '''
+        rows = self._index['strain'].get(strain, np.array([], dtype=int))
+        return self._iterRows(rows, params)
     
     def getWells(self, params=True):
         '''
@@ -1026,13 +1177,16 @@ class Experiment(object):
                     for w in reps:
                         yield w
                         
-    def getAverageWells(self, org_id=None):
+    def getAverageWells(self, org_id=None, plates=None):
         '''
         Generator to the single average wells
         if org_id is provided, only the wells from that ID is provided
+        if plates is provided, only the wells from those plates are provided
         (plate IDs, well IDs and organism IDs are sorted)
         '''
-        for plate in sorted(self.sumexp.keys()):
+        if plates is None:
+            plates = self.sumexp.keys()
+        for plate in sorted(set(plates).intersection(self.sumexp.keys())):
             for well in sorted(self.sumexp[plate].keys()):
                 if org_id:
                     if org_id not in self.sumexp[plate][well]:continue
@@ -1063,6 +1217,7 @@ class Experiment(object):
         Set the maximum time for each well by using the lowest value in the
         experiment.
         Returns the trim time.
+        The wells that have been actually trimmed are stored in a list (trimmed)
 
         If trimTime is set, that time will be used
         '''
@@ -1081,6 +1236,8 @@ class Experiment(object):
                     to_del.add(time)
             for time in to_del:
                 del w.signals[time]
+            if len(to_del) > 0:
+                self.trimmed.append(w)
                 
         return mtime
     
@@ -1112,106 +1269,68 @@ class Experiment(object):
                 logger.error('Replica %d not present'%replica)
                 return False
             
-            for plate in self.experiment:
-                for well in self.experiment[plate]:
-                    for strain in self.experiment[plate][well]:
-                        if replica in self.experiment[plate][well][strain]:
-                            self.discarded.add((plate, well,
-                                                strain, replica))
-                            
-                            del self.experiment[plate][well][strain][replica]
-                            
-                            # TODO: simplify here
-                            rem_p = filter(lambda x: x.replica == replica,
-                                        self.plates[plate].strains[strain])[0]
-                            del rem_p.data[well]
-                            
-                            logger.debug('Purged %s %s %s %d'%(plate, well,
-                                                           strain, replica))
+            reps = np.array([w.replica == replica for w in self._rows],
+                            dtype=bool)
+            self._discardRows(self._alive & reps)
             
             return True
         
-        for plate in self.experiment:
-            for well in self.experiment[plate]:
-                for strain in self.experiment[plate][well]:  
-                    reps = self.experiment[plate][well][strain].values()
-                    act = np.array([x.activity for x in reps])
-                    
-                    if policy == 'keep-min' or policy == 'keep-min-one':
-                        m = act.min()
-                    
-                    if policy == 'keep-max' or policy == 'keep-max-one':
-                        m = act.max()
-                        
-                    # If a keep-one policy is on, choose the replica that
-                    # matches the policy as close as possible
-                    # (i.e. keep-min-one --> replica with smaller average signal)    
-                    if policy == 'keep-min-one' or policy == 'keep-max-one':
-                        candidates = filter(lambda x: x.activity == m, reps)
-                        if len(candidates) == 1:
-                            self.sumexp[plate][well][strain] = candidates[0]
-                        elif len(candidates) == 0:
-                            logger.critical('This shouldn\'t be possible!')
-                            return False
-                        else:
-                            # Keep the best replica according to the policy
-                            candidates = sorted(candidates, key=lambda x: x.area)
-                            if policy == 'keep-min-one':
-                                self.sumexp[plate][well][strain] = candidates[0]
-                                for x in candidates[1:]:
-                                    candidates.remove(x)
-                            else:
-                                self.sumexp[plate][well][strain] = candidates[-1]
-                                for x in candidates[:-1]:
-                                    candidates.remove(x)
-                                                                
-                    # Keep those replica distant at max delta from the
-                    # minimum-maximum
-                    if policy == 'keep-min' or policy == 'keep-max':
-                        if policy == 'keep-min':
-                            candidates = filter(lambda x: x.activity <= m + delta,
-                                                reps)
-                            if len(candidates) == 1:
-                                self.sumexp[plate][well][strain] = candidates[0]
-                            elif len(candidates) == 0:
-                                logger.critical('This shouldn\'t be possible!')
-                                return False
-                            else:
-                                # Keep the average activity
-                                self.sumexp[plate][well][strain].activity = np.array(
-                                                             [x.activity
-                                                              for x in candidates]
-                                                                 ).mean()
-                        else:
-                            candidates = filter(lambda x: x.activity >= m - delta,
-                                                reps)
-                            if len(candidates) == 1:
-                                self.sumexp[plate][well][strain] = candidates[0]
-                            elif len(candidates) == 0:
-                                logger.critical('This shouldn\'t be possible!')
-                                return False
-                            else:
-                                # Keep the average activity
-                                self.sumexp[plate][well][strain].activity = np.array(
-                                                             [x.activity
-                                                              for x in candidates]
-                                                                 ).mean()
-                    
-                    # Remove the outliers
-                    for w in reps:
-                        if w not in candidates:
-                            self.discarded.add((plate, well,
-                                                strain, w.replica))
-                            
-                            del self.experiment[plate][well][strain][w.replica]
-                            
-                            # TODO: simplify here
-                            rem_p = filter(lambda x: x.replica == w.replica,
-                                        self.plates[plate].strains[strain])[0]
-                            del rem_p.data[well]
-                            
-                            logger.debug('Purged %s %s %s %d'%(plate, well,
-                                                           strain, w.replica))
+        act, missing = self._column('activity')
+        
+        if policy == 'keep-min' or policy == 'keep-min-one':
+            m = self._groupReduce(act, np.minimum, np.inf)[self._group]
+        else:
+            m = self._groupReduce(act, np.maximum, -np.inf)[self._group]
+        
+        if policy == 'keep-min':
+            keep = self._alive & (act <= m + delta)
+        elif policy == 'keep-max':
+            keep = self._alive & (act >= m - delta)
+        else:
+            # If a keep-one policy is on, choose the replica that
+            # matches the policy as close as possible
+            # (i.e. keep-min-one --> replica with smaller area)
+            candidates = self._alive & (act == m)
+            
+            area, amissing = self._column('area')
+            area[amissing] = -np.inf
+            
+            # Candidates sorted by group, then area, then row
+            rows = np.nonzero(candidates)[0]
+            order = rows[np.lexsort((rows, area[rows], self._group[rows]))]
+            groups = self._group[order]
+            if policy == 'keep-min-one':
+                first = np.ones(len(order), dtype=bool)
+                first[1:] = groups[1:] != groups[:-1]
+            else:
+                first = np.ones(len(order), dtype=bool)
+                first[:-1] = groups[1:] != groups[:-1]
+            
+            keep = np.zeros(len(self._rows), dtype=bool)
+            keep[order[first]] = True
+        
+        # Each group should have at least one replica left
+        alive = np.bincount(self._group[self._alive],
+                            minlength=len(self._groups))
+        kept = np.bincount(self._group[keep], minlength=len(self._groups))
+        if ((alive > 0) & (kept == 0)).any():
+            logger.critical('This shouldn\'t be possible!')
+            return False
+        
+        # Single replica left: it becomes the average well
+        for i in np.nonzero(keep & (kept[self._group] == 1))[0]:
+            plate, well, strain = self._groups[self._group[i]]
+            self.sumexp[plate][well][strain] = self._rows[i]
+        
+        # More than one replica left: keep the average activity
+        if policy == 'keep-min' or policy == 'keep-max':
+            means, valid = self._groupMean('activity', keep)
+            for gidx in np.nonzero(kept > 1)[0]:
+                plate, well, strain = self._groups[gidx]
+                self.sumexp[plate][well][strain].activity = means[gidx]
+        
+        # Remove the outliers
+        self._discardRows(self._alive & ~keep)
             
         self.purged = True
         return True
@@ -1325,13 +1444,15 @@ class Experiment(object):
         
         return dParams, dWells
     
-    def elbowTest(self, nrange=range(2, 13)):
+    def elbowTest(self, nrange=range(2, 13), n_init=10, ncpus=1,
+                  silhouette=False):
         '''
         Perform an elbow test on the k-means clustering
         nrange should be a list with each n going to be used in the clusterization
+        Each n is tested in parallel using ncpus processes
+        If requested, the silhouette score is reported as well
         '''
-        from ductape.phenome.clustering import _kmeans
-        from ductape.phenome.clustering import getSseKmeans
+        from ductape.phenome.clustering import elbow
         from ductape.phenome.clustering import plotElbow
         
         params_labels = ['max', 'area', 'height', 'lag', 'slope']
@@ -1344,18 +1465,32 @@ class Experiment(object):
         
         X = np.array( params )
         
-        dSse = {}
-        for n_clust in nrange:
-            logger.info('K-means clusterization (k=%d)'%n_clust)
-            k_means = _kmeans(X, n_clust)
-            dSse[n_clust] = getSseKmeans(k_means, X)
+        logger.info('K-means clusterization (k=%s)'%
+                    ', '.join([str(n) for n in nrange]))
+        dElbow = elbow(X, nrange, n_init, ncpus, silhouette)
+        
+        for n_clust in sorted(dElbow):
+            sse, inertia, score = dElbow[n_clust]
+            if score is not None:
+                logger.info('k=%d, inertia=%.4f, silhouette=%.4f'%(n_clust,
+                                                                  inertia,
+                                                                  score))
+            else:
+                logger.info('k=%d, inertia=%.4f'%(n_clust, inertia))
         
-        plotElbow(dSse, params_labels)
+        plotElbow(dict([(n_clust, dElbow[n_clust][0])
+                        for n_clust in dElbow]), params_labels)
     
-    def clusterize(self, save_fig=False, n_clusters=10):
+    def clusterize(self, save_fig=False, n_clusters=10, n_init=10, ncpus=1,
+                   centroids={}):
         '''
         Perform the biolog data clusterizzation
         The data is divided in two chunks if Zero subtraction has been done
+        
+        n_init k-means restarts are run on ncpus processes; the centroids of
+        a previous run ('zero'/'nonzero' --> centroids sorted by activity) 
+        are used as an additional restart
+        The resulting centroids are stored in the same way (centroids)
         '''
         from ductape.phenome.clustering import mean, kmeans, plotClusters
         
@@ -1395,7 +1530,9 @@ class Experiment(object):
         if self.zero and len(dParams['zero']) >= 1:
             xZero = [x for x in dParams['zero']]
             m_z_labels = mean(xZero)
-            k_z_labels = kmeans(xZero, n_clusters)
+            k_z_labels, k_z_centers = kmeans(xZero, n_clusters,
+                                             n_init=n_init, ncpus=ncpus,
+                                    centroids=centroids.get('zero', None))
         
         if self.zero  and len(dParams['zero']) >= 1:
             m_z_nclusters = len(np.unique(m_z_labels))
@@ -1426,6 +1563,8 @@ class Experiment(object):
                     who.activity = dConvert[k_z_labels[i]]
                     k_z_activity.append(dConvert[k_z_labels[i]])
                 
+                self.centroids['zero'] = [k_z_centers[t[0]] for t in mArea]
+                
                 # Intermediate plot
                 if save_fig:
                     plotClusters(xZero, k_z_activity,
@@ -1441,7 +1580,9 @@ class Experiment(object):
         if len(dParams['nonzero']) >= 1:
             xNonZero = [x for x in dParams['nonzero']]
             m_nz_labels = mean(xNonZero)
-            k_nz_labels = kmeans(xNonZero, n_clusters)
+            k_nz_labels, k_nz_centers = kmeans(xNonZero, n_clusters,
+                                               n_init=n_init, ncpus=ncpus,
+                                    centroids=centroids.get('nonzero', None))
         
         if len(dParams['nonzero']) >= 1:
             m_nz_nclusters = len(np.unique(m_nz_labels))
@@ -1471,6 +1612,8 @@ class Experiment(object):
                     who = dWells['nonzero'][i]
                     who.activity = dConvert[k_nz_labels[i]]
                     k_nz_activity.append(dConvert[k_nz_labels[i]])
+                
+                self.centroids['nonzero'] = [k_nz_centers[t[0]] for t in mArea]
                     
                 # Intermediate plot
                 if save_fig:
@@ -2401,6 +2544,100 @@ class CalcParams(object):
         
         return True
 
+class ExportPlate(object):
+    '''
+    Writes a single plate (YAML or JSON), to be run in parallel
+    signals: the signals of the plate, as taken from the DB
+    Returns a tuple (plate_id, strain, replica, file name or None)
+    '''
+    def __init__(self, signals, json=False):
+        self.signals = signals
+        self.json = json
+        
+    def __call__(self):
+        plate = [p for p in getSinglePlatesFromSignals(self.signals)][0]
+        
+        if self.json:
+            fname = '%s_%s_%s.json'%(plate.plate_id, plate.strain,
+                                     plate.replica)
+        else:
+            fname = '%s_%s_%s.yml'%(plate.plate_id, plate.strain,
+                                    plate.replica)
+        
+        try:
+            if self.json:
+                data = toJSON(plate)
+            else:
+                data = toYAML(plate)
+        except ValueError:
+            return plate.plate_id, plate.strain, plate.replica, None
+        
+        fout = open(fname, 'w')
+        fout.write(data)
+        fout.close()
+        
+        return plate.plate_id, plate.strain, plate.replica, fname
+
+class PhenomeArrays(object):
+    '''
+    Class PhenomeArrays
+    Collects the phenomic experiments in a columnar form and saves them
+    in a single numpy file (npz)
+    
+    Times and signals of all the experiments are concatenated: those
+    of the experiment i are times[offsets[i]:offsets[i+1]]
+    '''
+    columns = ['plate_id', 'well_id', 'org_id', 'replica', 'model', 'source']
+    params = ['activity', 'min', 'max', 'height', 'plateau', 'slope', 'lag',
+              'area', 'v', 'y0']
+    
+    def __init__(self):
+        from array import array
+        
+        self.data = dict([(x, []) for x in self.columns])
+        self.values = array('d')
+        self.times = array('d')
+        self.signals = array('d')
+        self.offsets = array('l', [0])
+        
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def add(self, wells):
+        '''
+        Add some experiments (signals rows, as taken from the DB)
+        '''
+        for w in wells:
+            for column in self.columns:
+                self.data[column].append(getattr(w, column))
+            self.values.extend([getattr(w, x) if getattr(w, x) is not None
+                                else np.nan
+                                for x in self.params])
+            if w.times:
+                self.times.extend([float(x) for x in w.times.split('_')])
+                self.signals.extend([float(x) for x in w.signals.split('_')])
+            self.offsets.append(len(self.times))
+    
+    def save(self, fname):
+        '''
+        Save all the experiments
+        '''
+        arrays = {}
+        for column in self.columns:
+            if column == 'replica':
+                arrays[column] = np.array(self.data[column], dtype=int)
+            else:
+                arrays[column] = np.array([xstr(x)
+                                           for x in self.data[column]])
+        arrays['params'] = np.array(self.params)
+        arrays['values'] = np.frombuffer(self.values,
+                                dtype=float).reshape(-1, len(self.params))
+        arrays['times'] = np.frombuffer(self.times, dtype=float)
+        arrays['signals'] = np.frombuffer(self.signals, dtype=float)
+        arrays['offsets'] = np.array(self.offsets, dtype=np.int64)
+        
+        np.savez_compressed(fname, **arrays)
+
 class BiologCluster(CommonThread):
     '''
     Class BiologCluster
@@ -2413,7 +2650,7 @@ class BiologCluster(CommonThread):
     
     def __init__(self,experiment,
                  save_fig_clusters=False, force_params=False, n_clusters=10,
-                 elbow=False,
+                 elbow=False, n_init=10, ncpus=1, centroids={},
                  queue=Queue.Queue()):
         CommonThread.__init__(self,queue)
         # Experiment
@@ -2422,6 +2659,13 @@ class BiologCluster(CommonThread):
         # Number of clusters?
         self.n_clusters = int(n_clusters)
         
+        # K-means restarts and parallelization
+        self.n_init = int(n_init)
+        self.ncpus = int(ncpus)
+        
+        # Previous run centroids (warm start)
+        self.centroids = centroids
+        
         # Save clusters figure?
         self.save_fig = bool(save_fig_clusters)
         
@@ -2463,9 +2707,26 @@ class BiologCluster(CommonThread):
             return
         
         self.updateStatus()
-        self.exp.clusterize(self.save_fig, self.n_clusters)
+        self.exp.clusterize(self.save_fig, self.n_clusters,
+                            n_init=self.n_init, ncpus=self.ncpus,
+                            centroids=self.centroids)
+
+def getFingerprint(times, signals):
+    '''
+    Takes the times and signals strings as stored in the DB and returns
+    their fingerprint, which includes the curve fitting settings
+    Two wells with the same fingerprint will have the same parameters
+    '''
+    import hashlib
+    from ductape.phenome.fitting import fitSettings
+    
+    settings = '_'.join(['%s=%s'%(k, fitSettings[k])
+                         for k in sorted(fitSettings)])
+    
+    return hashlib.sha1('|'.join([str(times), str(signals),
+                                  settings])).hexdigest()
 
-def getSinglePlates(binput, nonmean=False):
+def getSinglePlates(binput, nonmean=False, fingerprints=None):
     '''
     Takes signals or wells from the storage and transforms them into SinglePlates
     NB it is a generator
@@ -2474,17 +2735,22 @@ def getSinglePlates(binput, nonmean=False):
         return
     
     if hasattr(binput[0], "times"):
-        for splate in getSinglePlatesFromSignals(binput):
+        for splate in getSinglePlatesFromSignals(binput, fingerprints):
             yield splate
     else:
         for splate in getSinglePlatesFromParameters(binput, nonmean):
             yield splate
             
-def getSinglePlatesFromSignals(signals):
+def getSinglePlatesFromSignals(signals, fingerprints=None):
     '''
     Takes a bunch of signals taken from the DB and returns a series of 
     SinglePlates objects
     NB it is a generator
+    
+    If fingerprints is provided (plate_id, well_id, org_id, replica) --> 
+    fingerprint, the wells whose signals have not changed since their 
+    parameters were calculated are loaded without their signals, while the
+    others are loaded without their (stale) parameters
     '''
     dExp = {}
     
@@ -2492,8 +2758,26 @@ def getSinglePlatesFromSignals(signals):
         plate_id, well_id, org_id, replica = (well.plate_id, well.well_id,
                                               well.org_id, well.replica)
         
-        lT = well.times.split('_')
-        lS = well.signals.split('_')
+        fingerprint = getFingerprint(well.times, well.signals)
+        
+        if fingerprints is not None:
+            # Wells with parameters but no fingerprint were analyzed before
+            # fingerprints were introduced: their parameters are kept
+            stored = fingerprints.get((plate_id, well_id, org_id, replica),
+                                      fingerprint)
+            params = [getattr(well, param, None)
+                      for param in Well('fake', 'fake').params]
+            dirty = (stored != fingerprint or
+                     len(filter(lambda x: x is not None, params)) == 0)
+        else:
+            dirty = True
+        
+        if dirty:
+            lT = well.times.split('_')
+            lS = well.signals.split('_')
+        else:
+            lT = []
+            lS = []
         
         if plate_id not in dExp:
             dExp[plate_id] = {}
@@ -2511,7 +2795,13 @@ def getSinglePlatesFromSignals(signals):
         for i in range(len(lT)):
             dExp[plate_id][org_id][replica].data[well_id].addSignal(float(lT[i]),
                                                                     float(lS[i]))
-            
+        
+        dExp[plate_id][org_id][replica].data[well_id].fingerprint = fingerprint
+        
+        # Stale parameters are not loaded
+        if dirty and fingerprints is not None:
+            continue
+        
         # Add the activity - if present
         if hasattr(well, "activity"):
             dExp[plate_id][org_id][replica].data[well_id].activity = well.activity
@@ -2598,14 +2888,14 @@ def getSinglePlatesFromParameters(wells, nonmean=False):
                     splate.data[well_id].activity = np.array(dExp[plate_id][org_id][well_id]).mean()
                 yield splate
                 
-def getPlates(signals, nonmean=False):
+def getPlates(signals, nonmean=False, fingerprints=None):
     '''
     Takes a bunch of signals taken from the DB and returns a series of 
     Plates objects
     NB it is a generator
     '''
     dExp = {}
-    for splate in getSinglePlates(signals, nonmean):
+    for splate in getSinglePlates(signals, nonmean, fingerprints):
         if splate.plate_id not in dExp:
             dExp[splate.plate_id] = Plate(splate.plate_id)
         dExp[splate.plate_id].addData(splate.strain, splate)
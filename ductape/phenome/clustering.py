@@ -7,8 +7,10 @@ Phenome library
 biolog data clustering functions
 Many thanks to the scikits.learn team for the exhaustive documentation
 """
+from ductape.common.utils import slice_it
 from itertools import product
-from sklearn.cluster import KMeans, MeanShift, estimate_bandwidth
+from sklearn.cluster import KMeans, MiniBatchKMeans, MeanShift, \
+    estimate_bandwidth
 import numpy as np
 import logging
 import warnings
@@ -17,32 +19,56 @@ __author__ = "Marco Galardini"
 
 logger = logging.getLogger('ductape.clustering')
 
+# Above this number of wells MiniBatchKMeans is used
+MINIBATCH_WELLS = 100000
+MINIBATCH_SIZE = 1000
+# Maximum number of wells used for the MeanShift bandwidth estimation
+BANDWIDTH_SAMPLES = 10000
+# Maximum number of wells used for the silhouette score
+SILHOUETTE_SAMPLES = 5000
+
 def plotElbow(d, param_labels):
+    '''
+    d: n_clusters --> mean squared error of each parameter
+    The cubic interpolation needs at least 4 points, otherwise a linear
+    one is used
+    '''
     from scipy.interpolate import interp1d
     import matplotlib.pyplot as plt
     
+    nclusters = sorted(d.keys())
+    if len(nclusters) == 0:
+        logger.warning('No elbow test results, skipping the plot')
+        return
+    
     logger.info('Saving elbow test plots')
     
-    x_new = np.linspace(-1, max(d.keys()), 100)
+    if len(nclusters) >= 4:
+        kind = 'cubic'
+    else:
+        kind = 'linear'
+    
+    x_new = np.linspace(-1, max(nclusters), 100)
     
     figidx = 1
     
-    figsize = (len(d[d.keys()[0]][0])/2) + (len(d[d.keys()[0]][0])%2)  
+    figsize = (len(param_labels)/2) + (len(param_labels)%2)  
     
     fig = plt.figure(figsize=(3.5*figsize, 8))
     fig.clf()
-    for j in range(len(d[d.keys()[0]][0])):
+    for j in range(len(param_labels)):
         ax = fig.add_subplot(2, figsize, figidx)
         
         figidx += 1
         
-        diffs = {}
-        for i in d:
-            diffs[i] = np.array([p[j] for p in d[i]]).mean()
+        diffs = [d[i][j] for i in nclusters]
         
-        inter = interp1d(d.keys(), [diffs[i] for i in d], bounds_error=False,
-                     kind='cubic')
-        ax.plot(d.keys(),[diffs[i] for i in d],'o', x_new, inter(x_new),'-')
+        if len(nclusters) > 1:
+            inter = interp1d(nclusters, diffs, bounds_error=False,
+                         kind=kind)
+            ax.plot(nclusters, diffs,'o', x_new, inter(x_new),'-')
+        else:
+            ax.plot(nclusters, diffs,'o')
         ax.set_ylabel('Sum of squared errors')
         ax.set_xlabel('Num. clusters')
         ax.set_title(param_labels[j])
@@ -51,7 +77,6 @@ def plotElbow(d, param_labels):
     fig.savefig('elbow.png',dpi=300)
 
 def plotClusters(X, labels, params=None, method='', prefix='clusters'):
-    from ductape.common.utils import slice_it
     import matplotlib.pyplot as plt
     import matplotlib.cm as cm
     
@@ -96,9 +121,11 @@ def plotClusters(X, labels, params=None, method='', prefix='clusters'):
     fig.suptitle('Clusters (%s, %s): %d' % (prefix, method, n_clusters_))
     fig.savefig('%s_%s.png'%(prefix,method),dpi=300)
 
-def mean(X, save_fig=False, params_labels=None, prefix='clusters'):
+def mean(X, save_fig=False, params_labels=None, prefix='clusters',
+         n_samples=BANDWIDTH_SAMPLES):
     '''
     Compute clustering with MeanShift
+    The bandwidth is estimated on a random subsample of n_samples wells
     '''
     logger.debug('Calculating MeanShift clusters using %d parameters'%len(X[0]))
     
@@ -106,7 +133,12 @@ def mean(X, save_fig=False, params_labels=None, prefix='clusters'):
     
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        bandwidth = estimate_bandwidth(X, quantile=0.2)
+        if len(X) > n_samples:
+            bandwidth = estimate_bandwidth(X, quantile=0.2,
+                                           n_samples=n_samples,
+                                           random_state=0)
+        else:
+            bandwidth = estimate_bandwidth(X, quantile=0.2)
     
         ms = MeanShift(bandwidth=bandwidth, bin_seeding=True)
         ms.fit(X)
@@ -124,46 +156,173 @@ def mean(X, save_fig=False, params_labels=None, prefix='clusters'):
     
     return labels
 
-def _kmeans(X, n_clusters):
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        
-        try:
-            k_means = KMeans(init='random', k=n_clusters, n_init=100,
-                             max_iter=1000)
-        except:
-            k_means = KMeans(init='random', n_clusters=n_clusters, n_init=100,
-                             max_iter=1000)
-        k_means.fit(X)
-        
-    return k_means
+class RunKMeans(object):
+    '''
+    A batch of k-means restarts, to be run in parallel
+    Returns the fitted KMeans object (or None if the fit failed)
+    '''
+    def __init__(self, X, n_clusters, n_init=10, init='k-means++',
+                 seed=None, max_iter=1000):
+        self.X = X
+        self.n_clusters = n_clusters
+        self.n_init = n_init
+        self.init = init
+        self.seed = seed
+        self.max_iter = max_iter
+    
+    def __call__(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            
+            try:
+                if len(self.X) > MINIBATCH_WELLS:
+                    k_means = MiniBatchKMeans(init=self.init,
+                                              n_clusters=self.n_clusters,
+                                              n_init=self.n_init,
+                                              max_iter=self.max_iter,
+                                              batch_size=MINIBATCH_SIZE,
+                                              random_state=self.seed)
+                else:
+                    try:
+                        k_means = KMeans(init=self.init, k=self.n_clusters,
+                                         n_init=self.n_init,
+                                         max_iter=self.max_iter,
+                                         random_state=self.seed)
+                    except:
+                        k_means = KMeans(init=self.init,
+                                         n_clusters=self.n_clusters,
+                                         n_init=self.n_init,
+                                         max_iter=self.max_iter,
+                                         random_state=self.seed)
+                k_means.fit(self.X)
+            except Exception as e:
+                logger.debug('K-means failed (%s)'%e)
+                return None
+            
+        return k_means
+
+def _kmeans(X, n_clusters, n_init=10, ncpus=1, centroids=None):
+    '''
+    Returns the best (lowest inertia) k-means over n_init restarts
+    (k-means++ initialization), split among ncpus processes
+    
+    If the centroids of a previous run are provided (and they are compatible)
+    a run initialized with them is added to the restarts
+    With more than MINIBATCH_WELLS wells MiniBatchKMeans is used
+    '''
+    from ductape.common.commonmultiprocess import runParallel
+    
+    X = np.array( X )
+    
+    ncpus = max(1, min(int(ncpus), int(n_init)))
+    tasks = []
+    seed = 0
+    for chunk in slice_it(range(int(n_init)), cols=ncpus):
+        if len(chunk) == 0:
+            continue
+        tasks.append( RunKMeans(X, n_clusters, n_init=len(chunk), seed=seed) )
+        seed += 1
+    
+    if centroids is not None:
+        centroids = np.array( centroids )
+        if centroids.shape == (n_clusters, X.shape[1]):
+            logger.debug('K-means restart from previous centroids')
+            tasks.append( RunKMeans(X, n_clusters, n_init=1, init=centroids) )
+        else:
+            logger.debug('Previous centroids are not compatible, '+
+                         'skipping the warm start')
+    
+    best = None
+    for k_means in runParallel(tasks, ncpus):
+        if k_means is None:
+            continue
+        if best is None or k_means.inertia_ < best.inertia_:
+            best = k_means
+    
+    if best is None:
+        raise ValueError('K-means clustering failed')
+    
+    return best
 
 def getSseKmeans(k_means, X):
     '''
-    Returns a list of sums of squared errors
+    Returns the matrix of squared errors (wells x parameters)
+    '''
+    X = np.array( X )
+    
+    return (X - k_means.cluster_centers_[k_means.labels_]) ** 2
+
+class RunElbow(object):
+    '''
+    A single k of the elbow test, to be run in parallel
+    Returns a tuple with the k, the mean squared error of each parameter,
+    the inertia and the silhouette score (the last three are None if the 
+    clusterization failed; the silhouette is None if not requested)
     '''
-    import math
+    def __init__(self, X, n_clusters, n_init=10, silhouette=False,
+                 n_samples=SILHOUETTE_SAMPLES):
+        self.X = X
+        self.n_clusters = n_clusters
+        self.n_init = n_init
+        self.silhouette = silhouette
+        self.n_samples = n_samples
     
-    sse=[]
-    for j in range(len(k_means.labels_)):
-        c = k_means.labels_[j]
-        ref = k_means.cluster_centers_[c]
-        dist = []
-        for k in range(len(ref)):
-            dist.append(math.pow(X[j][k] - ref[k], 2))
-        sse.append(dist)
+    def __call__(self):
+        k_means = RunKMeans(self.X, self.n_clusters, n_init=self.n_init,
+                            seed=0)()
+        if k_means is None:
+            return self.n_clusters, None, None, None
+        
+        sse = getSseKmeans(k_means, self.X).mean(axis=0)
+        
+        score = None
+        if self.silhouette:
+            from sklearn.metrics import silhouette_score
+            try:
+                if len(self.X) > self.n_samples:
+                    score = silhouette_score(self.X, k_means.labels_,
+                                             sample_size=self.n_samples,
+                                             random_state=0)
+                else:
+                    score = silhouette_score(self.X, k_means.labels_)
+            except Exception as e:
+                logger.debug('Silhouette score failed (%s)'%e)
         
-    return sse
+        return self.n_clusters, sse, k_means.inertia_, score
 
-def kmeans(X, n_clusters=10, save_fig=False, params_labels=None, prefix='clusters'):
+def elbow(X, nrange=range(2, 13), n_init=10, ncpus=1, silhouette=False):
+    '''
+    Elbow test: each k in nrange is clusterized in parallel (ncpus)
+    Returns a dictionary n_clusters --> (mean squared error of each parameter,
+                                          inertia, silhouette score)
+    The silhouette score is computed on a random subsample of the wells
+    '''
+    from ductape.common.commonmultiprocess import runParallel
+    
+    X = np.array( X )
+    
+    tasks = [RunElbow(X, n_clust, n_init, silhouette) for n_clust in nrange]
+    
+    d = {}
+    for n_clust, sse, inertia, score in runParallel(tasks, ncpus):
+        if sse is None:
+            logger.warning('K-means clusterization failed (k=%d)'%n_clust)
+            continue
+        d[n_clust] = (sse, inertia, score)
+    
+    return d
+
+def kmeans(X, n_clusters=10, save_fig=False, params_labels=None, prefix='clusters',
+           n_init=10, ncpus=1, centroids=None):
     '''
     Compute clustering with KMeans
+    Returns the labels and the clusters centroids
     '''
     logger.debug('Calculating KMean clusters using %d parameters'%len(X[0]))
     
     X = np.array( X )
     
-    k_means = _kmeans(X, n_clusters)
+    k_means = _kmeans(X, n_clusters, n_init, ncpus, centroids)
     
     labels = k_means.labels_
     
@@ -176,5 +335,5 @@ def kmeans(X, n_clusters=10, save_fig=False, params_labels=None, prefix='cluster
     
     logger.debug('Found %d clusters with KMeans algorithm'%n_clusters_)
     
-    return labels
+    return labels, k_means.cluster_centers_
     
\ No newline at end of file
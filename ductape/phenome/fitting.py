@@ -78,6 +78,15 @@ __author__ = "Marco Galardini"
 
 logger = logging.getLogger('ductape.fitting')
 
+# Signal preprocessing applied before the curve fitting
+# These settings are part of the wells fingerprint: any change here
+# (or a version bump after a change in fitData) forces the parameters
+# recalculation of the stored wells
+fitSettings = {'version': 1,
+               'compress': 3,
+               'window_len': 11,
+               'window': 'blackman'}
+
 def logistic(x, A, u, d, v, y0):
     '''
     Logistic growth model
@@ -8,11 +8,16 @@ SQLite Database wrappers
 """
 # TODO: decorator to catch SQLite exceptions
 
-from ductape.storage.SQLite.dbstrings import dbcreate, dbboost
+from ductape.storage.SQLite.dbstrings import dbcreate, dbboost, dbupgrade
 from ductape.common.utils import get_span
 import logging
+import numpy as np
+import os
+import re
 import sqlite3
+import struct
 import time
+import zlib
 
 __author__ = "Marco Galardini"
 
@@ -21,6 +26,28 @@ __author__ = "Marco Galardini"
 
 logger = logging.getLogger('ductape.database')
 
+################################################################################
+# Constants
+
+# Parameters that can be used in the Biolog activity matrix
+matrixParams = ('activity', 'zero', 'min', 'max', 'height', 'plateau',
+                'slope', 'lag', 'area', 'v', 'y0')
+
+# Biolog activity matrices cache
+# (project, parameter, category, pathway) --> (project state, wells, orgs, matrix)
+_matrices = {}
+
+# Reaction x organism incidence cache
+# project --> (project state, reactions, organisms, matrix)
+_incidences = {}
+
+# Kegg tables to be exported/imported (in this order)
+keggTables = ('ko', 'compound', 'pathway', 'reaction', 'rpair', 'ko_react',
+              'comp_path', 'react_comp', 'react_path', 'rpair_react')
+
+# Kegg dump format version
+keggDumpVersion = 2
+
 ################################################################################
 # Classes
 
@@ -76,6 +103,8 @@ class DBBase(object):
             with self.connection:
                 for command in dbcreate.split(';'):
                     self.connection.execute(command+';')
+            
+            self.upgrade()
                     
             # Import Biolog data
             b = Biolog(self.dbname)
@@ -87,6 +116,22 @@ class DBBase(object):
 
         return True
     
+    def upgrade(self):
+        '''
+        Add the tables introduced after the project creation (if needed)
+        Returns True/False
+        '''
+        try:
+            with self.connection:
+                for command in dbupgrade.split(';'):
+                    self.connection.execute(command+';')
+        except sqlite3.Error as e:
+            logger.error('Could not upgrade the database!')
+            logger.error(e)
+            return False
+        
+        return True
+    
     def boost(self):
         '''
         The current connection is boosted
@@ -94,6 +139,26 @@ class DBBase(object):
         with self.connection as conn:
             conn.execute(dbboost)
             
+    def _getState(self):
+        '''
+        Project file modification signature (None for in-memory DBs)
+        The file change counter (header offset 24) is incremented by SQLite
+        at each commit (rollback journal mode), unlike the size or the
+        modification time
+        '''
+        try:
+            st = os.stat(self.dbname)
+            f = open(self.dbname, 'rb')
+            try:
+                header = f.read(28)
+            finally:
+                f.close()
+        except (OSError, IOError):
+            return None
+        if len(header) < 28:
+            return (st.st_ino, 0)
+        return (st.st_ino, struct.unpack('>I', header[24:28])[0])
+    
     def query(self, sql):
         '''
         Launch a query and returns a generator with each row 
@@ -280,6 +345,27 @@ class Project(DBBase):
         else:
             return True
     
+    def setSetting(self, name, value):
+        '''
+        Set a project setting (i.e. the search backend)
+        '''
+        with self.connection as conn:
+            conn.execute('''insert or replace into project_setting
+                            values (?,?);''', [name, value,])
+    
+    def getSetting(self, name, default=None):
+        '''
+        Get a project setting (default if it was never set)
+        '''
+        with self.connection as conn:
+            cursor=conn.execute('''select value from project_setting
+                                   where name=?;''', [name,])
+        
+        data = cursor.fetchall()
+        if len(data) == 0:
+            return default
+        return data[0][0]
+    
 class Organism(DBBase):
     '''
     Class Organism
@@ -626,25 +712,44 @@ class Genome(DBBase):
                                 [prot_id,])
         return bool(cursor.fetchall()[0][0])
     
+    def _getMissingProts(self, conn, prots):
+        '''
+        Returns the prot_ids absent from the protein table
+        The check is done with a single join against a temporary table
+        '''
+        conn.execute('create temp table if not exists checkprot (prot_id TEXT);')
+        conn.execute('delete from checkprot;')
+        conn.executemany('insert into checkprot values (?);',
+                         [(prot_id,) for prot_id in prots])
+        cursor = conn.execute('''select distinct c.prot_id
+                                from checkprot c
+                                left join protein p on c.prot_id=p.prot_id
+                                where p.prot_id is null;''')
+        missing = [x[0] for x in cursor]
+        conn.execute('delete from checkprot;')
+        
+        return missing
+    
     def areProts(self, prots):
         '''
         Returns False if at least one prot_id is absent
         '''
         with self.connection as conn:
-            for prot_id in prots:
-                cursor=conn.execute('select count(*) from protein where prot_id=?;',
-                                [prot_id,])
-                if not bool(cursor.fetchall()[0][0]):
-                    logger.warning('Protein %s is not present yet!'%prot_id)
-                    return False
+            missing = self._getMissingProts(conn, prots)
+        
+        if len(missing) > 0:
+            logger.warning('Protein %s is not present yet!'%missing[0])
+            return False
         
         return True
     
-    def addProteome(self, org_id, pfile):
+    def addProteome(self, org_id, pfile, chunk=10000, compress=False):
         '''
         Add a bunch of proteins belonging to org_id (which must be present!)
         The proteins are present in a fasta file, if a particular protein had 
         already been added, no warnings are thrown
+        The proteins are inserted in bulk (chunk proteins at a time)
+        If compress is set, the sequences are stored as zlib BLOBs
         An exception is raised if the org_id is not present in the database
         '''
         from Bio import SeqIO
@@ -658,11 +763,26 @@ class Genome(DBBase):
         self.boost()
         
         i = 0
+        rows = []
         with self.connection as conn:
             for s in SeqIO.parse(open(pfile),'fasta'):
-                conn.execute('insert or replace into protein values (?,?,?,?);',
-                         [s.id,org_id,s.description,str(s.seq),])
+                if compress:
+                    rows.append( (s.id,org_id,s.description,
+                                  encodeSequence(str(s.seq))) )
+                else:
+                    rows.append( (s.id,org_id,s.description,str(s.seq)) )
                 i += 1
+                
+                if len(rows) >= chunk:
+                    conn.executemany(
+                        'insert or replace into protein values (?,?,?,?);',
+                        rows)
+                    rows = []
+            
+            if len(rows) > 0:
+                conn.executemany(
+                        'insert or replace into protein values (?,?,?,?);',
+                        rows)
         
         logger.debug('Added %d protein to organism %s'%(i,org_id))
         
@@ -682,7 +802,9 @@ class Genome(DBBase):
         if len(data) == 0:
             return Row([], cursor.description)
         else:
-            return Row(data[0], cursor.description)
+            prot = Row(data[0], cursor.description)
+            prot.sequence = decodeSequence(prot.sequence)
+            return prot
         
     def getAllProt(self, org_id):
         '''
@@ -698,7 +820,9 @@ class Genome(DBBase):
                                 [org_id,])
             
         for res in cursor:
-            yield Row(res, cursor.description)
+            prot = Row(res, cursor.description)
+            prot.sequence = decodeSequence(prot.sequence)
+            yield prot
             
     def getRecords(self, org_id):
         '''
@@ -808,28 +932,29 @@ class Genome(DBBase):
         A check on each protein is performed
         An exception is raised if at least one protein is missing
         '''
-        # Check if all the proteins are present
-        prots = [prot_id for ps in orthologs.values() for prot_id in ps]
-        for prot_id in prots:
-            if not self.isProt(prot_id):
-                logger.warning('Protein %s is not present yet!'%prot_id)
-                raise Exception('This Protein (%s) is not present yet!'%prot_id)
-        
         self.boost()
         
+        rows = [(group_id, prot_id)
+                for group_id, prots in orthologs.iteritems()
+                for prot_id in prots]
+        
+        with self.connection as conn:
+            # Check if all the proteins are present
+            missing = self._getMissingProts(conn,
+                                            [prot_id for _, prot_id in rows])
+        if len(missing) > 0:
+            logger.warning('Protein %s is not present yet!'%missing[0])
+            raise Exception('This Protein (%s) is not present yet!'%missing[0])
+        
         # Go for it!
-        i = 0
         with self.connection as conn:
-            for group_id in orthologs:
-                for prot_id in orthologs[group_id]:
-                    conn.execute('insert or replace into ortholog values (?,?);',
-                             [group_id,prot_id,])
-                i += 1
+            conn.executemany('insert or replace into ortholog values (?,?);',
+                             rows)
         
         oProj = Project(self.dbname)
         oProj.donePanGenome()
         
-        logger.debug('Added %d orthologous groups'%(i))
+        logger.debug('Added %d orthologous groups'%(len(orthologs)))
     
     def getPanGenome(self):
         '''
@@ -893,6 +1018,41 @@ class Genome(DBBase):
         # TODO
         raise NotImplementedError
     
+    def getPanGenomeCategories(self):
+        '''
+        Returns a dictionary with the orthologous groups of each
+        pangenome category (core, dispensable, accessory, unique),
+        computed with a single query
+        category --> set(group_id, ...)
+        '''
+        # How many organisms are present?
+        oCheck = Organism(self.dbname)
+        nOrgs = oCheck.howMany()
+        
+        query = '''
+                select distinct group_id, count(distinct org_id) orgs
+                from ortholog o, protein r
+                where o.prot_id = r.prot_id
+                group by group_id;
+                '''
+        
+        with self.connection as conn:
+            cursor = conn.execute(query)
+        
+        categories = {'core':set(), 'dispensable':set(),
+                      'accessory':set(), 'unique':set()}
+        for group_id, orgs in cursor:
+            if orgs == nOrgs:
+                categories['core'].add(group_id)
+            if orgs < nOrgs:
+                categories['dispensable'].add(group_id)
+            if orgs < nOrgs and orgs > 1:
+                categories['accessory'].add(group_id)
+            if orgs == 1:
+                categories['unique'].add(group_id)
+        
+        return categories
+    
     def _getCore(self):
         '''
         Base method to get the core genome
@@ -1115,7 +1275,8 @@ class Kegg(DBBase):
             conn.execute('delete from react_comp;')
             conn.execute('delete from react_path;')
             conn.execute('delete from rpair_react;')
-        
+            conn.execute('delete from pathmap;')
+
         # "Update" the release number
         proj = Project(self.dbname)
         proj.setKegg(None)
@@ -1124,146 +1285,159 @@ class Kegg(DBBase):
         '''
         Generator for kegg data export
         All the relevant data for the kegg db is extracted
+        
+        Format version 2: tab separated, first field is the table name;
+        backslashes, tabs and newlines are escaped, None is \\N
         '''
+        yield '# DuctApe generated dump of the Kegg data'
+        yield '\t'.join(['version', str(keggDumpVersion)])
+        
         # Release?
         try:
             oCheck = Project(self.dbname)
             if oCheck.isKegg():
-                yield '\t'.join(['release', str(oCheck.kegg)])
+                yield '\t'.join(['release', escapeField(oCheck.kegg)])
             else:
-                yield '\t'.join(['release', str(None)])
+                yield '\t'.join(['release', escapeField(None)])
         except:
             # Testing bugfix for old DBs
-            yield '\t'.join(['release', str(None)])
-        
-        with self.connection as conn:
-            cursor=conn.execute('select * from ko;')
-            
-        for res in cursor:
-            yield '\t'.join(['ko'] + 
-                            [str(res[cursor.description.index(field)]) 
-                             for field in cursor.description])
-        
-        with self.connection as conn:
-            cursor=conn.execute('select * from compound;')
-            
-        for res in cursor:
-            yield '\t'.join(['compound'] + 
-                            [str(res[cursor.description.index(field)]) 
-                             for field in cursor.description])
-    
-        with self.connection as conn:
-            conn.text_factory = str
-            
-            cursor=conn.execute('select * from pathway;')
-            
-        # Exceptionally ugly exception
-        # Newlines chars in html maps are converted in DUCTAPENEWLINEHERE
-        # Which is stupid, but for know it will suffice
-        for res in cursor:
-            yield '\t'.join(['pathway'] + 
-                            [str(res[cursor.description.index(field)]).replace('\n','DUCTAPENEWLINEHERE').replace('\t','  ') 
-                             for field in cursor.description])
-    
-        with self.connection as conn:
-            cursor=conn.execute('select * from reaction;')
-            
-        for res in cursor:
-            yield '\t'.join(['reaction'] + 
-                            [str(res[cursor.description.index(field)]) 
-                             for field in cursor.description])
-            
-        with self.connection as conn:
-            cursor=conn.execute('select * from rpair;')
-            
-        for res in cursor:
-            yield '\t'.join(['rpair'] + 
-                            [str(res[cursor.description.index(field)]) 
-                             for field in cursor.description])
-        
-        with self.connection as conn:
-            cursor=conn.execute('select * from ko_react;')
-            
-        for res in cursor:
-            yield '\t'.join(['ko_react'] + 
-                            [str(res[cursor.description.index(field)]) 
-                             for field in cursor.description])
+            yield '\t'.join(['release', escapeField(None)])
         
-        with self.connection as conn:
-            cursor=conn.execute('select * from comp_path;')
-            
-        for res in cursor:
-            yield '\t'.join(['comp_path'] + 
-                            [str(res[cursor.description.index(field)]) 
-                             for field in cursor.description])
-            
-        with self.connection as conn:
-            cursor=conn.execute('select * from react_comp;')
-            
-        for res in cursor:
-            yield '\t'.join(['react_comp'] + 
-                            [str(res[cursor.description.index(field)]) 
-                             for field in cursor.description])
-    
-        with self.connection as conn:
-            cursor=conn.execute('select * from react_path;')
-            
-        for res in cursor:
-            yield '\t'.join(['react_path'] + 
-                            [str(res[cursor.description.index(field)]) 
-                             for field in cursor.description])
-            
-        with self.connection as conn:
-            cursor=conn.execute('select * from rpair_react;')
+        for table in keggTables:
+            with self.connection as conn:
+                conn.text_factory = str
+                cursor=conn.execute('select * from %s;'%table)
             
-        for res in cursor:
-            yield '\t'.join(['rpair_react'] + 
-                            [str(res[cursor.description.index(field)]) 
-                             for field in cursor.description])
+            for res in cursor:
+                yield '\t'.join([table] + [escapeField(x) for x in res])
     
-    def importKegg(self, infile):
+    def importKegg(self, infile, chunk=10000):
         '''
         Imports the content of the file object inside the kegg tables
-        In case of errors there should be a rollback
+        Rows are inserted in bulk (chunk rows at a time), all in a single
+        transaction, so in case of errors there is a rollback
+        Older dumps (without version line) are supported as well
+        Returns the number of imported entries
         '''
         self.boost()
         
+        release = None
+        version = 1
+        imported = 0
+        # (table, number of fields) --> rows
+        buffers = {}
+        
         with self.connection as conn:
             conn.text_factory = str
             
             for l in infile:
                 if l.lstrip().startswith('#'):continue
-            
+                
                 s = l.rstrip('\n').split('\t')
-                # Special case #1
+                if s[0] == 'version':
+                    version = int(s[1])
+                    if version > keggDumpVersion:
+                        raise ValueError('Unsupported Kegg dump version %d'%
+                                         version)
+                    continue
+                
+                if version == 1:
+                    s = unescapeLegacy(s)
+                elif '\\' in l:
+                    s = [s[0]] + [unescapeField(x) for x in s[1:]]
+                
                 if s[0] == 'release':
-                    if s[1] == 'None':
-                        release = None
-                    else:
-                        release = s[1]
-                else:
-                    # Special case #2
-                    if s[0] == 'pathway':
-                        for i in range(len(s)):
-                            s[i] = s[i].replace('DUCTAPENEWLINEHERE','\n')
-                    
-                    for i in range(len(s)):
-                        if s[i] == 'None':
-                            s[i] = None
-                    
-                    values = ''
-                    for i in range(len(s[1:])):
-                        values += '''?, '''
-                    values = values.rstrip(', ')
-                    query = '''insert or replace into %s values (%s);'''%(s[0], values)
-                    
-                    conn.execute(query, [str(x) for x in s[1:]])
+                    release = s[1]
+                    continue
+                
+                if s[0] not in keggTables:
+                    raise ValueError('Unknown Kegg table %s'%s[0])
+                
+                key = (s[0], len(s) - 1)
+                rows = buffers.setdefault(key, [])
+                rows.append(s[1:])
+                imported += 1
+                
+                if len(rows) >= chunk:
+                    self._bulkInsert(conn, key, rows)
+                    buffers[key] = []
+            
+            for key, rows in buffers.iteritems():
+                self._bulkInsert(conn, key, rows)
         
         # Last step
         if release:
             proj = Project(self.dbname)
-            proj.setKegg(release)            
+            proj.setKegg(release)
+        
+        return imported
     
+    def _bulkInsert(self, conn, key, rows):
+        '''
+        Insert (or replace) the rows in the desired table
+        key: (table, number of fields)
+        '''
+        if len(rows) == 0:
+            return
+        
+        table, nfields = key
+        query = '''insert or replace into %s values (%s);'''%(table,
+                                            ', '.join(['?'] * nfields))
+        conn.executemany(query, rows)
+
+    def copyKegg(self, source):
+        '''
+        Copies the kegg tables (and the pathway maps) from another
+        project (or any SQLite file with the kegg tables) directly,
+        without passing through a dump file
+        The source DB is attached and only read
+        Returns the number of copied entries
+        '''
+        self.boost()
+
+        release = None
+        copied = 0
+
+        self.connection.execute('attach database ? as source;', (source,))
+        try:
+            try:
+                release = self.connection.execute(
+                        'select kegg from source.project;').fetchone()
+                if release:
+                    release = release[0]
+            except sqlite3.OperationalError:
+                # Not a project: a bare kegg DB
+                release = None
+
+            with self.connection as conn:
+                # Older projects may lack some tables (i.e. pathmap)
+                present = set([x[0] for x in conn.execute('''select name
+                                    from source.sqlite_master
+                                    where type='table';''')])
+                for table in keggTables + ('pathmap',):
+                    if table not in present:
+                        logger.warning('Table %s not in %s, skipping'%
+                                       (table, source))
+                        continue
+                    sourcecols = set([x[1] for x in
+                        conn.execute('pragma source.table_info(%s);'%table)])
+                    columns = ', '.join(['`%s`'%x[1] for x in
+                        conn.execute('pragma main.table_info(%s);'%table)
+                        if x[1] in sourcecols])
+                    cursor = conn.execute('''insert or replace into main.%s
+                                    (%s) select %s from source.%s;'''%
+                                    (table, columns, columns, table))
+                    copied += cursor.rowcount
+        finally:
+            self.connection.execute('detach database source;')
+
+        # Last step
+        if release:
+            proj = Project(self.dbname)
+            proj.setKegg(release)
+
+        return copied
+
     def addDraftKOs(self, ko):
         '''
         Add new KOs (skipping if they are already present)
@@ -2026,6 +2200,42 @@ class Kegg(DBBase):
                 conn.execute('update pathmap set png = ? where path_id = ?;',
                                  (sqlite3.Binary(pic.read()),path_id,))
     
+    def setPathPics(self, pathpic):
+        '''
+        Store the base maps pictures
+        the input is a dictionary
+        path_id --> png data
+        '''
+        self.boost()
+
+        with self.connection as conn:
+            for path_id, pic in pathpic.iteritems():
+                conn.execute('insert or ignore into pathmap (path_id) values (?);',
+                             (path_id,))
+                conn.execute('update pathmap set png = ? where path_id = ?;',
+                             (sqlite3.Binary(pic),path_id,))
+
+    def getPathPics(self, path_ids=None):
+        '''
+        Get the stored base maps pictures
+        Returns a dictionary path_id --> png data
+        (only the pathways in path_ids, if provided)
+        '''
+        with self.connection as conn:
+            cursor=conn.execute('''select path_id, png from pathmap
+                                   where png is not null;''')
+
+        if path_ids is not None:
+            path_ids = set(path_ids)
+
+        d = {}
+        for res in cursor:
+            if path_ids is not None and res[0] not in path_ids:
+                continue
+            d[res[0]] = str(res[1])
+
+        return d
+
     def getPathway(self, path_id):
         if not self.isPathway(path_id):
             return None
@@ -2038,6 +2248,18 @@ class Kegg(DBBase):
             
         return Row(cursor.fetchall()[0], cursor.description)
     
+    def getPathwaysHTML(self):
+        '''
+        Get the html image map of all the pathways
+        Returns a dictionary path_id --> html
+        '''
+        with self.connection as conn:
+            conn.text_factory = str
+            cursor=conn.execute('''select path_id, html from pathway
+                                   where html is not null;''')
+        
+        return dict([(res[0], res[1]) for res in cursor])
+    
     def getAllPathways(self, onlymain=False):
         '''
         Generator to the single pathways
@@ -2678,53 +2900,94 @@ class Kegg(DBBase):
         for res in cursor:
             yield Row(res, cursor.description)
     
-    def getExclusiveReactions(self, orgs=set()):
+    def getReactionIncidence(self):
         '''
-        Return the number of reactions ID exclusive to a list of organisms
-        return a dictionary of org_id --> set(re_id, ...)
-        if the organisms list is empty, all the organisms are queried
+        Reaction x organism incidence matrix
+        Returns (reactions, organisms, matrix), where matrix is a boolean
+        numpy array (reactions x organisms)
+        Built with a single query and cached until the project changes
         '''
+        state = self._getState()
+        if state is not None and self.dbname in _incidences:
+            istate, reacts, orgs, matrix = _incidences[self.dbname]
+            if istate == state:
+                return reacts, orgs, matrix.copy()
+        
         organism = Organism(self.dbname)
-        if len(orgs) == 0:
-            orgs = [org.org_id for org in organism.getAll()]
-        else:
-            orgs = set(orgs)
-            for org_id in orgs:
-                if not organism.isOrg(org_id):
-                    logger.warning('Organism %s is not present yet!'%org_id)
-                    raise Exception('This Organism (%s) is not present yet!'%org_id)
+        orgs = sorted([org.org_id for org in organism.getAll()])
+        
+        query = '''
+                select distinct re_id, org_id
+                from protein p, mapko m, ko_react k
+                where p.prot_id=m.prot_id
+                and m.ko_id=k.ko_id;
+                '''
+        
+        with self.connection as conn:
+            cursor=conn.execute(query)
+        pairs = cursor.fetchall()
+        
+        reacts = sorted(set([x[0] for x in pairs]))
+        rindex = dict([(re_id, i) for i, re_id in enumerate(reacts)])
+        oindex = dict([(org_id, i) for i, org_id in enumerate(orgs)])
+        
+        matrix = np.zeros((len(reacts), len(orgs)), dtype=bool)
+        if len(pairs) > 0:
+            matrix[[rindex[x[0]] for x in pairs],
+                   [oindex[x[1]] for x in pairs]] = True
         
-        react = {}
+        if state is not None:
+            _incidences[self.dbname] = (state, reacts, orgs, matrix)
         
+        return reacts, orgs, matrix.copy()
+    
+    def _getOrgsIncidence(self, orgs=set()):
+        '''
+        Reaction incidence restricted to some organisms (all if empty)
+        An exception is raised if an organism is not present
+        '''
+        reacts, allorgs, matrix = self.getReactionIncidence()
+        
+        if len(orgs) == 0:
+            return reacts, allorgs, matrix
+        
+        orgs = sorted(set(orgs))
         for org_id in orgs:
-            query = '''
-                    select distinct re_id
-                    from protein p, mapko m, ko_react k
-                    where org_id=?
-                    and p.prot_id=m.prot_id
-                    and m.ko_id=k.ko_id;
-                    '''
-            
-            with self.connection as conn:
-                cursor=conn.execute(query,[org_id,])
-            
-                r = set()
-                for res in cursor:
-                    r.add(res[0])
-                react[org_id] = r
+            if org_id not in allorgs:
+                logger.warning('Organism %s is not present yet!'%org_id)
+                raise Exception('This Organism (%s) is not present yet!'%org_id)
         
-        out = {}
+        return reacts, orgs, matrix[:, [allorgs.index(x) for x in orgs]]
+    
+    def _getReactions(self, reacts, mask):
+        '''
+        Reactions IDs selected by a boolean mask
+        '''
+        return set([reacts[i] for i in np.flatnonzero(mask)])
+    
+    def getOrgsReactions(self, orgs=set()):
+        '''
+        Return the reactions ID of each organism
+        return a dictionary of org_id --> set(re_id, ...)
+        if the organisms list is empty, all the organisms are queried
+        '''
+        reacts, orgs, matrix = self._getOrgsIncidence(orgs)
         
-        # Thanks to @balpha for this one
-        # http://stackoverflow.com/a/2042394/1237531
-        from itertools import combinations
-        all_orgs = set(react.keys())
-        for i in combinations(react, len(react)-1):
-            this_orgs = set(i)
-            org_id = all_orgs.difference(this_orgs).pop()
-            out[org_id] = react[org_id].difference(*[react[x] for x in this_orgs])            
-           
-        return out
+        return dict([(org_id, self._getReactions(reacts, matrix[:, j]))
+                     for j, org_id in enumerate(orgs)])
+    
+    def getExclusiveReactions(self, orgs=set()):
+        '''
+        Return the number of reactions ID exclusive to a list of organisms
+        return a dictionary of org_id --> set(re_id, ...)
+        if the organisms list is empty, all the organisms are queried
+        '''
+        reacts, orgs, matrix = self._getOrgsIncidence(orgs)
+        
+        exclusive = matrix & (matrix.sum(axis=1) == 1)[:, np.newaxis]
+        
+        return dict([(org_id, self._getReactions(reacts, exclusive[:, j]))
+                     for j, org_id in enumerate(orgs)])
     
     def getExclusiveReactionsMutants(self, ref_id, muts=set()):
         '''
@@ -2751,9 +3014,8 @@ class Kegg(DBBase):
             kind = organism.getOrg(mut_id).mkind
             
             if kind == 'insertion':
-                ref = self.getExclusiveReactions( [ref_id] )[ref_id]
-                mut = self.getExclusiveReactions( [mut_id] )[mut_id].union(ref)
-                out[mut_id] = mut.difference(ref)
+                react = self.getOrgsReactions( [ref_id, mut_id] )
+                out[mut_id] = react[mut_id].difference(react[ref_id])
             else:
                 # prot_id --> [re_id, ...]
                 ref_react = {}
@@ -2818,6 +3080,113 @@ class Kegg(DBBase):
                 racc.difference(rcore, runi),
                 runi.difference(rcore, racc))
             
+    def getOrgsStats(self):
+        '''
+        Kegg mapping statistics of each organism, from a single query
+        Returns a dictionary org_id --> Row (prots, mapped, ko, path,
+        react, unireact), same values as the howMany* methods
+        '''
+        query = '''
+                select o.org_id, coalesce(p.prots, 0) prots,
+                    coalesce(m.mapped, 0) mapped, coalesce(m.ko, 0) ko,
+                    coalesce(pa.path, 0) path,
+                    coalesce(r.react, 0) react,
+                    coalesce(r.unireact, 0) unireact
+                from organism o
+                left join (select org_id, count(*) prots
+                    from protein
+                    group by org_id) p
+                on o.org_id = p.org_id
+                left join (select org_id, count(distinct p.prot_id) mapped,
+                        count(distinct ko_id) ko
+                    from mapko m, protein p
+                    where m.prot_id = p.prot_id
+                    group by org_id) m
+                on o.org_id = m.org_id
+                left join (select org_id, count(k.re_id) react,
+                        count(distinct k.re_id) unireact
+                    from mapko m, protein p, ko_react k
+                    where m.prot_id = p.prot_id
+                    and m.ko_id = k.ko_id
+                    group by org_id) r
+                on o.org_id = r.org_id
+                left join (select org_id, count(distinct path_id) path
+                    from mapko m, protein p, ko_react k, react_path r
+                    where m.prot_id = p.prot_id
+                    and m.ko_id = k.ko_id
+                    and k.re_id = r.re_id
+                    group by org_id) pa
+                on o.org_id = pa.org_id;
+                '''
+        
+        with self.connection as conn:
+            cursor=conn.execute(query)
+        
+        stats = {}
+        for res in cursor:
+            row = Row(res, cursor.description)
+            stats[row.org_id] = row
+        
+        return stats
+    
+    def getPanGenomeStats(self):
+        '''
+        Kegg mapping statistics of each pangenome category
+        (core, dispensable, accessory, unique), from three queries
+        Returns a dictionary category --> Row (size, mapped, ko, path,
+        react, unireact, ereact), same values as the howMany* methods
+        and getExclusiveReactionsPanGenome
+        '''
+        genome = Genome(self.dbname)
+        categories = genome.getPanGenomeCategories()
+        
+        with self.connection as conn:
+            gkos = conn.execute('''select distinct o.group_id, ko_id
+                                from mapko m, ortholog o
+                                where m.prot_id = o.prot_id;''').fetchall()
+            greacts = conn.execute('''select distinct o.group_id, re_id
+                                from mapko m, ortholog o, ko_react k
+                                where m.prot_id = o.prot_id
+                                and m.ko_id = k.ko_id;''').fetchall()
+            gpaths = conn.execute('''select distinct o.group_id, path_id
+                                from mapko m, ortholog o, ko_react k,
+                                    react_path r
+                                where m.prot_id = o.prot_id
+                                and m.ko_id = k.ko_id
+                                and k.re_id = r.re_id;''').fetchall()
+        
+        # Reactions of each category
+        reacts = {}
+        for kind, groups in categories.iteritems():
+            reacts[kind] = set([re_id for group_id, re_id in greacts
+                                if group_id in groups])
+        exclusive = {'core':reacts['core'].difference(reacts['dispensable']),
+            'dispensable':reacts['dispensable'].difference(reacts['core']),
+            'accessory':reacts['accessory'].difference(reacts['core'],
+                                                       reacts['unique']),
+            'unique':reacts['unique'].difference(reacts['core'],
+                                                 reacts['accessory'])}
+        
+        fields = ('size', 'mapped', 'ko', 'path', 'react', 'unireact',
+                  'ereact')
+        
+        stats = {}
+        for kind, groups in categories.iteritems():
+            kos = [(group_id, ko_id) for group_id, ko_id in gkos
+                   if group_id in groups]
+            values = (len(groups),
+                      len(set([x[0] for x in kos])),
+                      len(set([x[1] for x in kos])),
+                      len(set([path_id for group_id, path_id in gpaths
+                               if group_id in groups])),
+                      len([1 for group_id, re_id in greacts
+                           if group_id in groups]),
+                      len(reacts[kind]),
+                      len(exclusive[kind]))
+            stats[kind] = Row(values, [(x,) for x in fields])
+        
+        return stats
+    
     def howManyMapped(self, org_id=None, pangenome=''):
         '''
         Returns the number of proteins mapped to kegg
@@ -3365,6 +3734,8 @@ class Biolog(DBBase):
             conn.execute('delete from biolog_exp_det;')
             conn.execute('delete from biolog_purged_exp;')
             conn.execute('delete from biolog_purged_exp_det;')
+            conn.execute('delete from biolog_exp_hash;')
+            conn.execute('delete from biolog_centroid;')
             
         oOrg = Organism(self.dbname)
         oOrg.resetPhenomes()
@@ -3836,6 +4207,10 @@ class Biolog(DBBase):
             for w in wells:
                 conn.execute(query,
                               [w.plate_id,w.well_id,w.strain,w.replica,])
+                conn.execute('''delete from biolog_exp_hash 
+                            where plate_id=? and well_id=? and org_id=?
+                            and replica=?;''',
+                            [w.plate_id,w.well_id,w.strain,w.replica,])
     
     def delWells(self, explist):
         '''
@@ -3852,6 +4227,11 @@ class Biolog(DBBase):
                             where plate_id=? and well_id=? and org_id=?
                             and replica=?;''',
                             [w.plate_id,w.well_id,w.strain,w.replica,])
+                
+                conn.execute('''delete from biolog_exp_hash 
+                            where plate_id=? and well_id=? and org_id=?
+                            and replica=?;''',
+                            [w.plate_id,w.well_id,w.strain,w.replica,])
             conn.commit()
                 
     def delOrg(self, org_id):
@@ -3874,6 +4254,10 @@ class Biolog(DBBase):
             conn.execute('''delete from biolog_purged_exp_det 
                         where org_id=?;''',
                         [org_id,])
+            
+            conn.execute('''delete from biolog_exp_hash 
+                        where org_id=?;''',
+                        [org_id,])
         
         org = Organism(self.dbname)
         org.setPhenomeStatus(org_id, 'none')    
@@ -4089,6 +4473,80 @@ class Biolog(DBBase):
         except:
             return None
     
+    def getActivityMatrix(self, param='activity', category=None,
+                          path_id=None):
+        '''
+        Mean value of a parameter (default: activity index) for each
+        well (rows) and organism (columns), using a single query
+        category and path_id restrict the wells to a biolog category
+        and to the compounds of a Kegg pathway
+        Returns a tuple: wells (list of Row: plate_id, well_id, co_id),
+        organisms (list of IDs), matrix (numpy array, NaN if missing)
+        The results are kept until the project file changes
+        '''
+        if param not in matrixParams:
+            logger.warning('Unknown parameter %s'%param)
+            return None
+        
+        key = (os.path.abspath(self.dbname), param, category, path_id)
+        state = self._getState()
+        if state is not None and key in _matrices:
+            mstate, wells, orgs, matrix = _matrices[key]
+            if mstate == state:
+                return wells, orgs, matrix.copy()
+        
+        query = '''select e.plate_id, e.well_id, b.co_id, e.org_id,
+                   avg(e.%s) value
+                   from biolog_exp e, biolog b
+                   where e.plate_id = b.plate_id
+                   and e.well_id = b.well_id
+                   and e.%s is not null'''%(param, param)
+        args = []
+        if category is not None:
+            query += ''' and b.category = ?'''
+            args.append(category)
+        if path_id is not None:
+            query += ''' and 'cpd:' || b.co_id in
+                        (select co_id from comp_path where path_id = ?)'''
+            args.append(path_id)
+        query += ''' group by e.plate_id, e.well_id, e.org_id
+                    order by e.plate_id, e.well_id, e.org_id;'''
+        
+        with self.connection as conn:
+            cursor=conn.execute(query, args)
+            
+        wells = []
+        dwells = {}
+        dorgs = {}
+        values = []
+        for res in cursor:
+            r = Row(res, cursor.description)
+            if (r.plate_id, r.well_id) not in dwells:
+                dwells[(r.plate_id, r.well_id)] = len(wells)
+                wells.append(r)
+            if r.org_id not in dorgs:
+                dorgs[r.org_id] = None
+            values.append( (dwells[(r.plate_id, r.well_id)], r.org_id,
+                            r.value) )
+        
+        orgs = sorted(dorgs.keys())
+        for i in range(len(orgs)):
+            dorgs[orgs[i]] = i
+            
+        matrix = np.empty((len(wells), len(orgs)))
+        matrix.fill(np.nan)
+        for i, org_id, value in values:
+            matrix[i, dorgs[org_id]] = value
+        
+        # Each row describes a well, not a single experiment
+        for w in wells:
+            del w.org_id, w.value
+        
+        if state is not None:
+            _matrices[key] = (state, wells, orgs, matrix)
+        
+        return wells, orgs, matrix.copy()
+    
     def getAvgActivityEachOrg(self, plate_id, well_id):
         '''
         Get the average activity for a particular experiment
@@ -4260,6 +4718,30 @@ class Biolog(DBBase):
         for res in cursor:
             yield Row(res, cursor.description)
     
+    def getAllWellsDetails(self, byorg=True):
+        '''
+        Get all the wells from the storage, with the biolog informations
+        (chemical, category, moa, co_id)
+        Sorted by organism, plate, well and replica (if byorg is set) or
+        by plate, well, replica and organism
+        '''
+        if byorg:
+            order = 'e.org_id, e.plate_id, e.well_id, e.replica'
+        else:
+            order = 'e.plate_id, e.well_id, e.replica, e.org_id'
+        
+        with self.connection as conn:
+            cursor=conn.execute('''select e.*, b.chemical, b.category,
+                                   b.moa, b.co_id
+                                   from biolog_exp e
+                                   left join biolog b
+                                   on e.plate_id = b.plate_id
+                                   and e.well_id = b.well_id
+                                   order by %s;'''%order)
+        
+        for res in cursor:
+            yield Row(res, cursor.description)
+    
     def getDistinctWells(self, replica=False):
         '''
         Get the distinct wells identifiers (if replica=True, replica aware)
@@ -4352,22 +4834,29 @@ class Biolog(DBBase):
         for res in cursor:
             yield Row(res, cursor.description)
     
-    def getAllSignals(self):
+    def getAllSignals(self, ordered=False):
         '''
         Get all the signals from the storage
-        '''
-        with self.connection as conn:
-            cursor=conn.execute('''select b.plate_id, b.well_id, b.org_id,
-                                          b.replica, b1.times, b1.signals,
-                                          b.activity, b.min, b.max, b.height,
-                                          b.plateau, b.slope, b.lag, b.area,
-                                          b.v, b.y0,
-                                          b.model, b.source
-                                   from biolog_exp_det b1, biolog_exp b
-                                   where b.plate_id=b1.plate_id
-                                   and b.well_id=b1.well_id
-                                   and b.org_id=b1.org_id
-                                   and b.replica=b1.replica;''')
+        If ordered is set, the signals of each plate (plate_id, org_id,
+        replica) are returned contiguously
+        '''
+        query = '''select b.plate_id, b.well_id, b.org_id,
+                          b.replica, b1.times, b1.signals,
+                          b.activity, b.min, b.max, b.height,
+                          b.plateau, b.slope, b.lag, b.area,
+                          b.v, b.y0,
+                          b.model, b.source
+                   from biolog_exp_det b1, biolog_exp b
+                   where b.plate_id=b1.plate_id
+                   and b.well_id=b1.well_id
+                   and b.org_id=b1.org_id
+                   and b.replica=b1.replica'''
+        if ordered:
+            query += ''' order by b.plate_id, b.org_id, b.replica,
+                        b.well_id'''
+        
+        with self.connection as conn:
+            cursor=conn.execute(query + ';')
         
         for res in cursor:
             yield Row(res, cursor.description)
@@ -4385,16 +4874,91 @@ class Biolog(DBBase):
                                    and b.well_id=b1.well_id
                                    and b.org_id=b1.org_id
                                    and b.replica=b1.replica
-                                   and (activity=null and min=null
-                                       and max=null and height=null
-                                       and plateau=null and slope=null
-                                       and lag=null and area=null
-                                       and v=null and y0=null
-                                       and model=null and source=null);''')
+                                   and (activity is null and min is null
+                                       and max is null and height is null
+                                       and plateau is null and slope is null
+                                       and lag is null and area is null
+                                       and v is null and y0 is null
+                                       and model is null and source is null);''')
         
         for res in cursor:
             yield Row(res, cursor.description)
+    
+    def getFingerprints(self):
+        '''
+        Returns a dictionary with the fingerprint of the signals used to
+        calculate the parameters of each well
+        (plate_id, well_id, org_id, replica) --> fingerprint
+        '''
+        with self.connection as conn:
+            cursor=conn.execute('''select plate_id, well_id, org_id, replica,
+                                          fingerprint
+                                   from biolog_exp_hash;''')
+        
+        return dict( ((x[0], x[1], x[2], x[3]), x[4]) for x in cursor )
+    
+    def setFingerprints(self, wells):
+        '''
+        Store the fingerprint of the signals used to calculate the parameters
+        Input: a series of Well objects (those without fingerprint are skipped)
+        '''
+        query = '''insert or replace into biolog_exp_hash
+                        (plate_id, well_id, org_id, replica, fingerprint)
+                        values (?,?,?,?,?);'''
+        
+        self.boost()
+        
+        with self.connection as conn:
+            conn.executemany(query,
+                             [(w.plate_id, w.well_id, w.strain, w.replica,
+                               w.fingerprint)
+                              for w in wells
+                              if w.fingerprint is not None])
       
+    def getCentroids(self):
+        '''
+        Get the clusters centroids of the last clusterization
+        Returns a dictionary 'zero'/'nonzero' --> [centroids sorted by activity]
+        '''
+        with self.connection as conn:
+            cursor=conn.execute('''select zero, activity, centroid
+                                   from biolog_centroid
+                                   order by zero, activity;''')
+        
+        centroids = {}
+        for res in cursor:
+            c = Row(res, cursor.description)
+            if c.zero:
+                z = 'zero'
+            else:
+                z = 'nonzero'
+            centroids[z] = centroids.get(z, [])
+            centroids[z].append([float(x) for x in c.centroid.split('_')])
+        
+        return centroids
+    
+    def setCentroids(self, centroids):
+        '''
+        Store the clusters centroids of the last clusterization
+        Input: a dictionary 'zero'/'nonzero' --> [centroids sorted by activity]
+        '''
+        self.boost()
+        
+        with self.connection as conn:
+            for z in centroids:
+                if z == 'zero':
+                    izero = 1
+                else:
+                    izero = 0
+                conn.execute('delete from biolog_centroid where zero=?;',
+                             [izero,])
+                conn.executemany('''insert into biolog_centroid
+                                    (zero, activity, centroid)
+                                    values (?,?,?);''',
+                                 [(izero, act,
+                                   '_'.join([repr(float(x)) for x in c]))
+                                  for act, c in enumerate(centroids[z])])
+    
     def getParamsSources(self):
         '''
         Generator to the distinct sources for the parameters calculation
@@ -4653,3 +5217,61 @@ class Biolog(DBBase):
                                 and replica = ?;''',[well.plate_id, well.well_id,
                                                   well.org_id, well.replica,])
         return restored
+
+################################################################################
+# Methods
+
+_escaped = re.compile(r'\\(.)', re.DOTALL)
+_unescapes = {'t':'\t', 'n':'\n', 'r':'\r'}
+
+def escapeField(value):
+    '''
+    Dump field escaping: backslashes, tabs and newlines are escaped
+    and None becomes \\N
+    '''
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n',
+                                        '\\n').replace('\r', '\\r')
+
+def encodeSequence(sequence):
+    '''
+    Protein sequence compression (zlib BLOB)
+    '''
+    return sqlite3.Binary(zlib.compress(sequence))
+
+def decodeSequence(sequence):
+    '''
+    Reverts encodeSequence; plain sequences are returned as they are
+    '''
+    if isinstance(sequence, buffer):
+        return zlib.decompress(sequence)
+    return sequence
+
+def _unescape(match):
+    return _unescapes.get(match.group(1), match.group(1))
+
+def unescapeField(value):
+    '''
+    Reverts escapeField
+    '''
+    if value == '\\N':
+        return None
+    if '\\' not in value:
+        return value
+    
+    return _escaped.sub(_unescape, value)
+
+def unescapeLegacy(fields):
+    '''
+    Unescape the fields of an old Kegg dump (no version line)
+    '''
+    if fields[0] == 'pathway':
+        fields = [x.replace('DUCTAPENEWLINEHERE','\n') for x in fields]
+    
+    return [None if x == 'None' else x for x in fields]
@@ -1,4 +1,27 @@
 dbboost='''PRAGMA cache_size = 20000;'''
+# Tables added after the first releases: they are created on demand
+# so that older projects can be upgraded transparently
+dbupgrade='''
+CREATE TABLE IF NOT EXISTS biolog_exp_hash (
+    "plate_id" TEXT NOT NULL,
+    "well_id" TEXT NOT NULL,
+    "org_id" TEXT NOT NULL,
+    "replica" INTEGER NOT NULL,
+    "fingerprint" TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS "biologexphash_id" on biolog_exp_hash (plate_id ASC, well_id ASC, org_id ASC, replica ASC);
+CREATE TABLE IF NOT EXISTS biolog_centroid (
+    "zero" INTEGER NOT NULL,
+    "activity" INTEGER NOT NULL,
+    "centroid" TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS "biologcentroid_id" on biolog_centroid (zero ASC, activity ASC);
+CREATE TABLE IF NOT EXISTS project_setting (
+    "name" TEXT NOT NULL,
+    "value" TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS "projectsetting_id" on project_setting (name ASC);
+'''
 dbcreate='''
 CREATE TABLE project (
     "name" TEXT NOT NULL,
@@ -38,7 +38,7 @@ echo -e $green"Single organism"$reset
 
 /usr/bin/python dape -v clear --keep-org || die "/usr/bin/python dape -v clear"
 sleep 5
-/usr/bin/python dape -v import kegg.tsv || die "/usr/bin/python dape -v import"
+/usr/bin/python dape -v import kegg.tsv.gz || die "/usr/bin/python dape -v import"
 
 rm ductape.db
 rm -rf tmp
@@ -46,7 +46,7 @@ rm -rf tmp
 echo -e $green"Deletion AND insertion mutants"$reset
 
 /usr/bin/python dape -v init || die "/usr/bin/python dape -v init"
-/usr/bin/python dape -v import kegg.tsv || die "/usr/bin/python dape -v import"
+/usr/bin/python dape -v import kegg.tsv.gz || die "/usr/bin/python dape -v import"
 sleep 5
 /usr/bin/python dape -v add Rm1021 -c red || die "/usr/bin/python dape -v add"
 /usr/bin/python dape -v add-mut -k deletion -c blue -m Rm1021 del || die "/usr/bin/python dape -v add-mut"
@@ -79,7 +79,7 @@ sleep 5
 
 /usr/bin/python dape -v clear --keep-org || die "/usr/bin/python dape -v clear"
 sleep 5
-/usr/bin/python dape -v import kegg.tsv || die "/usr/bin/python dape -v import"
+/usr/bin/python dape -v import kegg.tsv.gz || die "/usr/bin/python dape -v import"
 
 rm ductape.db
 rm -rf tmp
@@ -88,7 +88,7 @@ echo -e $green"Pangenome"$reset
 
 /usr/bin/python dape -v init || die "/usr/bin/python dape -v init"
 /usr/bin/python dape -v add-multi Rm1021 AK83 AK58 BL225C || die "/usr/bin/python dape -v add-multi"
-/usr/bin/python dape -v import kegg.tsv || die "/usr/bin/python dape -v import"
+/usr/bin/python dape -v import kegg.tsv.gz || die "/usr/bin/python dape -v import"
 sleep 5
 
 /usr/bin/python dgenome -v add-dir test/input/pangenome || die "/usr/bin/python dgenome -v add-dir"
@@ -117,14 +117,14 @@ sleep 5
 /usr/bin/python dape -v export || die "/usr/bin/python dape -v export"
 /usr/bin/python dape -v clear --keep-org || die "/usr/bin/python dape -v clear"
 sleep 5
-/usr/bin/python dape -v import kegg.tsv || die "/usr/bin/python dape -v import"
+/usr/bin/python dape -v import kegg.tsv.gz || die "/usr/bin/python dape -v import"
 
 rm ductape.db
 
 echo -e $green"Custom plates"$reset
 
 /usr/bin/python dape -v init || die "dape init"
-/usr/bin/python dape -v import kegg.tsv || die "/usr/bin/python dape -v import"
+/usr/bin/python dape -v import kegg.tsv.gz || die "/usr/bin/python dape -v import"
 sleep 5
 /usr/bin/python dphenome -v import-plates test/input/newplate.tsv || die "dphenome import-plates (good)"
 sleep 5
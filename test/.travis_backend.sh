@@ -0,0 +1,175 @@
+#!/bin/bash
+
+green="\033[1;32m"
+red="\033[1;31m"
+reset="\033[0m"
+
+die () {
+        echo -e $red"############"$reset
+	echo -e $red$1$reset
+	echo -e $red"Test failed!"$reset
+	echo -e $red"############"$reset
+	exit 1
+}
+
+echo -e $green"Search backend (fake diamond)"$reset
+
+fake=$(mktemp -d)
+
+# Fake executable: logs its command line and writes a BLAST XML output
+cat > $fake/diamond << 'EOF'
+#!/bin/bash
+echo "$@" >> $FAKE_DIAMOND_LOG
+case $1 in
+	version)
+		echo "diamond version 0.0.0"
+		;;
+	makedb)
+		touch $5.dmnd
+		;;
+	blastp)
+		out=/dev/stdout
+		while [ $# -gt 0 ]; do
+			if [ "$1" == "-o" ]; then out=$2; fi
+			shift
+		done
+		cat > $out << 'XML'
+<?xml version="1.0"?>
+<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">
+<BlastOutput>
+  <BlastOutput_program>blastp</BlastOutput_program>
+  <BlastOutput_version>diamond 0.0.0</BlastOutput_version>
+  <BlastOutput_reference></BlastOutput_reference>
+  <BlastOutput_db>db</BlastOutput_db>
+  <BlastOutput_query-ID>Query_1</BlastOutput_query-ID>
+  <BlastOutput_query-def>q1 first</BlastOutput_query-def>
+  <BlastOutput_query-len>10</BlastOutput_query-len>
+  <BlastOutput_param>
+    <Parameters>
+      <Parameters_matrix>BLOSUM80</Parameters_matrix>
+      <Parameters_expect>1e-10</Parameters_expect>
+      <Parameters_gap-open>11</Parameters_gap-open>
+      <Parameters_gap-extend>1</Parameters_gap-extend>
+      <Parameters_filter>F</Parameters_filter>
+    </Parameters>
+  </BlastOutput_param>
+  <BlastOutput_iterations>
+    <Iteration>
+      <Iteration_iter-num>1</Iteration_iter-num>
+      <Iteration_query-ID>Query_1</Iteration_query-ID>
+      <Iteration_query-def>q1 first</Iteration_query-def>
+      <Iteration_query-len>10</Iteration_query-len>
+      <Iteration_hits>
+        <Hit>
+          <Hit_num>1</Hit_num>
+          <Hit_id>p1</Hit_id>
+          <Hit_def>target protein</Hit_def>
+          <Hit_accession>p1</Hit_accession>
+          <Hit_len>10</Hit_len>
+          <Hit_hsps>
+            <Hsp>
+              <Hsp_num>1</Hsp_num>
+              <Hsp_bit-score>20.5</Hsp_bit-score>
+              <Hsp_score>45</Hsp_score>
+              <Hsp_evalue>1e-20</Hsp_evalue>
+              <Hsp_query-from>1</Hsp_query-from>
+              <Hsp_query-to>10</Hsp_query-to>
+              <Hsp_hit-from>1</Hsp_hit-from>
+              <Hsp_hit-to>10</Hsp_hit-to>
+              <Hsp_query-frame>0</Hsp_query-frame>
+              <Hsp_hit-frame>0</Hsp_hit-frame>
+              <Hsp_identity>9</Hsp_identity>
+              <Hsp_positive>10</Hsp_positive>
+              <Hsp_gaps>0</Hsp_gaps>
+              <Hsp_align-len>10</Hsp_align-len>
+              <Hsp_qseq>MKVLAAGIVG</Hsp_qseq>
+              <Hsp_hseq>MKVLAAGIVA</Hsp_hseq>
+              <Hsp_midline>MKVLAAGIV </Hsp_midline>
+            </Hsp>
+          </Hit_hsps>
+        </Hit>
+      </Iteration_hits>
+      <Iteration_stat>
+        <Statistics>
+          <Statistics_db-num>2</Statistics_db-num>
+          <Statistics_db-len>20</Statistics_db-len>
+          <Statistics_hsp-len>0</Statistics_hsp-len>
+          <Statistics_eff-space>0</Statistics_eff-space>
+          <Statistics_kappa>0.041</Statistics_kappa>
+          <Statistics_lambda>0.267</Statistics_lambda>
+          <Statistics_entropy>0.14</Statistics_entropy>
+        </Statistics>
+      </Iteration_stat>
+    </Iteration>
+  </BlastOutput_iterations>
+</BlastOutput>
+XML
+		;;
+	*)
+		exit 1
+		;;
+esac
+EOF
+chmod +x $fake/diamond
+
+printf ">p1 target\nMKVLAAGIVA\n>p2 other\nMSTNPKPQRK\n" > $fake/target.faa
+printf ">q1 first\nMKVLAAGIVG\n" > $fake/query.faa
+
+export FAKE_DIAMOND_LOG=$fake/log
+PATH=$fake:$PATH python - $fake << 'EOF' || die "fake diamond backend"
+import logging
+import os
+import sys
+from ductape.genome.blast import getBackend
+
+logging.basicConfig(level=logging.ERROR)
+
+fake = sys.argv[1]
+log = os.path.join(fake, 'log')
+db = os.path.join(fake, 'db')
+target = os.path.join(fake, 'target.faa')
+query = os.path.join(fake, 'query.faa')
+out = os.path.join(fake, 'out.xml')
+
+def last():
+    return open(log).read().strip().split('\n')[-1]
+
+try:
+    getBackend('unknown')
+    sys.exit('Unknown backends should raise ValueError')
+except ValueError:
+    pass
+
+blaster = getBackend('diamond', useDisk=True)
+assert blaster.isAvailable()
+
+assert blaster.createDB(target, 'prot', db)
+assert last() == 'makedb --in %s -d %s'%(target, db), last()
+assert os.path.exists(db + '.faa')
+assert not blaster.createDB(target, 'nucl', db)
+
+additional = (' -soft_masking true -dbsize 500000000 '+
+              '-use_sw_tback -max_target_seqs 1 -matrix BLOSUM80')
+assert (blaster._translate(additional) ==
+        '--max-target-seqs 1 --matrix BLOSUM80'), blaster._translate(additional)
+
+assert blaster.runBlast(query, db, out, evalue=1e-10, ncpus=2,
+                        additional=additional)
+expected = ('blastp -d %s -q %s -e 1e-10 --outfmt 5 -p 2 --quiet '+
+            '--max-target-seqs 1 --matrix BLOSUM80 -o %s')%(db, query, out)
+assert last() == expected, last()
+
+assert blaster.runBlast(query, db, out, evalue=1e-10, task='blastp-short')
+assert '--more-sensitive' in last().split(), last()
+
+blaster.parseBlast(out)
+hits = [h for h in blaster.getHits(1e-10)]
+assert len(hits) == 1 and len(hits[0]) == 1
+assert hits[0][0].query_id == 'q1' and hits[0][0].hit == 'p1'
+
+assert blaster.retrieveFromDB(db, 'p2', out=os.path.join(fake, 'p2.faa'))
+assert open(os.path.join(fake, 'p2.faa')).read().startswith('>p2')
+assert not blaster.retrieveFromDB(db, 'p3', out=os.path.join(fake, 'p3.faa'))
+EOF
+
+rm -rf $fake
@@ -0,0 +1,104 @@
+#!/bin/bash
+
+green="\033[1;32m"
+red="\033[1;31m"
+reset="\033[0m"
+
+die () {
+        echo -e $red"############"$reset
+	echo -e $red$1$reset
+	echo -e $red"Test failed!"$reset
+	echo -e $red"############"$reset
+	exit 1
+}
+
+echo -e $green"Job executors"$reset
+
+spool=$(mktemp -d)
+
+python - $spool << 'EOF' || die "spool executor, local workers"
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from functools import partial
+from ductape.common.executors import SpoolExecutor, LocalExecutor, \
+    claimJob, runWorker
+
+logging.basicConfig(level=logging.CRITICAL)
+
+spool = sys.argv[1]
+
+# Multiple local workers, standing in for the nodes
+start = time.time()
+res = list(SpoolExecutor(spool, workers=4, poll=0.05).run(
+           [partial(time.sleep, 0.5) for i in range(8)]))
+assert res == [None] * 8
+assert time.time() - start < 3, 'The jobs did not run in parallel'
+
+res = SpoolExecutor(spool, workers=3, poll=0.05).run(
+      [partial(pow, i, 2) for i in range(20)])
+assert sorted(res) == [i * i for i in range(20)]
+
+assert sorted(LocalExecutor(2).run([partial(pow, i, 2) for i in range(5)])
+              ) == [0, 1, 4, 9, 16]
+
+# A job raising an exception makes the executor fail
+try:
+    list(SpoolExecutor(spool, workers=2, poll=0.05).run(
+         [partial(int, 'x'), partial(pow, 2, 2)]))
+    sys.exit('A failed job should raise RuntimeError')
+except RuntimeError:
+    pass
+
+# Nobody serves the queue
+try:
+    list(SpoolExecutor(spool, poll=0.05, timeout=1).run([partial(pow, 2, 2)]))
+    sys.exit('The timeout should raise RuntimeError')
+except RuntimeError:
+    pass
+
+# Cleanup of the jobs left by the failing runs
+for d in ('queue', 'running', 'done'):
+    for f in os.listdir(os.path.join(spool, d)):
+        os.remove(os.path.join(spool, d, f))
+
+# A worker dies holding a claim: the job is requeued
+class DeadWorkerSpool(SpoolExecutor):
+    launched = 0
+    def launch(self, job):
+        self.launched += 1
+        if self.launched > 1:
+            return
+        claimed = claimJob(self.spool, job)
+        os.utime(claimed, (0, 0))
+        self.worker = multiprocessing.Process(target=runWorker,
+                                              args=(spool, None, False, 0.05))
+        self.worker.start()
+
+executor = DeadWorkerSpool(spool, poll=0.05, stale=1, timeout=30)
+res = list(executor.run([partial(pow, 3, 2)]))
+executor.worker.terminate()
+assert res == [9], res
+assert executor.launched == 2, 'The stale claim was not requeued'
+EOF
+
+# Separate worker processes serving the same spool
+python dgenome worker $spool &> /dev/null &
+w1=$!
+python dgenome worker $spool &> /dev/null &
+w2=$!
+
+python - $spool << 'EOF' || die "spool executor, worker processes"
+import sys
+from functools import partial
+from ductape.common.executors import SpoolExecutor
+
+res = SpoolExecutor(sys.argv[1], poll=0.05, timeout=60).run(
+      [partial(pow, i, 2) for i in range(20)])
+assert sorted(res) == [i * i for i in range(20)]
+EOF
+
+kill $w1 $w2
+rm -rf $spool
@@ -15,7 +15,7 @@ die () {
 echo -e $green"Custom plates"$reset
 
 python dape -v init || die "dape init"
-python dape -v import kegg.tsv || die "python dape -v import"
+python dape -v import kegg.tsv.gz || die "python dape -v import"
 sleep 5
 python dphenome -v import-plates test/input/newplate.tsv || die "dphenome import-plates (good)"
 sleep 5
@@ -15,7 +15,7 @@ die () {
 echo -e $green"Deletion AND insertion mutants"$reset
 
 python dape -v init || die "python dape -v init"
-python dape -v import kegg.tsv || die "python dape -v import"
+python dape -v import kegg.tsv.gz || die "python dape -v import"
 sleep 5
 python dape -v add Rm1021 -c red || die "python dape -v add"
 python dape -v add-mut -k deletion -c blue -m Rm1021 del || die "python dape -v add-mut"
@@ -50,7 +50,7 @@ python dape -v export || die "python dape -v export"
 
 python dape -v clear --keep-org || die "python dape -v clear"
 sleep 5
-python dape -v import kegg.tsv || die "python dape -v import"
+python dape -v import kegg.tsv.gz || die "python dape -v import"
 
 rm ductape.db
 rm -rf tmp
@@ -16,7 +16,7 @@ echo -e $green"Pangenome"$reset
 
 python dape -v init || die "python dape -v init"
 python dape -v add-multi Rm1021 AK83 AK58 BL225C || die "python dape -v add-multi"
-python dape -v import kegg.tsv || die "python dape -v import"
+python dape -v import kegg.tsv.gz || die "python dape -v import"
 sleep 5
 
 python dgenome -v add-dir test/input/pangenome || die "python dgenome -v add-dir"
@@ -50,6 +50,94 @@ python dape start -s > /dev/null || die "python dape start"
 python dape -v export || die "python dape -v export"
 python dape -v clear --keep-org || die "python dape -v clear"
 sleep 5
-python dape -v import kegg.tsv || die "python dape -v import"
+python dape -v import kegg.tsv.gz || die "python dape -v import"
 
 rm ductape.db
+
+# Identical proteins: same groups and KO assignments with and without
+# their deduplication (needs the BLAST executables)
+if which blastp > /dev/null; then
+	dedup=$(mktemp -d)
+	# Small KEGG-like DB, one KO for each protein of Rm1021
+	python - test/input/pangenome/Rm1021.faa $dedup/kegg.faa << 'EOF' || die "KEGG test DB"
+import sys
+from Bio import SeqIO
+f = open(sys.argv[2], 'w')
+for i, s in enumerate(SeqIO.parse(open(sys.argv[1]), 'fasta')):
+    f.write('>kegg%d K%05d\n%s\n'%(i, i + 1, str(s.seq)))
+f.close()
+EOF
+	for run in dedup nodedup; do
+		if [ $run == "nodedup" ]; then flag="--no-dedup"; else flag=""; fi
+		opts="-p $dedup/$run.db -w $dedup/$run"
+		mkdir $dedup/$run
+		python dape $opts init || die "python dape init ($run)"
+		python dape $opts add-multi Rm1021 AK83 AK58 BL225C || die "python dape add-multi ($run)"
+		python dgenome $opts add-dir test/input/pangenome || die "python dgenome add-dir ($run)"
+		python dgenome $opts start -l -k $dedup/kegg.faa $flag > /dev/null || die "python dgenome start ($run)"
+	done
+	python - $dedup/dedup.db $dedup/nodedup.db << 'EOF' || die "pangenome with and without dedup"
+import sqlite3
+import sys
+
+def getResults(project):
+    conn = sqlite3.connect(project)
+    groups = {}
+    for group, prot in conn.execute('select group_id, prot_id from ortholog;'):
+        groups.setdefault(group, set()).add(prot)
+    kos = set(conn.execute('select prot_id, ko_id from mapko;'))
+    return set([frozenset(x) for x in groups.values()]), kos
+
+dgroups, dkos = getResults(sys.argv[1])
+groups, kos = getResults(sys.argv[2])
+assert len(dgroups) > 0 and len(dkos) > 0
+assert dgroups == groups, dgroups ^ groups
+assert dkos == kos, dkos ^ kos
+EOF
+	# A paralog in the first organism hides the ortholog of the third one,
+	# which is found back only from the identical copy in the second one
+	python - $dedup << 'EOF' || die "pangenome with and without dedup (paralogs)"
+import logging
+import os
+import random
+import sys
+from ductape.genome.pangenome import PanGenomer
+
+logging.basicConfig(level=logging.CRITICAL)
+
+os.chdir(sys.argv[1])
+random.seed(1)
+
+aminoacids = 'ACDEFGHIKLMNPQRSTVWY'
+
+def getRandom(length):
+    return ''.join([random.choice(aminoacids) for i in range(length)])
+
+def mutate(seq, rate):
+    return ''.join([random.choice(aminoacids) if random.random() < rate else c
+                    for c in seq])
+
+x = getRandom(200)
+p = mutate(x, 0.1)
+t = mutate(p, 0.05)
+proteomes = {'orgA.faa':[('x', x), ('p', p)],
+             'orgB.faa':[('xcopy', x)],
+             'orgC.faa':[('t', t)]}
+for fname, prots in proteomes.iteritems():
+    f = open(fname, 'w')
+    for i in range(3):
+        prots.append(('%s_%d'%(fname.split('.')[0], i), getRandom(150)))
+    for prot, seq in prots:
+        f.write('>%s\n%s\n'%(prot, seq))
+    f.close()
+
+results = []
+for dedup in (True, False):
+    pang = PanGenomer(sorted(proteomes), dedup=dedup)
+    pang.run()
+    results.append(set([frozenset(g) for g in pang.orthologs.values()]))
+assert results[0] == results[1], results[0] ^ results[1]
+assert frozenset(['x', 'xcopy', 't']) in results[0], results[0]
+EOF
+	rm -rf $dedup
+fi
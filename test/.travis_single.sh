@@ -43,7 +43,7 @@ python dape -v export || die "python dape -v export"
 
 python dape -v clear --keep-org || die "python dape -v clear"
 sleep 5
-python dape -v import kegg.tsv || die "python dape -v import"
+python dape -v import kegg.tsv.gz || die "python dape -v import"
 
 rm ductape.db
 rm -rf tmp
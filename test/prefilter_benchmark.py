@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Prefilter benchmark
+
+Recall and speed of the k-mer prefilter on simulated proteomes: a set of
+random proteins is mutated at decreasing identity levels (substitutions
+biased towards similar residues, plus short indels); the recall is the
+fraction of homologs kept, while unrelated random queries should be
+filtered out
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from ductape.genome.prefilter import KmerIndex
+
+__author__ = "Marco Galardini"
+
+################################################################################
+# Constants
+
+aminoacids = 'ACDEFGHIKLMNPQRSTVWY'
+frequencies = np.array([8.25, 1.37, 5.45, 6.75, 3.86, 7.07, 2.27, 5.96, 5.84,
+                        9.66, 2.42, 4.06, 4.70, 3.93, 5.53, 6.56, 5.34, 6.87,
+                        1.08, 2.92])
+similar = ['LVIM', 'C', 'A', 'G', 'ST', 'P', 'FYW', 'EDNQ', 'KR', 'H']
+identities = [0.9, 0.7, 0.5, 0.4, 0.3]
+setups = [('111011011', 3), ('111011011', 2), ('11011011', 3)]
+
+################################################################################
+# Classes
+
+class Record(object):
+    '''
+    Minimal Bio.SeqRecord stand-in
+    '''
+    def __init__(self, id, seq):
+        self.id = id
+        self.seq = seq
+
+################################################################################
+# Methods
+
+def getRandom(length):
+    return ''.join(np.random.choice(list(aminoacids), length,
+                                    p=frequencies / frequencies.sum()))
+
+def mutate(seq, identity, indels):
+    '''
+    Returns a mutated copy of seq
+    '''
+    groups = dict((c, g) for g in similar for c in g)
+    out = []
+    for c in seq:
+        if random.random() < indels:
+            if random.random() < 0.5:
+                continue
+            out.append(random.choice(aminoacids))
+        if random.random() < identity:
+            out.append(c)
+        elif random.random() < 0.4:
+            out.append(random.choice(groups[c]))
+        else:
+            out.append(random.choice(aminoacids))
+    return ''.join(out)
+
+def getOptions():
+    parser = argparse.ArgumentParser(description='Prefilter benchmark')
+    parser.add_argument('-n', action='store', type=int, default=1500,
+                        dest='nprot',
+                        help='Proteins in each proteome [Default: 1500]')
+    parser.add_argument('-q', action='store', type=int, default=300,
+                        dest='nquery',
+                        help='Queries [Default: 300]')
+    parser.add_argument('-i', action='store', type=float, default=0.02,
+                        dest='indels',
+                        help='Indel rate [Default: 0.02]')
+    parser.add_argument('-s', action='store', type=int, default=1,
+                        dest='seed',
+                        help='Random seed [Default: 1]')
+    return parser.parse_args()
+
+################################################################################
+
+if __name__ == '__main__':
+    options = getOptions()
+
+    random.seed(options.seed)
+    np.random.seed(options.seed)
+
+    base = [getRandom(random.randint(100, 600)) for i in range(options.nprot)]
+    orgs = {}
+    for org, identity in enumerate(identities):
+        orgs[org] = [Record('o%d_%d'%(org, i),
+                            mutate(s, identity, options.indels))
+                     for i, s in enumerate(base)]
+    unrelated = [getRandom(random.randint(100, 600))
+                 for i in range(options.nquery)]
+    queries = base[:options.nquery]
+
+    for seed, minseeds in setups:
+        index = KmerIndex(seed, minseeds)
+
+        start = time.time()
+        for org in orgs:
+            index.addOrganism(org, orgs[org])
+        tindex = time.time() - start
+
+        start = time.time()
+        recall = [np.mean([index.hasCandidates(q, org) for q in queries])
+                  for org in orgs]
+        kept = np.mean([index.hasCandidates(q, org)
+                        for q in unrelated for org in orgs])
+        tquery = (time.time() - start) / ((len(queries) + len(unrelated)) *
+                                          len(orgs))
+
+        print('%s (minseeds %d): index %.1fs, query %.2fms'%(seed, minseeds,
+              tindex, tquery * 1000))
+        print('\trecall by identity: %s'%' '.join(['%.1f:%.3f'%x
+                                       for x in zip(identities, recall)]))
+        print('\tunrelated queries kept: %.3f'%kept)
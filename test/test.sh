@@ -48,10 +48,10 @@ echo -e $green"Single organism"$reset
 
 ../dape export || die "dape export"
 
-cp kegg.tsv input/ &> /dev/null
+cp kegg.tsv.gz input/ &> /dev/null
 
 ../dape clear --keep-org || die "dape clear"
-../dape import kegg.tsv || die "dape import"
+../dape import kegg.tsv.gz || die "dape import"
 sleep 5
 
 ../dape clear --keep-kegg || die "dape clear"
@@ -61,7 +61,7 @@ cleanUp
 echo -e $green"Deletion AND insertion mutants"$reset
 
 ../dape init || die "dape init"
-../dape import input/kegg.tsv || die "dape import"
+../dape import input/kegg.tsv.gz || die "dape import"
 sleep 5
 ../dape add Rm1021 -c red || die "dape add"
 ../dape add-mut -k deletion -c blue -m Rm1021 del || die "dape add-mut"
@@ -95,10 +95,10 @@ sleep 5
 
 ../dape export || die "dape export"
 
-cp kegg.tsv input/ &> /dev/null
+cp kegg.tsv.gz input/ &> /dev/null
 
 ../dape clear --keep-org || die "dape clear"
-../dape import kegg.tsv || die "dape import"
+../dape import kegg.tsv.gz || die "dape import"
 sleep 5
 
 ../dape clear --keep-kegg || die "dape clear"
@@ -109,7 +109,7 @@ echo -e $green"Pangenome"$reset
 
 ../dape init || die "dape init"
 ../dape add-multi Rm1021 AK83 AK58 BL225C || die "dape add-multi"
-../dape import input/kegg.tsv || die "dape import"
+../dape import input/kegg.tsv.gz || die "dape import"
 sleep 5
 
 ../dgenome add-dir input/pangenome || die "dgenome add-dir"
@@ -142,7 +142,7 @@ sleep 5
 
 ../dape export || die "dape export"
 ../dape clear --keep-org || die "dape clear"
-../dape import kegg.tsv || die "dape import"
+../dape import kegg.tsv.gz || die "dape import"
 
 ../dape clear --keep-kegg || die "dape clear"
 
@@ -155,7 +155,7 @@ cleanUp
 echo -e $green"Custom plates"$reset
 
 ../dape init || die "dape init"
-../dape import input/kegg.tsv || die "dape import"
+../dape import input/kegg.tsv.gz || die "dape import"
 sleep 5
 ../dphenome import-plates input/newplate.tsv || die "dphenome import-plates (good)"
 ../dphenome export || die "dphenome export"